@@ -0,0 +1,147 @@
+"""
+Admission control of the jobs sent to the inference workers
+"""
+import time
+from typing import Dict, List, Optional
+
+import redis.asyncio as redis
+
+import redis_models
+import metrics
+
+# Workers that did not report in this time are considered gone,
+# must match the inference worker heartbeat
+WORKER_HEARTBEAT_S = 30
+
+
+class AdmissionRejected(Exception):
+    """
+    Raised when a job is not enqueued because the inference
+    workers are overloaded
+    """
+    def __init__(self, status_code: int, detail: str, retry_after_s: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after_s = retry_after_s
+
+
+class AdmissionController():
+    """
+    Rejects new jobs when the job streams of all the models and modalities hold more
+    than `max_queue_depth` jobs (503), or when the estimated wait in the queue
+    exceeds the time left before the deadline of the request (429).
+    The wait is estimated from the queue depth and the average job
+    time reported by the active workers. Only the jobs of the same or
+    higher priority classes are counted, the workers read them first,
+    so bulk jobs never cause the rejection of interactive ones. The
+    load is read from Redis at most once every `refresh_interval_s` seconds
+    """
+    def __init__(
+            self,
+            redis_client: redis.Redis,
+            model_names: List[str],
+            max_queue_depth: int,
+            refresh_interval_s: float = 0.1):
+        """
+        Constructor for the AdmissionController class
+
+        Args:
+        - redis_client (redis.Redis): The Redis client
+        - model_names (List[str]): The models served, the workers share
+            their capacity between all of them
+        - max_queue_depth (int): The maximum number of queued jobs, 0 disables the limit
+        - refresh_interval_s (float): The minimum time between two reads of the load
+        """
+        self.redis_client = redis_client
+        self.streams = [
+            (priority, redis_models.job_stream(model_name, modality, priority))
+            for priority in redis_models.PRIORITY_CLASSES
+            for model_name in model_names
+            for modality in redis_models.JOB_MODALITIES]
+        self.max_queue_depth = max_queue_depth
+        self.refresh_interval_s = refresh_interval_s
+
+        self.queue_depths: Dict[str, int] = {priority: 0 for priority in redis_models.PRIORITY_CLASSES}
+        self.estimated_job_time_s: Optional[float] = None
+        self.last_refresh = 0.0
+
+    async def refresh(self):
+        """
+        Read the queue depth and the average job time of the active workers
+        """
+        now = time.time()
+        pipeline = self.redis_client.pipeline(transaction=False)
+        # The workers delete the jobs once answered, so the length of
+        # the streams is the number of queued and running jobs
+        for _, stream in self.streams:
+            pipeline.xlen(stream)
+        pipeline.zrangebyscore("workers", now - WORKER_HEARTBEAT_S, "+inf")
+        pipeline.hgetall("workers:job_time_s")
+        *streams_length, active_workers, job_times = await pipeline.execute()
+        queue_depths = {priority: 0 for priority in redis_models.PRIORITY_CLASSES}
+        for (priority, _), length in zip(self.streams, streams_length):
+            queue_depths[priority] += length
+
+        job_times = {
+            (key.decode() if isinstance(key, bytes) else key): float(value)
+            for key, value in job_times.items()}
+        active_times = [
+            job_times[worker]
+            for worker in (w.decode() if isinstance(w, bytes) else w for w in active_workers)
+            if worker in job_times]
+
+        self.queue_depths = queue_depths
+        for priority, depth in queue_depths.items():
+            metrics.QUEUE_DEPTH.labels(priority).set(depth)
+        self.estimated_job_time_s = None
+        if active_times:
+            # N workers drain the queue N times faster
+            mean_job_time_s = sum(active_times) / len(active_times)
+            self.estimated_job_time_s = mean_job_time_s / len(active_times)
+        self.last_refresh = now
+
+    def queue_depth(self, priority: str) -> int:
+        """
+        Get the number of queued jobs of a priority class and the higher ones
+        """
+        classes = redis_models.PRIORITY_CLASSES[:redis_models.PRIORITY_CLASSES.index(priority) + 1]
+        return sum(self.queue_depths[priority_class] for priority_class in classes)
+
+    def estimated_wait_s(self, priority: str) -> float:
+        """
+        Get the estimated time a new job of a priority class waits in the queue
+        """
+        if self.estimated_job_time_s is None:
+            return 0.0
+        return self.queue_depth(priority) * self.estimated_job_time_s
+
+    async def check(self, priority: str, deadline: Optional[float] = None):
+        """
+        Check if a new job can be enqueued
+
+        Args:
+        - priority (str): The priority class of the job, see `redis_models.PRIORITY_CLASSES`
+        - deadline (Optional[float]): The unix time the job must be completed by
+
+        Raises:
+        - AdmissionRejected: If the job should not be enqueued
+        """
+        if time.time() - self.last_refresh > self.refresh_interval_s:
+            await self.refresh()
+
+        queue_depth = self.queue_depth(priority)
+        if self.max_queue_depth > 0 and queue_depth >= self.max_queue_depth:
+            metrics.REJECTIONS.labels("queue_full").inc()
+            raise AdmissionRejected(
+                status_code=503,
+                detail=f"The inference queue is full ({queue_depth} jobs)",
+                retry_after_s=max(1, round(self.estimated_wait_s(priority))))
+
+        estimated_wait_s = self.estimated_wait_s(priority)
+        if deadline is not None and time.time() + estimated_wait_s > deadline:
+            metrics.REJECTIONS.labels("queue_wait").inc()
+            raise AdmissionRejected(
+                status_code=429,
+                detail=f"The estimated queue wait ({estimated_wait_s:.1f}s) exceeds the request timeout",
+                retry_after_s=max(1, round(estimated_wait_s)))
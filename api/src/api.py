@@ -1,50 +1,397 @@
+import time
 import uuid
-import json
 import base64
-from typing import List, Union, Optional
+import asyncio
+from typing import List, Union, Optional, Tuple
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-from fastapi import FastAPI
+import numpy as np
+import redis.asyncio as redis
+from fastapi import FastAPI, HTTPException, Request, Depends, Path, Query
+from fastapi.responses import JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 import models
-from redis_manager import RedisManager
-from environment_variables import should_show_api_docs
+import redis_models
+from redis_manager import JobFailed, RedisManager
+from response_encoding import encode_response, encode_embedding
+from streaming import DuplexStreamingResponse, StreamItem, stream_embeddings
+from embedding_cache import EmbeddingCache, text_digest, image_digest
+from embedding_transform import EmbeddingTransform, ProjectionStore
+from zero_shot import ZeroShotStore, classification_response, normalize
+from admission import AdmissionRejected
+from tenants import TenantLimiter, TenantMiddleware, request_priority
+from metrics import MetricsMiddleware
+from job_timing import TimingMiddleware, job_stages, request_jobs
+from vector_index import IndexStore
+from uploads import SUPPORTED_FORMATS, read_uploaded_images, sniff_image_format
+from image_downscale import downscale_image, model_input_size
+from environment_variables import (
+    should_show_api_docs, get_clip_model_names, get_image_transport, get_image_ttl_s,
+    get_text_cache_size, get_text_cache_ttl_s, get_image_cache_size, get_image_cache_ttl_s,
+    get_request_timeout_s, get_max_queue_depth, get_stream_chunk_size, get_stream_max_in_flight,
+    get_index_dir, get_index_ivf_min_vectors, get_index_nprobe,
+    should_downscale_images, get_image_downscale_quality, get_image_downscale_workers, get_tenants,
+    get_api_keys, get_slow_request_ms, get_redis_host, get_redis_port,
+    get_cache_redis_host, get_cache_redis_port)
 
 
-async def write_images(images_path: Optional[List[str]] = None, images_b64: Optional[List[str]] = None):
+def decode_image_items(items: List[StreamItem]) -> List[Optional[bytes]]:
     """
-    Write images to disk from base64 encoded strings
+    Decode the base64 images of a stream chunk one by one,
+    so that an invalid image does not fail the others
+
+    Args:
+    - items (List[StreamItem]): The stream items with the base64 images
+
+    Returns:
+    - List[Optional[bytes]]: The raw bytes of the images, None for the invalid ones
+    """
+    images_data = []
+    for _, _, img in items:
+        try:
+            images_data.append(base64.b64decode(img.split(",")[-1], validate=True))
+        except ValueError:
+            images_data.append(None)
+    return images_data
+
+
+def decode_images(images_b64: List[str]) -> List[bytes]:
+    """
+    Decode base64 images with the data URI header,
+    e.g. data:image/png;base64,...
     
     Args:
-    - images_path (List[str]): List of paths to write the images
     - images_b64 (List[str]): List of base64 encoded images
+    
+    Returns:
+    - List[bytes]: The raw bytes of the images
+
+    Raises:
+    - HTTPException: If an image is not valid base64
+    """
+    images_data = []
+    for idx, img in enumerate(images_b64):
+        try:
+            images_data.append(base64.b64decode(img.split(",")[-1], validate=True))
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"Image {idx} is not valid base64")
+    return images_data
+
+
+async def embed_texts(
+        texts: List[str],
+        model_name: str,
+        deadline: float,
+        priority: str
+    ) -> List[redis_models.RedisTextEmbedding]:
+    """
+    Get the text features of the given texts. Cached features are
+    reused, only the misses are sent to the inference worker and
+    their features are added to the cache
+    
+    Args:
+    - texts (List[str]): The texts to embed
+    - model_name (str): The CLIP model to use
+    - deadline (float): The unix time the worker must answer by
+    - priority (str): The priority class of the job
+    
+    Returns:
+    - List[RedisTextEmbedding]: The packed text features, in the same order as `texts`
     """
+    digests = [text_digest(text) for text in texts]
+    cached = await text_cache.get_many(model_name, digests)
+
+    # Send every missing text only once, even if repeated in the request
+    missing = {}
+    for text, digest, embedding in zip(texts, digests, cached):
+        if embedding is None and digest not in missing:
+            missing[digest] = text
+
+    computed = {}
+    if missing:
+        job_id = str(uuid.uuid4())
+        await redis_helper.enqueue_job(
+            job_id, model_name, texts=list(missing.values()), deadline=deadline, priority=priority)
+        result = await redis_helper.get_result(job_id, deadline)
+
+        computed = {
+            digest: item.embedding 
+            for digest, item in zip(missing.keys(), result.text_embeddings)}
+        await text_cache.set_many(model_name, computed)
+
+    return [
+        redis_models.RedisTextEmbedding(
+            text=text, 
+            embedding=embedding if embedding is not None else computed[digest])
+        for text, digest, embedding in zip(texts, digests, cached)]
 
-    if images_path is None or images_b64 is None:
-        return
+
+async def embed_images(
+        images_data: List[bytes],
+        model_name: str,
+        deadline: float,
+        priority: str
+    ) -> Tuple[List[Optional[redis_models.RedisImageEmbedding]], List[redis_models.ImageError]]:
+    """
+    Get the image features of the given images, identified by the hash
+    of their content. Cached features are reused, only the misses are
+    sent to the inference worker and their features are added to the cache
     
-    for img_path, img_data in zip(images_path, images_b64):
-        with open(img_path, "wb") as f:
-            f.write(base64.b64decode(img_data))
+    Args:
+    - images_data (List[bytes]): The raw bytes of the images
+    - model_name (str): The CLIP model to use
+    - deadline (float): The unix time the worker must answer by
+    - priority (str): The priority class of the job
+    
+    Returns:
+    - List[Optional[RedisImageEmbedding]]: The packed image features, in the
+        same order as `images_data`, None for the images that failed
+    - List[ImageError]: The errors of the failed images
+    """
+    # hashing large images is CPU bound, keep it off the event loop
+    digests = await asyncio.to_thread(lambda: [image_digest(data) for data in images_data])
+    cached = await image_cache.get_many(model_name, digests)
+    # images that are not in a known format are never sent to the worker
+    supported = [sniff_image_format(data) is not None for data in images_data]
+
+    # Send every missing image only once, even if repeated in the request
+    missing = {}
+    for idx, (digest, embedding) in enumerate(zip(digests, cached)):
+        if embedding is None and supported[idx] and digest not in missing:
+            missing[digest] = idx
+
+    computed = {}
+    failed = {}
+    if missing:
+        job_id = str(uuid.uuid4())
+        missing_digests = list(missing.keys())
+        images_to_send = [images_data[idx] for idx in missing.values()]
+        if downscale_executor is not None:
+            # the ids and the cache keys are the digests of the original images
+            loop = asyncio.get_running_loop()
+            images_to_send = await asyncio.gather(*[
+                loop.run_in_executor(
+                    downscale_executor, downscale_image, data, model_input_size(model_name), downscale_quality)
+                for data in images_to_send])
+        await redis_helper.enqueue_job(
+            job_id, 
+            model_name,
+            images=images_to_send,
+            images_id=missing_digests,
+            deadline=deadline,
+            priority=priority)
+        result = await redis_helper.get_result(job_id, deadline)
+
+        computed = {item.image_id: item.embedding for item in result.image_embeddings}
+        failed = {missing_digests[error.image_index]: error.error for error in result.errors or []}
+        await image_cache.set_many(model_name, computed)
+
+    image_embeddings = []
+    errors = []
+    for idx, (digest, embedding) in enumerate(zip(digests, cached)):
+        if embedding is None:
+            embedding = computed.get(digest)
+        if embedding is None:
+            image_embeddings.append(None)
+            error = failed.get(digest, "The image could not be embedded")
+            if not supported[idx]:
+                error = f"Unsupported image format, expected one of {SUPPORTED_FORMATS}"
+            errors.append(redis_models.ImageError(image_index=idx, error=error))
+        else:
+            image_embeddings.append(
+                redis_models.RedisImageEmbedding(image_id=digest, embedding=embedding))
+
+    return image_embeddings, errors
+
+
+def request_deadline(timeout_s: Optional[float] = None) -> float:
+    """
+    Get the unix time a request must be answered by, from the
+    client timeout or the default one
+    """
+    return time.time() + (timeout_s if timeout_s is not None else request_timeout_s)
+
+
+def response_timings(options: models.EmbeddingOptions) -> Optional[List[dict]]:
+    """
+    Get the stages of the jobs run so far by a request,
+    only when asked with `include_timings`
+    """
+    return job_stages(request_jobs()) if options.include_timings else None
+
+
+def resolve_model(model: Optional[str]) -> str:
+    """
+    Get the CLIP model a request runs on, the default one if not set
+
+    Raises:
+    - HTTPException: If the model is not served
+    """
+    if model is None:
+        return clip_model_names[0]
+    if model not in clip_model_names:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Model {model} is not served. Available models are: {clip_model_names}")
+    return model
+
+
+async def embedding_transform(request: models.EmbeddingOptions, model_name: str) -> EmbeddingTransform:
+    """
+    Get the transforms applied to the returned embeddings
+
+    Raises:
+    - HTTPException: If the projection does not exist for the model
+    """
+    projection = None
+    if request.projection is not None:
+        projection = await projection_store.get(model_name, request.projection)
+        if projection is None:
+            raise HTTPException(
+                status_code=404, 
+                detail=f"Projection {request.projection} not found for model {model_name}")
+    return EmbeddingTransform(
+        normalize=request.normalize, 
+        dimensions=request.dimensions, 
+        projection=projection)
+
+
+async def embed_index_items(
+        items: List[Union[models.IndexItem, models.IndexSearchRequest]],
+        model_name: str,
+        deadline: float,
+        priority: str
+    ) -> Tuple[List[Optional[np.ndarray]], List[Optional[str]]]:
+    """
+    Get the embeddings of the items added to or searched in a vector
+    index, each with exactly one of `text`, `image_b64` or `embedding`
+
+    Args:
+    - items (List[IndexItem | IndexSearchRequest]): The items
+    - model_name (str): The CLIP model to use
+    - deadline (float): The unix time the worker must answer by
+    - priority (str): The priority class of the jobs
+
+    Returns:
+    - List[Optional[np.ndarray]]: The float32 embeddings, None for the failed items
+    - List[Optional[str]]: The error of every item, None if embedded
+    """
+    embeddings: List[Optional[np.ndarray]] = [None] * len(items)
+    errors: List[Optional[str]] = [None] * len(items)
+
+    texts, images = [], []
+    for idx, item in enumerate(items):
+        fields = [field for field in (item.text, item.image_b64, item.embedding) if field is not None]
+        if len(fields) != 1:
+            errors[idx] = "Exactly one of text, image_b64 or embedding must be set"
+        elif item.embedding is not None:
+            embeddings[idx] = np.asarray(item.embedding, dtype=np.float32)
+        elif item.text is not None:
+            texts.append(idx)
+        else:
+            images.append((idx, None, item.image_b64))
+
+    if texts:
+        text_embeddings = await embed_texts([items[idx].text for idx in texts], model_name, deadline, priority)
+        for idx, item in zip(texts, text_embeddings):
+            embeddings[idx] = redis_models.unpack_embedding(item.embedding)
+
+    if images:
+        images_data = await asyncio.to_thread(decode_image_items, images)
+        valid = [(idx, data) for (idx, _, _), data in zip(images, images_data) if data is not None]
+        for (idx, _, _), data in zip(images, images_data):
+            if data is None:
+                errors[idx] = "Invalid base64 image"
+        if valid:
+            image_embeddings, image_errors = await embed_images(
+                [data for _, data in valid], model_name, deadline, priority)
+            for error in image_errors:
+                errors[valid[error.image_index][0]] = error.error
+            for (idx, _), item in zip(valid, image_embeddings):
+                if item is not None:
+                    embeddings[idx] = redis_models.unpack_embedding(item.embedding)
+
+    return embeddings, errors
+
+
+def label_set_key(model_name: str, name: str) -> str:
+    """
+    Redis key of a label set, label sets are scoped by model
+    """
+    return f"label-set:{model_name}:{name}"
 
 
 redis_helper: Union[RedisManager, None] = None
+text_cache: Union[EmbeddingCache, None] = None
+image_cache: Union[EmbeddingCache, None] = None
+projection_store: Union[ProjectionStore, None] = None
+zero_shot_store: Union[ZeroShotStore, None] = None
+index_store: Union[IndexStore, None] = None
+# decoding and resizing images is CPU bound, it runs in its own threads
+downscale_executor: Union[ThreadPoolExecutor, None] = None
+downscale_quality = get_image_downscale_quality()
+# the first model is the default one
+clip_model_names = get_clip_model_names()
+request_timeout_s = get_request_timeout_s()
+stream_chunk_size = get_stream_chunk_size()
+stream_max_in_flight = get_stream_max_in_flight()
+tenant_limiter = TenantLimiter(get_tenants(), get_api_keys())
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global redis_helper
-    redis_helper = RedisManager("redis", 6379)
+    global redis_helper, text_cache, image_cache, projection_store, zero_shot_store, index_store, downscale_executor
+    redis_helper = RedisManager(
+        get_redis_host(),
+        get_redis_port(),
+        model_names=clip_model_names,
+        image_transport=get_image_transport(), 
+        image_ttl_s=get_image_ttl_s(),
+        max_queue_depth=get_max_queue_depth())
     await redis_helper.ping()
+    await redis_helper.start()
+    tenant_limiter.start(redis_helper.redis_client)
+
+    # The embedding cache has its own Redis, evicting under memory
+    # pressure, while the one of the jobs never evicts
+    cache_client = redis.Redis.from_url(
+        url=f"redis://{get_cache_redis_host()}:{get_cache_redis_port()}")
+    text_cache = EmbeddingCache(
+        cache_client,
+        namespace="text",
+        max_entries=get_text_cache_size(),
+        ttl_s=get_text_cache_ttl_s())
+    image_cache = EmbeddingCache(
+        cache_client,
+        namespace="image",
+        max_entries=get_image_cache_size(),
+        ttl_s=get_image_cache_ttl_s())
+    projection_store = ProjectionStore(redis_helper.redis_client)
+    zero_shot_store = ZeroShotStore(redis_helper.redis_client)
+    index_store = IndexStore(
+        get_index_dir(),
+        ivf_min_vectors=get_index_ivf_min_vectors(),
+        nprobe=get_index_nprobe())
+
+    if should_downscale_images():
+        downscale_executor = ThreadPoolExecutor(
+            max_workers=get_image_downscale_workers(), thread_name_prefix="downscale")
 
     yield
 
     await redis_helper.close()
+    await cache_client.aclose()
+    if downscale_executor is not None:
+        downscale_executor.shutdown(wait=False)
 
 description = """
 API for serving CLIP embeddings. Includes 3 endpoints:
 - **embed-text:** Embeds one or more text
 - **embed-images:** Embeds one or more images
 - **zero-shot-classification:** Classifies images based on provided text labels
+  or on a label set registered with **label-sets**
+- **index:** Stores embeddings in named vector indexes and searches them by text or image
 """
 
 app = FastAPI(
@@ -59,85 +406,479 @@ app = FastAPI(
     docs_url="/docs" if should_show_api_docs() else None,
     redoc_url=None,
 )
+# the last middleware added is the outermost, the metrics wrap the
+# tenant limits so that the requests they reject are counted too
+app.add_middleware(TimingMiddleware, slow_request_ms=get_slow_request_ms())
+app.add_middleware(TenantMiddleware, limiter=tenant_limiter)
+app.add_middleware(MetricsMiddleware)
+
+
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request: Request, exc: AdmissionRejected):
+    """
+    The inference workers are overloaded, the client should retry later
+    """
+    return JSONResponse(
+        status_code=exc.status_code, 
+        content={"detail": exc.detail}, 
+        headers={"Retry-After": str(exc.retry_after_s)})
+
+@app.exception_handler(JobFailed)
+async def job_failed_handler(request: Request, exc: JobFailed):
+    """
+    The inference worker could not run a job of the request
+    """
+    return JSONResponse(status_code=500, content={"detail": exc.detail})
+
+@app.exception_handler(TimeoutError)
+async def timeout_handler(request: Request, exc: TimeoutError):
+    """
+    The inference worker did not answer before the request deadline
+    """
+    return JSONResponse(
+        status_code=504, 
+        content={"detail": "The request deadline expired before the inference completed"})
 
 
 
 @app.post("/embed-text", response_model=models.TextEmbeddingResponse)
-async def embed_text(request: models.TextRequest):
+async def embed_text(request: models.TextRequest, priority: str = Depends(request_priority)):
     """
     Embed text using the CLIP model
     """
+    model_name = resolve_model(request.model)
+    transform = await embedding_transform(request, model_name)
     text = request.text
+    if isinstance(text, str):
+        text = [text]
+
+    # only the texts missing from the cache are sent to the model
+    text_embeddings = await embed_texts(text, model_name, request_deadline(request.timeout_s), priority)
+
+    result = redis_models.RedisResponseItem(
+        model_name=model_name, 
+        text_embeddings=text_embeddings)
+    return encode_response(result, request.encoding, request.dtype, transform, response_timings(request))
+
+async def embed_images_response(options: models.EmbeddingOptions, images_data: List[bytes], priority: str):
+    """
+    Embed images given as raw bytes and encode the response, shared
+    by the JSON and the upload variants of `/embed-images`
+    """
+    model_name = resolve_model(options.model)
+    transform = await embedding_transform(options, model_name)
 
-    job_id = str(uuid.uuid4())
+    # only the images missing from the cache are sent to the model
+    image_embeddings, errors = await embed_images(
+        images_data, model_name, request_deadline(options.timeout_s), priority)
 
-    # enqueue the text to be embedded
-    await redis_helper.enqueue_job(job_id, texts=text)
+    result = redis_models.RedisResponseItem(
+        model_name=model_name,
+        image_embeddings=[item for item in image_embeddings if item is not None],
+        errors=errors)
+    return encode_response(result, options.encoding, options.dtype, transform, response_timings(options))
+
+
+async def classify_images_response(
+        options: models.EmbeddingOptions,
+        labels: List[str],
+        label_set_name: Optional[str],
+        top_k: Optional[int],
+        images_data: List[bytes],
+        priority: str):
+    """
+    Zero-shot classify images given as raw bytes and encode the response,
+    shared by the JSON and the upload variants of `/zero-shot-classification`
+    """
+    if options.encoding == models.EmbeddingEncoding.BINARY:
+        raise HTTPException(
+            status_code=400,
+            detail="The binary encoding is not available for zero-shot classification, use msgpack instead")
+
+    if (label_set_name is None) == (not labels):
+        raise HTTPException(
+            status_code=400,
+            detail="Provide either labels or label_set")
+
+    model_name = resolve_model(options.model)
+    transform = await embedding_transform(options, model_name)
+    deadline = request_deadline(options.timeout_s)
+
+    label_set = None
+    if label_set_name is not None:
+        label_set_info = await redis_helper.get_label_set_info(label_set_key(model_name, label_set_name))
+        if label_set_info is None:
+            raise HTTPException(status_code=404, detail=f"Label set {label_set_name} not found")
+        label_set, _ = label_set_info
+
+    # the label and image features come from the caches, or are computed
+    # and cached, the softmax scores are computed here without another
+    # job. The features of registered label sets are already stored
+    labels_embedding, (images_embedding, errors) = await asyncio.gather(
+        embed_texts(labels, model_name, deadline, priority), 
+        embed_images(images_data, model_name, deadline, priority))
+    images_embedding = [item for item in images_embedding if item is not None]
+
+    if not images_embedding:
+        # nothing to classify
+        result = redis_models.RedisResponseItem(
+            model_name=model_name,
+            image_embeddings=[],
+            classification_result=redis_models.ClassificationResult(labels=labels),
+            errors=errors)
+        return encode_response(result, options.encoding, options.dtype, transform, response_timings(options))
+
+    if label_set is not None:
+        try:
+            labels, label_embeds = await zero_shot_store.label_set(label_set)
+        except KeyError:
+            raise HTTPException(status_code=409, detail=f"Label set {label_set_name} was changed, retry the request")
+    else:
+        label_embeds = normalize(np.stack([
+            redis_models.unpack_embedding(item.embedding) for item in labels_embedding]))
+
+    logit_scale = await zero_shot_store.logit_scale(model_name)
+    # large label sets take a few milliseconds, keep them off the event loop
+    result = await asyncio.to_thread(
+        classification_response,
+        model_name,
+        labels,
+        label_embeds,
+        images_embedding,
+        logit_scale,
+        top_k,
+        label_set is None)
+    if errors:
+        result.errors = errors
+
+    return encode_response(result, options.encoding, options.dtype, transform, response_timings(options))
 
-    # when the result comes back, return the response
-    result = await redis_helper.get_result(job_id)
-    return json.loads(result)
 
 @app.post("/embed-images", response_model=models.ImageEmbeddingResponse)
-async def embed_image(request: models.ImageRequest):
+async def embed_image(request: models.ImageRequest, priority: str = Depends(request_priority)):
     """
     Embed images using the CLIP model
     """
     img_base64 = request.image_b64
 
-    job_id = str(uuid.uuid4())
-    # get image format
     # sample header for base64 image data:image/png;base64,...
     if isinstance(img_base64, str):
         img_base64 = [img_base64]
     
-    images_format = [
-        img.split(",")[0].split("/")[1].split(";")[0] 
-        for img in img_base64]
-    
-    images_data = [img.split(",")[1] for img in img_base64]
-    
-    images_path = [
-        f"/img_store/{job_id}_{_id}.{format}" 
-        for _id, format in enumerate(images_format)]
-
-    await write_images(images_path, images_data)
+    # decoding large images is CPU bound, keep it off the event loop
+    images_data = await asyncio.to_thread(decode_images, img_base64)
+    return await embed_images_response(request, images_data, priority)
 
-    # enqueue the text to be embedded
-    await redis_helper.enqueue_job(job_id, images=images_path)
-
-    # when the result comes back, return the response
-    result = await redis_helper.get_result(job_id)
-    
-    return json.loads(result)
+@app.post("/embed-images/upload", response_model=models.ImageEmbeddingResponse)
+async def embed_image_upload(
+        request: Request,
+        options: models.EmbeddingOptions = Depends(),
+        priority: str = Depends(request_priority)):
+    """
+    Embed images uploaded as raw bytes, either as the `images` files
+    of a multipart/form-data body or as a single image in an
+    application/octet-stream body. The options are query parameters
+    """
+    images_data = await read_uploaded_images(request)
+    return await embed_images_response(options, images_data, priority)
 
 @app.post("/zero-shot-classification", response_model=models.ClassificationResponse)
-async def zero_shot_classification(request: models.ZeroShotClassificationRequest):
+async def zero_shot_classification(
+        request: models.ZeroShotClassificationRequest,
+        priority: str = Depends(request_priority)):
     """
     Zero-shot classification using the CLIP model
     """
-    labels = request.labels
-    img_base64 = request.images_b64
+    # sample header for base64 image data:image/png;base64,...
+    images_data = await asyncio.to_thread(decode_images, request.images_b64)
+    return await classify_images_response(
+        request, request.labels, request.label_set, request.top_k, images_data, priority)
+
+@app.post("/zero-shot-classification/upload", response_model=models.ClassificationResponse)
+async def zero_shot_classification_upload(
+        request: Request,
+        options: models.EmbeddingOptions = Depends(),
+        labels: List[str] = Query(default=[]),
+        label_set: Optional[str] = None,
+        top_k: Optional[int] = Query(default=None, ge=1),
+        priority: str = Depends(request_priority)):
+    """
+    Zero-shot classification of images uploaded as raw bytes, see
+    `/embed-images/upload`. The labels are repeated `labels` query
+    parameters or, with multipart/form-data, form fields
+    """
+    images_data = await read_uploaded_images(request)
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        # the form is parsed once, and cached by the request
+        form = await request.form()
+        labels = labels + [label for label in form.getlist("labels") if isinstance(label, str)]
+    return await classify_images_response(options, labels, label_set, top_k, images_data, priority)
+
+
+@app.post("/embed/stream")
+async def embed_stream(
+        request: Request,
+        options: models.EmbeddingOptions = Depends(),
+        priority: str = Depends(request_priority)):
+    """
+    Embed a stream of texts and images. The body is NDJSON, one object
+    per line with either `text` or `image_b64` and an optional `id`.
+    The response is NDJSON too, one line per input line with its `index`
+    (and `id`) and either the embedding or an `error`. Lines are sent as
+    soon as their chunk completes, not in input order. The options are
+    passed as query parameters, only the `float` and `base64` encodings
+    are available
+    """
+    if options.encoding not in (models.EmbeddingEncoding.FLOAT, models.EmbeddingEncoding.BASE64):
+        raise HTTPException(
+            status_code=400,
+            detail="Only the float and base64 encodings are available for streaming")
 
-    job_id = str(uuid.uuid4())
-    # get image format
-    # sample header for base64 image data:image/png;base64
-    images_format = [
-        img.split(",")[0].split("/")[1].split(";")[0] 
-        for img in img_base64]
+    model_name = resolve_model(options.model)
+    transform = await embedding_transform(options, model_name)
 
-    images_data = [img.split(",")[1] for img in img_base64]
+    def output_line(index: int, item_id, **fields) -> dict:
+        line = {"index": index, **fields}
+        if item_id is not None:
+            line["id"] = item_id
+        return line
 
-    images_path = [
-        f"/img_store/{job_id}_{_id}.{format}" 
-        for _id, format in enumerate(images_format)]
+    async def embed_chunk(kind: str, items: List[StreamItem]) -> List[dict]:
+        # every chunk has its own deadline, the stream can last longer
+        deadline = request_deadline(options.timeout_s)
 
-    await write_images(images_path, images_data)
+        if kind == "text":
+            text_embeddings = await embed_texts([text for _, _, text in items], model_name, deadline, priority)
+            return [
+                output_line(index, item_id, **encode_embedding(
+                    item.embedding, options.encoding, options.dtype, transform))
+                for (index, item_id, _), item in zip(items, text_embeddings)]
 
-    # enqueue the text to be embedded
-    await redis_helper.enqueue_job(job_id, texts=labels, images=images_path)
+        images_data = await asyncio.to_thread(decode_image_items, items)
+        valid = [idx for idx, data in enumerate(images_data) if data is not None]
+        image_embeddings, errors = [], []
+        if valid:
+            image_embeddings, errors = await embed_images(
+                [images_data[idx] for idx in valid], model_name, deadline, priority)
 
-    # when the result comes back, return the response
-    result = await redis_helper.get_result(job_id)
-    
-    return json.loads(result)
+        lines = [
+            output_line(index, item_id, error="Invalid base64 image")
+            for (index, item_id, _), data in zip(items, images_data) if data is None]
+        errors_by_idx = {valid[error.image_index]: error.error for error in errors}
+        for idx, item in zip(valid, image_embeddings):
+            index, item_id, _ = items[idx]
+            if item is None:
+                lines.append(output_line(index, item_id, error=errors_by_idx.get(idx)))
+            else:
+                lines.append(output_line(index, item_id, image_id=item.image_id, **encode_embedding(
+                    item.embedding, options.encoding, options.dtype, transform)))
+        return lines
+
+    # the body is read while the response is sent, see DuplexStreamingResponse
+    return DuplexStreamingResponse(
+        request,
+        lambda body: stream_embeddings(body, embed_chunk, stream_chunk_size, stream_max_in_flight))
+
+
+@app.post("/label-sets", response_model=models.LabelSetResponse)
+async def register_label_set(request: models.LabelSetRequest, priority: str = Depends(request_priority)):
+    """
+    Register a named label set, its normalized text embeddings are
+    computed once and reused by `/zero-shot-classification` requests
+    with `label_set`. Registering an existing name replaces it
+    """
+    model_name = resolve_model(request.model)
+    labels_embedding = await embed_texts(request.labels, model_name, request_deadline(), priority)
+
+    embeddings = np.stack([
+        redis_models.unpack_embedding(item.embedding) for item in labels_embedding])
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    version = await redis_helper.save_label_set(
+        label_set_key(model_name, request.name), 
+        request.labels, 
+        embeddings.astype("<f4").tobytes())
+
+    return models.LabelSetResponse(
+        name=request.name, 
+        model_name=model_name, 
+        labels_count=len(request.labels), 
+        version=version)
+
+@app.get("/label-sets/{name}", response_model=models.LabelSetResponse)
+async def get_label_set(name: str, model: Optional[str] = None):
+    """
+    Get the information about a registered label set
+    """
+    model_name = resolve_model(model)
+    label_set_info = await redis_helper.get_label_set_info(label_set_key(model_name, name))
+    if label_set_info is None:
+        raise HTTPException(status_code=404, detail=f"Label set {name} not found")
+
+    label_set, labels_count = label_set_info
+    return models.LabelSetResponse(
+        name=name, 
+        model_name=model_name, 
+        labels_count=labels_count, 
+        version=label_set.version)
+
+@app.delete("/label-sets/{name}")
+async def delete_label_set(name: str, model: Optional[str] = None):
+    """
+    Delete a registered label set
+    """
+    model_name = resolve_model(model)
+    if not await redis_helper.delete_label_set(label_set_key(model_name, name)):
+        raise HTTPException(status_code=404, detail=f"Label set {name} not found")
+    return {"name": name, "deleted": True}
+
+
+# Index names are directory names, they cannot start with a dot
+IndexName = Path(pattern=r"^[A-Za-z0-9_-][A-Za-z0-9_.-]{0,127}$")
+
+
+@app.post("/index/{name}/add", response_model=models.IndexAddResponse)
+async def index_add(
+        request: models.IndexAddRequest,
+        name: str = IndexName,
+        priority: str = Depends(request_priority)):
+    """
+    Embed texts and images, or take precomputed embeddings, and add
+    them to a vector index. The index is created by the first request
+    for the model of the request, later requests use the model of the index
+    """
+    index = await asyncio.to_thread(index_store.get, name)
+    if index is not None and request.model is not None and request.model != index.model_name:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Index {name} holds embeddings of {index.model_name}, not {request.model}")
+    model_name = index.model_name if index is not None else resolve_model(request.model)
+
+    embeddings, errors = await embed_index_items(
+        request.items, model_name, request_deadline(request.timeout_s), priority)
+
+    dimensions = index.dimensions if index is not None else next(
+        (embedding.shape[0] for embedding in embeddings if embedding is not None), None)
+    for idx, embedding in enumerate(embeddings):
+        if embedding is not None and embedding.shape[0] != dimensions:
+            embeddings[idx] = None
+            errors[idx] = f"The embedding has {embedding.shape[0]} dimensions, the index has {dimensions}"
+
+    added_rows = [idx for idx, embedding in enumerate(embeddings) if embedding is not None]
+    added = 0
+    if added_rows:
+        if index is None:
+            try:
+                index = await asyncio.to_thread(
+                    index_store.get_or_create, name, model_name, dimensions, request.dtype.value)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        # adding can train the approximate index, keep it off the event loop
+        added = await asyncio.to_thread(
+            index.add,
+            [request.items[idx].id for idx in added_rows],
+            np.stack([embeddings[idx] for idx in added_rows]),
+            index_store.ivf_min_vectors)
+    elif index is None:
+        raise HTTPException(status_code=400, detail="None of the items could be embedded")
+
+    return models.IndexAddResponse(
+        name=name,
+        **index.info(),
+        added=added,
+        errors=[
+            models.IndexItemError(index=idx, id=request.items[idx].id, error=error)
+            for idx, error in enumerate(errors) if error is not None])
+
+@app.post("/index/{name}/search", response_model=models.IndexSearchResponse)
+async def index_search(
+        request: models.IndexSearchRequest,
+        name: str = IndexName,
+        priority: str = Depends(request_priority)):
+    """
+    Find the items of a vector index most similar to a text, an image
+    or an embedding, the query is embedded with the model of the index
+    """
+    index = await asyncio.to_thread(index_store.get, name)
+    if index is None:
+        raise HTTPException(status_code=404, detail=f"Index {name} not found")
+
+    embeddings, errors = await embed_index_items(
+        [request], index.model_name, request_deadline(request.timeout_s), priority)
+    if errors[0] is not None:
+        raise HTTPException(status_code=400, detail=errors[0])
+    if embeddings[0].shape[0] != index.dimensions:
+        raise HTTPException(
+            status_code=400,
+            detail=f"The embedding has {embeddings[0].shape[0]} dimensions, the index has {index.dimensions}")
+
+    results, method = await asyncio.to_thread(
+        index.search,
+        embeddings[0],
+        request.top_k,
+        request.nprobe or index_store.nprobe,
+        request.exact)
+    return models.IndexSearchResponse(
+        name=name,
+        model_name=index.model_name,
+        method=method,
+        results=[models.IndexSearchResult(id=item_id, score=score) for item_id, score in results])
+
+@app.post("/index/{name}/train", response_model=models.IndexInfoResponse)
+async def index_train(name: str = IndexName):
+    """
+    Train the approximate index again on the current embeddings,
+    e.g. after the index grew a lot since it was first trained
+    """
+    index = await asyncio.to_thread(index_store.get, name)
+    if index is None:
+        raise HTTPException(status_code=404, detail=f"Index {name} not found")
+    if index.count == 0:
+        raise HTTPException(status_code=400, detail=f"Index {name} is empty")
+    await asyncio.to_thread(index.train)
+    return models.IndexInfoResponse(name=name, **index.info())
+
+@app.get("/index/{name}", response_model=models.IndexInfoResponse)
+async def get_index(name: str = IndexName):
+    """
+    Get the information about a vector index
+    """
+    index = await asyncio.to_thread(index_store.get, name)
+    if index is None:
+        raise HTTPException(status_code=404, detail=f"Index {name} not found")
+    return models.IndexInfoResponse(name=name, **index.info())
+
+@app.delete("/index/{name}")
+async def delete_index(name: str = IndexName):
+    """
+    Delete a vector index and its files
+    """
+    if not await asyncio.to_thread(index_store.delete, name):
+        raise HTTPException(status_code=404, detail=f"Index {name} not found")
+    return {"name": name, "deleted": True}
+
+
+@app.get("/models", response_model=models.ModelsResponse)
+async def list_models():
+    """
+    The CLIP models that can be selected with the `model` field
+    """
+    return models.ModelsResponse(default_model=clip_model_names[0], models=clip_model_names)
+
+
+@app.get("/cache/stats", response_model=models.CacheStatsResponse)
+async def cache_stats():
+    """
+    Hit and miss counters of the embedding caches of this API process
+    """
+    return models.CacheStatsResponse(text=text_cache.stats(), image=image_cache.stats())
+
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    """
+    Metrics of this API process in the Prometheus text format
+    """
+    # the queue depth is otherwise only read when jobs are enqueued
+    await redis_helper.admission.refresh()
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,94 @@
+"""
+Recall and latency benchmark of the vector indexes. Builds an index in
+a temporary directory from the embeddings of a `.npy` file (e.g. the
+output of `batch_embed.py`) or from synthetic clustered embeddings,
+then compares the IVF-PQ search at several `nprobe` with the exact
+search: recall@k of the approximate results and latency per query.
+
+Run it inside the api container, e.g.:
+
+    python3 src/benchmark_index.py --vectors 200000 --dimensions 512
+    python3 src/benchmark_index.py --embeddings /data/embeddings/embeddings.npy
+"""
+import argparse
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+
+from vector_index import VectorIndex, normalize
+
+
+def synthetic_embeddings(n: int, dimensions: int, seed: int = 0) -> np.ndarray:
+    """
+    Embeddings grouped in topics of different sizes, each made of
+    smaller groups of near duplicates, closer to real data than
+    uniformly random vectors
+    """
+    rng = np.random.default_rng(seed)
+    topics = rng.normal(size=(max(1, n // 1000), dimensions)).astype(np.float32)
+    weights = rng.pareto(1.5, topics.shape[0]) + 1
+    groups = topics[rng.choice(topics.shape[0], max(1, n // 20), p=weights / weights.sum())]
+    groups += 0.7 * rng.normal(size=groups.shape).astype(np.float32)
+    assignments = rng.integers(0, groups.shape[0], n)
+    return normalize(groups[assignments] + 0.4 * rng.normal(size=(n, dimensions)).astype(np.float32))
+
+
+def percentiles(latencies: List[float]) -> str:
+    p50, p95 = np.percentile(np.array(latencies) * 1000, [50, 95])
+    return f"{p50:>9.2f}{p95:>9.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the recall and latency of the vector indexes")
+    parser.add_argument("--embeddings", help=".npy file with the embeddings, synthetic if not set")
+    parser.add_argument("--vectors", type=int, default=200000, help="Number of synthetic embeddings")
+    parser.add_argument("--dimensions", type=int, default=512, help="Dimensions of the synthetic embeddings")
+    parser.add_argument("--queries", type=int, default=200, help="Held out embeddings used as queries")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64])
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+    args = parser.parse_args()
+
+    if args.embeddings:
+        embeddings = normalize(np.load(args.embeddings, mmap_mode="r"))
+        # zero rows are the items batch_embed.py could not embed
+        embeddings = embeddings[np.abs(embeddings).sum(axis=1) > 0]
+    else:
+        embeddings = synthetic_embeddings(args.vectors + args.queries, args.dimensions)
+    queries, embeddings = embeddings[:args.queries], embeddings[args.queries:]
+
+    with tempfile.TemporaryDirectory() as index_dir:
+        index = VectorIndex.create(f"{index_dir}/benchmark", "benchmark", embeddings.shape[1], args.dtype)
+        start = time.perf_counter()
+        for offset in range(0, embeddings.shape[0], 10000):
+            batch = embeddings[offset:offset + 10000]
+            index.add([str(row) for row in range(offset, offset + batch.shape[0])], batch)
+        print(f"Added {index.count} embeddings in {time.perf_counter() - start:.1f} s")
+
+        start = time.perf_counter()
+        index.train()
+        print(f"Trained the IVF-PQ index in {time.perf_counter() - start:.1f} s")
+
+        exact_results, exact_latencies = [], []
+        for query in queries:
+            start = time.perf_counter()
+            results, _ = index.search(query, args.top_k, nprobe=1, exact=True)
+            exact_latencies.append(time.perf_counter() - start)
+            exact_results.append({item_id for item_id, _ in results})
+
+        print(f"{'method':<14}{f'recall@{args.top_k}':>10}{'p50 ms':>9}{'p95 ms':>9}")
+        print(f"{'exact':<14}{1:>10.3f}{percentiles(exact_latencies)}")
+        for nprobe in args.nprobe:
+            recalls, latencies = [], []
+            for query, expected in zip(queries, exact_results):
+                start = time.perf_counter()
+                results, _ = index.search(query, args.top_k, nprobe=nprobe)
+                latencies.append(time.perf_counter() - start)
+                recalls.append(len(expected & {item_id for item_id, _ in results}) / len(expected))
+            print(f"{f'ivfpq/{nprobe}':<14}{np.mean(recalls):>10.3f}{percentiles(latencies)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+Two tier cache for the embeddings computed by the inference worker.
+A bounded in-process LRU sits in front of a Redis tier shared by
+all the API processes, entries are scoped by model name.
+"""
+import hashlib
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import redis.asyncio as redis
+
+
+def text_digest(text: str) -> str:
+    """
+    Hash a text after applying the same normalization of the CLIP
+    tokenizer (NFC, whitespace collapsing and lowercasing), so texts
+    that produce the same tokens share the same cache entry
+
+    Args:
+    - text (str): The text to hash
+
+    Returns:
+    - str: The hex digest of the normalized text
+    """
+    normalized = " ".join(unicodedata.normalize("NFC", text).split()).lower()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def image_digest(image_bytes: bytes) -> str:
+    """
+    Hash the raw bytes of an image, the digest is also
+    the `image_id` returned to the clients
+
+    Args:
+    - image_bytes (bytes): The raw bytes of the image
+
+    Returns:
+    - str: The hex digest of the image
+    """
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class LRUCache():
+    """
+    Bounded in-process least recently used cache
+    """
+    def __init__(self, max_entries: int):
+        """
+        Constructor for the LRUCache class
+
+        Args:
+        - max_entries (int): The maximum number of entries, 0 disables the cache
+        """
+        self.max_entries = max_entries
+        self.entries: OrderedDict = OrderedDict()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Get an entry and mark it as the most recently used
+        """
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str):
+        """
+        Add an entry, evicting the least recently used ones if full
+        """
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class EmbeddingCache():
+    """
+    Cache of packed embeddings (see `redis_models.pack_embeddings`)
+    keyed by model name and content digest. Lookups hit the local LRU
+    first, then the Redis tier. Redis entries expire after `ttl_s`
+    seconds and are evicted by Redis under memory pressure, the Redis
+    tier is its own instance (maxmemory-policy allkeys-lru). When it
+    is unreachable the lookups miss and the embeddings are recomputed
+    """
+    def __init__(
+            self,
+            redis_client: redis.Redis,
+            namespace: str,
+            max_entries: int,
+            ttl_s: int):
+        """
+        Constructor for the EmbeddingCache class
+
+        Args:
+        - redis_client (redis.Redis): The client of the cache Redis
+        - namespace (str): The kind of cached embeddings, e.g. `text`
+        - max_entries (int): The size of the local LRU, 0 disables it
+        - ttl_s (int): The expiration of the Redis entries, 0 disables the Redis tier
+        """
+        self.redis_client = redis_client
+        self.namespace = namespace
+        self.local = LRUCache(max_entries)
+        self.ttl_s = ttl_s
+
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+
+    def _key(self, model_name: str, digest: str) -> str:
+        return f"cache:{self.namespace}:{model_name}:{digest}"
+
+    async def get_many(self, model_name: str, digests: List[str]) -> List[Optional[str]]:
+        """
+        Look up the embeddings of the given digests
+
+        Args:
+        - model_name (str): The model that computed the embeddings
+        - digests (List[str]): The content digests
+
+        Returns:
+        - List[Optional[str]]: The packed embeddings, None for the misses
+        """
+        keys = [self._key(model_name, digest) for digest in digests]
+        values = [self.local.get(key) for key in keys]
+
+        missing = [idx for idx, value in enumerate(values) if value is None]
+        self.local_hits += len(keys) - len(missing)
+
+        if missing and self.ttl_s > 0:
+            try:
+                redis_values = await self.redis_client.mget([keys[idx] for idx in missing])
+            except redis.RedisError as e:
+                print(f"Error while reading the {self.namespace} cache: {e}")
+                redis_values = [None] * len(missing)
+            for idx, value in zip(missing, redis_values):
+                if value is None:
+                    continue
+                value = value.decode("ascii") if isinstance(value, bytes) else value
+                values[idx] = value
+                self.local.set(keys[idx], value)
+                self.redis_hits += 1
+
+        self.misses += sum(1 for value in values if value is None)
+        return values
+
+    async def set_many(self, model_name: str, embeddings: Dict[str, str]):
+        """
+        Store embeddings in both tiers
+
+        Args:
+        - model_name (str): The model that computed the embeddings
+        - embeddings (Dict[str, str]): The packed embeddings by digest
+        """
+        if not embeddings:
+            return
+
+        for digest, embedding in embeddings.items():
+            self.local.set(self._key(model_name, digest), embedding)
+
+        if self.ttl_s > 0:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            for digest, embedding in embeddings.items():
+                pipeline.set(self._key(model_name, digest), embedding, ex=self.ttl_s)
+            try:
+                await pipeline.execute()
+            except redis.RedisError as e:
+                print(f"Error while writing the {self.namespace} cache: {e}")
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the hit and miss counters of the cache
+
+        Returns:
+        - Dict[str, int]: The counters and the size of the local tier
+        """
+        return {
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "local_entries": len(self.local),
+        }
@@ -0,0 +1,147 @@
+"""
+Post-processing of the embeddings returned to the clients: PCA
+projection, dimension truncation, L2 normalization and quantization.
+Embeddings are cached at full precision, the transforms are applied
+on the way out so that every client gets its own output format.
+"""
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import redis.asyncio as redis
+
+from models import EmbeddingDtype
+
+
+@dataclass
+class Projection:
+    """
+    A PCA projection fitted offline on normalized embeddings,
+    `components` is the (dim, dimensions) matrix of the principal
+    components sorted by explained variance
+    """
+    mean: np.ndarray
+    components: np.ndarray
+    version: str
+
+
+def projection_key(model_name: str, name: str) -> str:
+    """
+    Redis key of a projection, projections are scoped by model
+    """
+    return f"projection:{model_name}:{name}"
+
+
+class ProjectionStore():
+    """
+    Loads the projections stored in Redis by `fit_projection.py`, as a
+    hash with the float32 `mean` and `components` and their `version`.
+    The matrices are kept in memory, only the version is read again
+    by every request to pick up projections fitted again
+    """
+    def __init__(self, redis_client: redis.Redis):
+        """
+        Constructor for the ProjectionStore class
+
+        Args:
+        - redis_client (redis.Redis): The Redis client
+        """
+        self.redis_client = redis_client
+        self.projections: Dict[str, Projection] = {}
+
+    async def get(self, model_name: str, name: str) -> Optional[Projection]:
+        """
+        Get a projection
+
+        Args:
+        - model_name (str): The model the projection was fitted for
+        - name (str): The name of the projection
+
+        Returns:
+        - Optional[Projection]: The projection, None if it does not exist
+        """
+        key = projection_key(model_name, name)
+        version = await self.redis_client.hget(key, "version")
+        if version is None:
+            self.projections.pop(key, None)
+            return None
+        version = version.decode() if isinstance(version, bytes) else version
+
+        projection = self.projections.get(key)
+        if projection is not None and projection.version == version:
+            return projection
+
+        mean, components, dimensions, version = await self.redis_client.hmget(
+            key, ["mean", "components", "dimensions", "version"])
+        if version is None:
+            return None
+        mean = np.frombuffer(mean, dtype="<f4")
+        projection = Projection(
+            mean=mean,
+            components=np.frombuffer(components, dtype="<f4").reshape(mean.shape[0], int(dimensions)),
+            version=version.decode() if isinstance(version, bytes) else version)
+        self.projections[key] = projection
+        return projection
+
+
+@dataclass
+class EmbeddingTransform:
+    """
+    The transforms applied to every returned embedding, in order:
+    projection (on the normalized embedding), truncation to the first
+    `dimensions` values and L2 normalization
+    """
+    normalize: bool = False
+    dimensions: Optional[int] = None
+    projection: Optional[Projection] = None
+
+    def is_identity(self) -> bool:
+        return not self.normalize and self.dimensions is None and self.projection is None
+
+    def apply(self, embedding: np.ndarray) -> np.ndarray:
+        """
+        Transform a float32 embedding
+
+        Args:
+        - embedding (np.ndarray): The embedding from the inference worker
+
+        Returns:
+        - np.ndarray: The transformed float32 embedding
+        """
+        if self.projection is not None:
+            embedding = embedding / np.linalg.norm(embedding)
+            embedding = (embedding - self.projection.mean) @ self.projection.components
+        if self.dimensions is not None:
+            embedding = embedding[:self.dimensions]
+        if self.normalize:
+            norm = np.linalg.norm(embedding)
+            if norm > 0:
+                embedding = embedding / norm
+        return embedding.astype("<f4")
+
+
+def quantize(embedding: np.ndarray, dtype: EmbeddingDtype) -> Tuple[np.ndarray, Optional[float]]:
+    """
+    Convert a float32 embedding to `dtype`
+    - float16: little-endian half precision
+    - int8: symmetric quantization, `embedding ~= values * scale`
+    - binary: the sign bits packed in bytes, most significant bit first,
+      a bit is set when the value is positive
+
+    Args:
+    - embedding (np.ndarray): The float32 embedding
+    - dtype (EmbeddingDtype): The data type of the output
+
+    Returns:
+    - np.ndarray: The quantized embedding
+    - Optional[float]: The scale of int8 embeddings, None otherwise
+    """
+    if dtype == EmbeddingDtype.FLOAT16:
+        return embedding.astype("<f2"), None
+    if dtype == EmbeddingDtype.INT8:
+        max_abs = float(np.abs(embedding).max()) if embedding.size else 0.0
+        scale = max_abs / 127 if max_abs > 0 else 1.0
+        return np.clip(np.round(embedding / scale), -127, 127).astype(np.int8), scale
+    if dtype == EmbeddingDtype.BINARY:
+        return np.packbits(embedding > 0), None
+    return embedding, None
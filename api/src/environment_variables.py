@@ -1,8 +1,121 @@
 import os
 from enum import Enum
+from typing import Dict, List
+
+import redis_models
+from tenants import TenantConfig
 
 class EnvironmentKeys(Enum):
     SHOW_API_DOCS = "SHOW_API_DOCS"
+    CLIP_MODEL_NAME = "CLIP_MODEL_NAME"
+    CLIP_MODEL_NAMES = "CLIP_MODEL_NAMES"
+    IMAGE_TRANSPORT = "IMAGE_TRANSPORT"
+    IMAGE_TTL_S = "IMAGE_TTL_S"
+    IMAGE_DOWNSCALE = "IMAGE_DOWNSCALE"
+    IMAGE_DOWNSCALE_QUALITY = "IMAGE_DOWNSCALE_QUALITY"
+    IMAGE_DOWNSCALE_WORKERS = "IMAGE_DOWNSCALE_WORKERS"
+    TEXT_CACHE_SIZE = "TEXT_CACHE_SIZE"
+    TEXT_CACHE_TTL_S = "TEXT_CACHE_TTL_S"
+    IMAGE_CACHE_SIZE = "IMAGE_CACHE_SIZE"
+    IMAGE_CACHE_TTL_S = "IMAGE_CACHE_TTL_S"
+    REQUEST_TIMEOUT_S = "REQUEST_TIMEOUT_S"
+    MAX_QUEUE_DEPTH = "MAX_QUEUE_DEPTH"
+    STREAM_CHUNK_SIZE = "STREAM_CHUNK_SIZE"
+    STREAM_MAX_IN_FLIGHT = "STREAM_MAX_IN_FLIGHT"
+    INDEX_DIR = "INDEX_DIR"
+    INDEX_IVF_MIN_VECTORS = "INDEX_IVF_MIN_VECTORS"
+    INDEX_NPROBE = "INDEX_NPROBE"
+    TENANTS = "TENANTS"
+    API_KEYS = "API_KEYS"
+    SLOW_REQUEST_MS = "SLOW_REQUEST_MS"
+    REDIS_HOST = "REDIS_HOST"
+    REDIS_PORT = "REDIS_PORT"
+    CACHE_REDIS_HOST = "CACHE_REDIS_HOST"
+    CACHE_REDIS_PORT = "CACHE_REDIS_PORT"
+
+
+class ImageTransport(Enum):
+    """
+    How image bytes are handed to the inference worker
+    - REDIS: as binary values stored in Redis
+    - VOLUME: as files written to the shared /img_store volume
+    """
+    REDIS = "redis"
+    VOLUME = "volume"
+
+valid_clip_model_names = [
+    "openai/clip-vit-base-patch32",
+    "openai/clip-vit-large-patch14",
+    "openai/clip-vit-base-patch16",
+    "openai/clip-vit-large-patch14-336",
+]
+
+default_image_ttl_s = 300
+default_image_downscale_quality = 95
+default_image_downscale_workers = 4
+default_text_cache_size = 10000
+default_text_cache_ttl_s = 86400
+default_image_cache_size = 2000
+default_image_cache_ttl_s = 86400
+default_request_timeout_s = 30
+default_max_queue_depth = 1000
+default_stream_chunk_size = 64
+default_stream_max_in_flight = 4
+default_index_dir = "/index_data"
+default_index_ivf_min_vectors = 100000
+default_index_nprobe = 16
+default_slow_request_ms = 1000
+default_redis_host = "redis"
+default_redis_port = 6379
+default_cache_redis_host = "redis-cache"
+
+
+def _get_int(key: EnvironmentKeys, default: int, minimum: int) -> int:
+    """
+    Read an integer not lower than `minimum` from the environment
+    variables, falling back to `default` when missing or invalid
+    """
+    value = os.environ.get(key.value, str(default))
+    try:
+        int_value = int(value)
+    except ValueError:
+        int_value = minimum - 1
+
+    if int_value < minimum:
+        print(f"Invalid value for {key.value}: {value}. Expected an integer >= {minimum}")
+        print(f"Using default value: {default}")
+        int_value = default
+
+    return int_value
+
+
+def get_redis_host() -> str:
+    """
+    Get the host of the Redis server
+    """
+    return os.environ.get(EnvironmentKeys.REDIS_HOST.value, default_redis_host)
+
+
+def get_redis_port() -> int:
+    """
+    Get the port of the Redis server
+    """
+    return _get_int(EnvironmentKeys.REDIS_PORT, default_redis_port, minimum=1)
+
+
+def get_cache_redis_host() -> str:
+    """
+    Get the host of the Redis server of the embedding cache, kept apart
+    from the jobs so that its evictions never drop a job in flight
+    """
+    return os.environ.get(EnvironmentKeys.CACHE_REDIS_HOST.value, default_cache_redis_host)
+
+
+def get_cache_redis_port() -> int:
+    """
+    Get the port of the Redis server of the embedding cache
+    """
+    return _get_int(EnvironmentKeys.CACHE_REDIS_PORT, default_redis_port, minimum=1)
 
 
 def should_show_api_docs() -> bool:
@@ -11,4 +124,225 @@ def should_show_api_docs() -> bool:
     """
     show_docs = os.environ.get(EnvironmentKeys.SHOW_API_DOCS.value, "True")
     bool_show_docs = True if show_docs in ["True", "true", "1"] else False
-    return bool_show_docs
\ No newline at end of file
+    return bool_show_docs
+
+
+def get_clip_model_name() -> str:
+    """
+    Get the CLIP model name from the environment variables,
+    used to scope the cached embeddings
+    """
+    clip_model_name = os.environ.get(EnvironmentKeys.CLIP_MODEL_NAME.value, valid_clip_model_names[0])
+    if clip_model_name not in valid_clip_model_names:
+        clip_model_name = valid_clip_model_names[0]
+
+    return clip_model_name
+
+
+def get_clip_model_names() -> List[str]:
+    """
+    Get the names of the CLIP models served, a comma separated list.
+    Defaults to the `CLIP_MODEL_NAME` model only, which is always served
+    and used by the requests that do not ask for a specific model
+    """
+    default_model_name = get_clip_model_name()
+    value = os.environ.get(EnvironmentKeys.CLIP_MODEL_NAMES.value, "")
+
+    model_names = [default_model_name]
+    for model_name in (name.strip() for name in value.split(",")):
+        if not model_name or model_name in model_names:
+            continue
+        if model_name not in valid_clip_model_names:
+            print(f"Invalid CLIP model name in {EnvironmentKeys.CLIP_MODEL_NAMES.value}: {model_name}. Valid values are: {valid_clip_model_names}")
+            continue
+        model_names.append(model_name)
+
+    return model_names
+
+
+def get_image_transport() -> ImageTransport:
+    """
+    Get the transport used to send the images to the inference worker
+    """
+    transport = os.environ.get(EnvironmentKeys.IMAGE_TRANSPORT.value, ImageTransport.REDIS.value)
+    try:
+        return ImageTransport(transport.lower())
+    except ValueError:
+        print(f"Invalid image transport. Valid values are: {[t.value for t in ImageTransport]}")
+        print(f"Using default value: {ImageTransport.REDIS.value}")
+        return ImageTransport.REDIS
+
+
+def get_image_ttl_s() -> int:
+    """
+    Get the time to live, in seconds, of the images stored in Redis.
+    Images that are not consumed by the inference worker in time
+    are dropped by Redis instead of leaking
+    """
+    return _get_int(EnvironmentKeys.IMAGE_TTL_S, default_image_ttl_s, minimum=1)
+
+
+def should_downscale_images() -> bool:
+    """
+    Check if the images should be downscaled to the model
+    input resolution before being sent to the inference worker
+    """
+    downscale = os.environ.get(EnvironmentKeys.IMAGE_DOWNSCALE.value, "False")
+    return downscale in ["True", "true", "1"]
+
+
+def get_image_downscale_quality() -> int:
+    """
+    Get the JPEG quality of the downscaled images
+    """
+    quality = _get_int(EnvironmentKeys.IMAGE_DOWNSCALE_QUALITY, default_image_downscale_quality, minimum=1)
+    return min(quality, 100)
+
+
+def get_image_downscale_workers() -> int:
+    """
+    Get the number of threads downscaling the images
+    """
+    return _get_int(EnvironmentKeys.IMAGE_DOWNSCALE_WORKERS, default_image_downscale_workers, minimum=1)
+
+
+def get_text_cache_size() -> int:
+    """
+    Get the maximum number of text embeddings kept in the
+    in-process cache, 0 disables it
+    """
+    return _get_int(EnvironmentKeys.TEXT_CACHE_SIZE, default_text_cache_size, minimum=0)
+
+
+def get_text_cache_ttl_s() -> int:
+    """
+    Get the time to live, in seconds, of the text embeddings
+    cached in Redis, 0 disables the Redis tier
+    """
+    return _get_int(EnvironmentKeys.TEXT_CACHE_TTL_S, default_text_cache_ttl_s, minimum=0)
+
+
+def get_image_cache_size() -> int:
+    """
+    Get the maximum number of image embeddings kept in the
+    in-process cache, 0 disables it
+    """
+    return _get_int(EnvironmentKeys.IMAGE_CACHE_SIZE, default_image_cache_size, minimum=0)
+
+
+def get_image_cache_ttl_s() -> int:
+    """
+    Get the time to live, in seconds, of the image embeddings
+    cached in Redis, 0 disables the Redis tier
+    """
+    return _get_int(EnvironmentKeys.IMAGE_CACHE_TTL_S, default_image_cache_ttl_s, minimum=0)
+
+
+def get_request_timeout_s() -> int:
+    """
+    Get the default time, in seconds, a request waits for
+    the inference worker before failing with 504
+    """
+    return _get_int(EnvironmentKeys.REQUEST_TIMEOUT_S, default_request_timeout_s, minimum=1)
+
+
+def get_max_queue_depth() -> int:
+    """
+    Get the maximum number of jobs waiting for the inference
+    workers, new requests are rejected with 503 above it.
+    0 disables the limit
+    """
+    return _get_int(EnvironmentKeys.MAX_QUEUE_DEPTH, default_max_queue_depth, minimum=0)
+
+
+def get_stream_chunk_size() -> int:
+    """
+    Get the number of items of every job sent to the
+    inference workers by the streaming endpoint
+    """
+    return _get_int(EnvironmentKeys.STREAM_CHUNK_SIZE, default_stream_chunk_size, minimum=1)
+
+
+def get_stream_max_in_flight() -> int:
+    """
+    Get the maximum number of jobs in flight for
+    every request to the streaming endpoint
+    """
+    return _get_int(EnvironmentKeys.STREAM_MAX_IN_FLIGHT, default_stream_max_in_flight, minimum=1)
+
+
+def get_index_dir() -> str:
+    """
+    Get the directory the vector indexes are stored in
+    """
+    return os.environ.get(EnvironmentKeys.INDEX_DIR.value, default_index_dir)
+
+
+def get_index_ivf_min_vectors() -> int:
+    """
+    Get the number of vectors that triggers the training of
+    the approximate index of a vector index, 0 to never train it
+    """
+    return _get_int(EnvironmentKeys.INDEX_IVF_MIN_VECTORS, default_index_ivf_min_vectors, minimum=0)
+
+
+def get_index_nprobe() -> int:
+    """
+    Get the default number of lists scanned by the approximate search
+    """
+    return _get_int(EnvironmentKeys.INDEX_NPROBE, default_index_nprobe, minimum=1)
+
+
+def get_slow_request_ms() -> int:
+    """
+    Get the milliseconds above which a request is logged
+    with the stages of its jobs, 0 to never log them
+    """
+    return _get_int(EnvironmentKeys.SLOW_REQUEST_MS, default_slow_request_ms, minimum=0)
+
+
+def get_tenants() -> Dict[str, TenantConfig]:
+    """
+    Get the tenants of the API, a comma separated list of
+    `name:priority[:max_concurrency[:max_requests_per_s]]` entries,
+    e.g. `search:interactive:64,backfill:bulk:4:20`. The `default`
+    entry applies to the requests without a valid API key
+    """
+    value = os.environ.get(EnvironmentKeys.TENANTS.value, "")
+
+    tenants = {}
+    for entry in (entry.strip() for entry in value.split(",")):
+        if not entry:
+            continue
+        fields = entry.split(":")
+        try:
+            name, priority = fields[0], fields[1]
+            limits = [int(limit) for limit in fields[2:]]
+        except (IndexError, ValueError):
+            name, priority, limits = "", "", []
+        if not name or priority not in redis_models.PRIORITY_CLASSES or len(limits) > 2 or any(limit < 0 for limit in limits):
+            print(f"Invalid tenant in {EnvironmentKeys.TENANTS.value}: {entry}. Expected name:priority[:max_concurrency[:max_requests_per_s]] with priority one of {redis_models.PRIORITY_CLASSES}")
+            continue
+        tenants[name] = TenantConfig(name, priority, *limits)
+
+    return tenants
+
+
+def get_api_keys() -> Dict[str, str]:
+    """
+    Get the tenant of every API key, a comma separated
+    list of `key:tenant` entries, e.g. `k3y1:search,k3y2:backfill`
+    """
+    value = os.environ.get(EnvironmentKeys.API_KEYS.value, "")
+
+    api_keys = {}
+    for entry in (entry.strip() for entry in value.split(",")):
+        if not entry:
+            continue
+        key, _, tenant = entry.rpartition(":")
+        if not key or not tenant:
+            print(f"Invalid API key in {EnvironmentKeys.API_KEYS.value}. Expected key:tenant entries")
+            continue
+        api_keys[key] = tenant
+
+    return api_keys
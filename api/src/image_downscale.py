@@ -0,0 +1,70 @@
+"""
+Downscaling of the images to the input resolution of the CLIP models
+before they are sent to the inference workers. Only the resolution the
+image processor resizes to is kept, so the workers read and decode far
+fewer bytes for the same embedding. Shared by the API and the inference
+worker (to evaluate it), the two copies must stay identical.
+"""
+import io
+
+from PIL import Image
+
+# Shortest edge the image processor of every model resizes to
+MODEL_INPUT_SIZES = {
+    "openai/clip-vit-base-patch32": 224,
+    "openai/clip-vit-large-patch14": 224,
+    "openai/clip-vit-base-patch16": 224,
+    "openai/clip-vit-large-patch14-336": 336,
+}
+DEFAULT_INPUT_SIZE = 224
+# JPEG images are decoded at a reduced scale at least this many times
+# larger than the target, the final resize is done with a proper filter
+DRAFT_MARGIN = 2
+
+
+def model_input_size(model_name: str) -> int:
+    """
+    Get the shortest edge the images of a model are resized to
+    """
+    return MODEL_INPUT_SIZES.get(model_name, DEFAULT_INPUT_SIZE)
+
+
+def downscale_image(image_bytes: bytes, shortest_edge: int, quality: int = 95) -> bytes:
+    """
+    Resize an image so that its shortest edge is `shortest_edge`, with
+    the same bicubic filter of the CLIP image processor, and encode it
+    as JPEG. Large JPEG images are decoded in draft mode, at a reduced
+    scale, which is much faster than a full decode. Images that are
+    already small enough, have transparency or cannot be decoded are
+    returned unchanged, as are those whose downscaled version is larger
+
+    Args:
+    - image_bytes (bytes): The raw bytes of the image
+    - shortest_edge (int): The shortest edge of the model input
+    - quality (int): The JPEG quality of the downscaled image
+
+    Returns:
+    - bytes: The downscaled image, or `image_bytes`
+    """
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            width, height = img.size
+            if min(width, height) <= shortest_edge:
+                return image_bytes
+            if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+                # the workers decide how to flatten the alpha channel
+                return image_bytes
+
+            scale = shortest_edge / min(width, height)
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            if img.format == "JPEG":
+                img.draft("RGB", (size[0] * DRAFT_MARGIN, size[1] * DRAFT_MARGIN))
+            resized = img.convert("RGB").resize(size, Image.Resampling.BICUBIC)
+    except Exception:
+        # the worker reports the images that cannot be decoded
+        return image_bytes
+
+    output = io.BytesIO()
+    resized.save(output, format="JPEG", quality=quality)
+    downscaled = output.getvalue()
+    return downscaled if len(downscaled) < len(image_bytes) else image_bytes
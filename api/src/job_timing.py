@@ -0,0 +1,122 @@
+"""
+Timings of the jobs run by a request. Every job carries the times of
+the stages it went through, from the enqueue to the reply, and the jobs
+of a request are summed in its `Server-Timing` header. Requests slower
+than `SLOW_REQUEST_MS` are logged with the stages of every job.
+"""
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from starlette.datastructures import MutableHeaders
+
+import redis_models
+
+SERVER_TIMING_HEADER = "server-timing"
+# Order of the stages in the header and in the logs
+STAGES = ["queue", "preprocess", "wait", "forward", "serialize", "reply"]
+
+_request_jobs: ContextVar[Optional[List[Tuple[str, redis_models.JobTimings]]]] = ContextVar(
+    "request_jobs", default=None)
+
+
+def record_job(job_id: str, timings: Optional[redis_models.JobTimings]):
+    """
+    Record the timings of a job answered for the current request,
+    ignored outside of a request seen by the `TimingMiddleware`
+    """
+    jobs = _request_jobs.get()
+    if jobs is not None and timings is not None:
+        jobs.append((job_id, timings))
+
+
+def request_jobs() -> List[Tuple[str, redis_models.JobTimings]]:
+    """
+    Get the jobs answered so far for the current request, with their timings
+    """
+    return list(_request_jobs.get() or [])
+
+
+def job_stages(jobs: List[Tuple[str, redis_models.JobTimings]]) -> List[Dict]:
+    """
+    Get the milliseconds spent in every stage by every job, as returned
+    in the body of the responses with `include_timings`
+    """
+    return [
+        {"job_id": job_id, **{stage: round(ms, 3) for stage, ms in timings.stages_ms().items()}}
+        for job_id, timings in jobs]
+
+
+def server_timing(jobs: List[Tuple[str, redis_models.JobTimings]], total_ms: float) -> str:
+    """
+    Build the `Server-Timing` header value of a request. The stages
+    are summed over its jobs, jobs run concurrently so the sum of the
+    stages can exceed the total
+
+    Args:
+    - jobs (List[Tuple[str, JobTimings]]): The jobs of the request with their timings
+    - total_ms (float): The milliseconds taken by the request so far
+
+    Returns:
+    - str: The header value, e.g. `queue;dur=1.2, forward;dur=8.5, total;dur=12.3`
+    """
+    totals = {}
+    for _, timings in jobs:
+        for stage, ms in timings.stages_ms().items():
+            totals[stage] = totals.get(stage, 0.0) + ms
+
+    metrics = [f"{stage};dur={totals[stage]:.1f}" for stage in STAGES if stage in totals]
+    metrics.append(f"total;dur={total_ms:.1f}")
+    return ", ".join(metrics)
+
+
+class TimingMiddleware():
+    """
+    ASGI middleware collecting the timings of the jobs of every request.
+    The `Server-Timing` header holds the jobs answered before the response
+    starts, i.e. all of them except for streamed responses. Slow requests
+    are logged once fully sent, with the stages of all their jobs
+    """
+    def __init__(self, app, slow_request_ms: int = 0):
+        """
+        Constructor for the TimingMiddleware class
+
+        Args:
+        - app: The ASGI app
+        - slow_request_ms (int): The milliseconds above which a request is logged, 0 disables the log
+        """
+        self.app = app
+        self.slow_request_ms = slow_request_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        jobs = []
+        token = _request_jobs.set(jobs)
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and jobs:
+                headers = MutableHeaders(scope=message)
+                headers.append(SERVER_TIMING_HEADER, server_timing(jobs, (time.perf_counter() - start) * 1000))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_jobs.reset(token)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if self.slow_request_ms > 0 and elapsed_ms >= self.slow_request_ms:
+                self._log(scope, jobs, elapsed_ms)
+
+    def _log(self, scope, jobs: List[Tuple[str, redis_models.JobTimings]], elapsed_ms: float):
+        """
+        Log a slow request, one line per job with its stages
+        """
+        print(f"Slow request {scope['method']} {scope['path']}: {elapsed_ms:.1f} ms, {len(jobs)} jobs")
+        for job_id, timings in jobs:
+            stages = timings.stages_ms()
+            breakdown = " ".join(f"{stage}={stages[stage]:.1f}" for stage in STAGES if stage in stages)
+            print(f"  job {job_id}: {breakdown or 'no timings'}")
@@ -0,0 +1,75 @@
+"""
+Prometheus metrics of the API, served by the `/metrics` endpoint. Rate
+and latency of the requests per endpoint, the depth of the job queues
+and the time the jobs take to be answered by the inference workers. The
+process metrics (RSS, CPU) are exported by the default collectors of
+`prometheus_client`.
+"""
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .075, .1, .25, .5, .75, 1, 2.5, 5, 10, 30, 60)
+
+REQUESTS = Counter(
+    "clipserve_api_requests",
+    "Requests answered, per endpoint and status code",
+    ["method", "endpoint", "status"])
+REQUEST_LATENCY = Histogram(
+    "clipserve_api_request_duration_seconds",
+    "Time to answer a request, until the last byte of the response",
+    ["method", "endpoint"],
+    buckets=LATENCY_BUCKETS)
+REQUESTS_IN_FLIGHT = Gauge(
+    "clipserve_api_requests_in_flight",
+    "Requests being answered")
+JOB_LATENCY = Histogram(
+    "clipserve_api_job_duration_seconds",
+    "Time between a job is enqueued and its response is received, "
+    "the wait in the queue included",
+    ["priority"],
+    buckets=LATENCY_BUCKETS)
+QUEUE_DEPTH = Gauge(
+    "clipserve_api_queue_depth",
+    "Jobs queued or running, per priority class",
+    ["priority"])
+REJECTIONS = Counter(
+    "clipserve_api_rejections",
+    "Requests rejected before enqueueing a job, per reason",
+    ["reason"])
+
+
+class MetricsMiddleware():
+    """
+    ASGI middleware observing the rate and latency of the HTTP requests.
+    Requests are labeled with the path template of their route, so that
+    e.g. all the `/index/{name}/search` requests share their series
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        REQUESTS_IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            REQUESTS_IN_FLIGHT.dec()
+            # The router adds the matched route to the scope,
+            # unknown paths share a single series
+            route = scope.get("route")
+            endpoint = getattr(route, "path", "unmatched")
+            REQUESTS.labels(scope["method"], endpoint, str(status_code)).inc()
+            REQUEST_LATENCY.labels(scope["method"], endpoint).observe(time.perf_counter() - start)
@@ -1,21 +1,77 @@
 """
 API models for ClipServe
 """
+from enum import Enum
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Union
-from redis_models import TextEmbedding, ImageEmbedding, ClassificationResult
+from typing import List, Optional, Union
+from redis_models import TextEmbedding, ImageEmbedding, ClassificationResult, ImageError
 
 """
 Request models
 """
-class TextRequest(BaseModel):
+class EmbeddingEncoding(str, Enum):
+    """
+    How the embeddings are encoded in the response
+    - float: JSON list of numbers
+    - base64: JSON string, base64 of the little-endian `dtype` bytes
+    - msgpack: `application/msgpack` body, embeddings as raw little-endian `dtype` bytes
+    - binary: `application/octet-stream` body, the row-major embedding matrix
+      as raw little-endian `dtype` bytes. Its shape is in the `X-Embedding-Shape`
+      header. Not available for zero-shot classification
+    """
+    FLOAT = "float"
+    BASE64 = "base64"
+    MSGPACK = "msgpack"
+    BINARY = "binary"
+
+
+class EmbeddingDtype(str, Enum):
+    """
+    Data type of the returned embeddings
+    - float32, float16: floating point values
+    - int8: integers in [-127, 127], every embedding has its
+      own `scale` so that `embedding ~= values * scale`
+    - binary: the sign bits of the values packed in bytes,
+      most significant bit first. Lists of numbers hold the bytes
+    """
+    FLOAT32 = "float32"
+    FLOAT16 = "float16"
+    INT8 = "int8"
+    BINARY = "binary"
+
+
+class EmbeddingOptions(BaseModel):
+    """
+    Options shared by all the requests returning embeddings.
+    `model` selects one of the served CLIP models, the default
+    one if not set. `timeout_s` overrides the default time the
+    request waits for the inference worker.
+    The returned embeddings are, in order, projected with the named
+    PCA `projection`, truncated to the first `dimensions` values,
+    L2 normalized if `normalize` and converted to `dtype`.
+    `include_timings` adds the stages of every job to the response,
+    the `Server-Timing` header always has their sum
+    """
+    model: Optional[str] = None
+    encoding: EmbeddingEncoding = EmbeddingEncoding.FLOAT
+    dtype: EmbeddingDtype = EmbeddingDtype.FLOAT32
+    normalize: bool = False
+    dimensions: Optional[int] = Field(default=None, ge=1)
+    projection: Optional[str] = None
+    timeout_s: Optional[float] = Field(default=None, gt=0, le=600)
+    include_timings: bool = False
+
+
+class TextRequest(EmbeddingOptions):
     """
     TextRequest model, used to send text to the API
     and get the embeddings. 
     Example:
     ```json
     {
-        "text": "a photo of a cat"
+        "text": "a photo of a cat",
+        "encoding": "float",
+        "dtype": "float32"
     }
     ```
     """
@@ -25,14 +81,16 @@ class TextRequest(BaseModel):
         return self.model_dump_json()
 
 
-class ImageRequest(BaseModel):
+class ImageRequest(EmbeddingOptions):
     """
     ImageRequest model, used to send image to the API
     and get the embeddings.
     Example:
     ```json
     {
-        "image_b64": "base64 encoded image"
+        "image_b64": "base64 encoded image",
+        "encoding": "float",
+        "dtype": "float32"
     }
     ```
     """
@@ -42,31 +100,142 @@ class ImageRequest(BaseModel):
         return self.model_dump_json()
 
 
-class ZeroShotClassificationRequest(BaseModel):
+class ZeroShotClassificationRequest(EmbeddingOptions):
     """
     ZeroShotClassificationRequest model, used to send
     labels and images to the API and get the classification
-    results.
+    results. Either `labels` or the name of a registered
+    `label_set` must be provided. With `top_k` only the
+    best labels of every image are returned.
     Example:
     ```json
     {
         "labels": ["dog", "cat"],
-        "images_b64": ["base64 encoded image"]
+        "images_b64": ["base64 encoded image"],
+        "encoding": "float",
+        "dtype": "float32"
+    }
+    ```
+    or
+    ```json
+    {
+        "label_set": "animals",
+        "images_b64": ["base64 encoded image"],
+        "top_k": 5
     }
     ```
     """
     labels: List[str] = Field(default_factory=list)
     images_b64: List[str] = Field(default_factory=list)
+    label_set: Optional[str] = None
+    top_k: Optional[int] = Field(default=None, ge=1)
 
     def to_json(self):
         return self.model_dump_json()
 
 
+class LabelSetRequest(BaseModel):
+    """
+    LabelSetRequest model, used to register a named label set
+    whose text embeddings are computed once and reused by the
+    zero-shot classification requests. Label sets are registered
+    for a single `model`, the default one if not set.
+    Example:
+    ```json
+    {
+        "name": "animals",
+        "labels": ["a photo of a dog", "a photo of a cat", ...]
+    }
+    ```
+    """
+    name: str = Field(min_length=1, max_length=128, pattern=r"^[A-Za-z0-9_.-]+$")
+    labels: List[str] = Field(min_length=1)
+    model: Optional[str] = None
+
+
+class IndexDtype(str, Enum):
+    """
+    Data type of the embeddings stored in a vector index
+    """
+    FLOAT32 = "float32"
+    FLOAT16 = "float16"
+
+
+class IndexItem(BaseModel):
+    """
+    An item added to a vector index, with exactly one of
+    `text`, `image_b64` or a precomputed `embedding`
+    """
+    id: str = Field(min_length=1)
+    text: Optional[str] = None
+    image_b64: Optional[str] = None
+    embedding: Optional[List[float]] = None
+
+
+class IndexAddRequest(BaseModel):
+    """
+    IndexAddRequest model, used to add items to a vector index.
+    The index is created by the first request, for its `model`
+    (the default one if not set) and with its `dtype`. Adding
+    an existing id replaces its embedding.
+    Example:
+    ```json
+    {
+        "items": [
+            {"id": "img-1", "image_b64": "data:image/jpeg;base64,<base64 encoded image>"},
+            {"id": "doc-1", "text": "a photo of a cat"}
+        ]
+    }
+    ```
+    """
+    items: List[IndexItem] = Field(min_length=1)
+    model: Optional[str] = None
+    dtype: IndexDtype = IndexDtype.FLOAT32
+    timeout_s: Optional[float] = Field(default=None, gt=0, le=600)
+
+
+class IndexSearchRequest(BaseModel):
+    """
+    IndexSearchRequest model, used to search a vector index with
+    exactly one of `text`, `image_b64` or `embedding`. `nprobe`
+    overrides the number of lists scanned by the approximate
+    search, `exact` always scans all the embeddings.
+    Example:
+    ```json
+    {
+        "text": "a dog playing in the snow",
+        "top_k": 10
+    }
+    ```
+    """
+    text: Optional[str] = None
+    image_b64: Optional[str] = None
+    embedding: Optional[List[float]] = None
+    top_k: int = Field(default=10, ge=1, le=1000)
+    nprobe: Optional[int] = Field(default=None, ge=1)
+    exact: bool = False
+    timeout_s: Optional[float] = Field(default=None, gt=0, le=600)
+
+
 ################################################################################
 
 """
 Response models
 """
+class JobStageTimings(BaseModel):
+    """
+    JobStageTimings model, the milliseconds a job of the request spent
+    in every stage. Returned with `include_timings`, stages the job
+    did not go through are not set
+    """
+    job_id: str
+    queue: Optional[float] = None
+    preprocess: Optional[float] = None
+    wait: Optional[float] = None
+    forward: Optional[float] = None
+    serialize: Optional[float] = None
+    reply: Optional[float] = None
+
 class TextEmbeddingResponse(BaseModel):
     """
     TextEmbeddingResponse model, response format for text embeddings.
@@ -87,6 +256,7 @@ class TextEmbeddingResponse(BaseModel):
     model_config  = ConfigDict(protected_namespaces=())
     model_name: str
     text_embeddings: List[TextEmbedding] = Field(default_factory=list)
+    timings: Optional[List[JobStageTimings]] = None
 
 class ImageEmbeddingResponse(BaseModel):
     """
@@ -97,17 +267,26 @@ class ImageEmbeddingResponse(BaseModel):
         "model_name": "clip",
         "image_embeddings": [
             {
-                "image_id": "36d2e446-e5ad-423e-a847-b7da1a2b4d70",
+                "image_id": "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08",
                 "embedding": [0.44, 0.55, 0.61, ..., 0.512]
             },
             ...
+        ],
+        "errors": [
+            {
+                "image_index": 1,
+                "error": "UnidentifiedImageError: cannot identify image file"
+            }
         ]
     }
     ```
+    Images that could not be decoded are skipped and reported in `errors`.
     """
     model_config  = ConfigDict(protected_namespaces=())
     model_name: str
     image_embeddings: List[ImageEmbedding] = Field(default_factory=list)
+    errors: List[ImageError] = Field(default_factory=list)
+    timings: Optional[List[JobStageTimings]] = None
 
 class ClassificationResponse(BaseModel):
     """
@@ -125,7 +304,7 @@ class ClassificationResponse(BaseModel):
         ],
         "image_embeddings": [
             {
-                "image_id": "36d2e446-e5ad-423e-a847-b7da1a2b4d70",
+                "image_id": "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08",
                 "embedding": [0.44, 0.55, 0.61, ..., 0.512]
             },
             ...
@@ -134,7 +313,7 @@ class ClassificationResponse(BaseModel):
             "labels": ["cat", "dog", "bird"],
             "softmax_outputs": [
                 {
-                    "image_id": "36d2e446-e5ad-423e-a847-b7da1a2b4d70",
+                    "image_id": "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08",
                     "softmax_scores": [0.7, 0.2, 0.1]
                 },
                 ...
@@ -147,4 +326,144 @@ class ClassificationResponse(BaseModel):
     model_name: str
     text_embeddings: List[TextEmbedding] = Field(default_factory=list)
     image_embeddings: List[ImageEmbedding] = Field(default_factory=list)
-    classification_result: ClassificationResult = Field(default_factory=list)
\ No newline at end of file
+    classification_result: ClassificationResult = Field(default_factory=list)
+    errors: List[ImageError] = Field(default_factory=list)
+    timings: Optional[List[JobStageTimings]] = None
+
+
+class CacheStats(BaseModel):
+    """
+    CacheStats model, hit and miss counters of an embedding cache
+    """
+    local_hits: int
+    redis_hits: int
+    misses: int
+    local_entries: int
+
+class CacheStatsResponse(BaseModel):
+    """
+    CacheStatsResponse model, response format for the cache counters.
+    Example:
+    ```json
+    {
+        "text": {
+            "local_hits": 120,
+            "redis_hits": 14,
+            "misses": 32,
+            "local_entries": 46
+        },
+        "image": {
+            "local_hits": 8,
+            "redis_hits": 2,
+            "misses": 40,
+            "local_entries": 40
+        }
+    }
+    ```
+    """
+    text: CacheStats
+    image: CacheStats
+
+
+class LabelSetResponse(BaseModel):
+    """
+    LabelSetResponse model, response format for the registered label sets.
+    Example:
+    ```json
+    {
+        "name": "animals",
+        "model_name": "openai/clip-vit-base-patch32",
+        "labels_count": 1000,
+        "version": "5f0c5bd2-71c8-4a43-8b0a-0c1d8a0e6a1c"
+    }
+    ```
+    """
+    model_config  = ConfigDict(protected_namespaces=())
+    name: str
+    model_name: str
+    labels_count: int
+    version: str
+
+
+class ModelsResponse(BaseModel):
+    """
+    ModelsResponse model, response format for the served models.
+    Example:
+    ```json
+    {
+        "default_model": "openai/clip-vit-base-patch32",
+        "models": ["openai/clip-vit-base-patch32", "openai/clip-vit-large-patch14"]
+    }
+    ```
+    """
+    default_model: str
+    models: List[str]
+
+
+class IndexInfoResponse(BaseModel):
+    """
+    IndexInfoResponse model, response format for the vector indexes.
+    `approximate` is true once the IVF-PQ index is trained.
+    Example:
+    ```json
+    {
+        "name": "photos",
+        "model_name": "openai/clip-vit-base-patch32",
+        "dimensions": 512,
+        "dtype": "float32",
+        "count": 250000,
+        "approximate": true
+    }
+    ```
+    """
+    model_config  = ConfigDict(protected_namespaces=())
+    name: str
+    model_name: str
+    dimensions: int
+    dtype: IndexDtype
+    count: int
+    approximate: bool
+
+
+class IndexItemError(BaseModel):
+    """
+    IndexItemError model, an item that could not be added
+    """
+    index: int
+    id: str
+    error: str
+
+
+class IndexAddResponse(IndexInfoResponse):
+    """
+    IndexAddResponse model, the index after the add with the number
+    of new ids `added` and the items that could not be embedded
+    """
+    added: int
+    errors: List[IndexItemError] = Field(default_factory=list)
+
+
+class IndexSearchResult(BaseModel):
+    id: str
+    score: float
+
+
+class IndexSearchResponse(BaseModel):
+    """
+    IndexSearchResponse model, the most similar items first with
+    their cosine similarity and the `method` used, `exact` or `ivfpq`.
+    Example:
+    ```json
+    {
+        "name": "photos",
+        "model_name": "openai/clip-vit-base-patch32",
+        "method": "ivfpq",
+        "results": [{"id": "img-1", "score": 0.31}]
+    }
+    ```
+    """
+    model_config  = ConfigDict(protected_namespaces=())
+    name: str
+    model_name: str
+    method: str
+    results: List[IndexSearchResult]
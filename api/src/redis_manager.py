@@ -1,28 +1,84 @@
-from typing import List, Union, Optional
+import json
+import time
+import uuid
+import asyncio
+from typing import Dict, List, Union, Optional, Tuple
 import redis.asyncio as redis
 import redis_models
+import metrics
+import job_timing
+from environment_variables import ImageTransport
+from admission import AdmissionController
+
+
+def _write_images(images_path: List[str], images_data: List[bytes]):
+    """
+    Write images to disk, runs in a thread to avoid
+    blocking the event loop
+
+    Args:
+    - images_path (List[str]): List of paths to write the images
+    - images_data (List[bytes]): List of raw image bytes
+    """
+    for img_path, img_data in zip(images_path, images_data):
+        with open(img_path, "wb") as f:
+            f.write(img_data)
+
+class JobFailed(Exception):
+    """
+    Raised when the inference worker answers a job with an error
+    """
+    def __init__(self, detail: str):
+        super().__init__(detail)
+        self.detail = detail
+
 
 class RedisManager():
     """
     Manager class for interacting with Redis
     using the aioredis library for async operations
     """
-    def __init__(self, host: str, port:str, decode_responses: bool=False):
+    def __init__(
+            self, 
+            host: str, 
+            port:str, 
+            model_names: List[str],
+            decode_responses: bool=False,
+            image_transport: ImageTransport=ImageTransport.REDIS,
+            image_ttl_s: int=300,
+            max_queue_depth: int=0):
         """
         Constructor for the RedisManager class
         
         Args:
         - host (str): The host of the Redis server
         - port (str): The port of the Redis server
+        - model_names (List[str]): The models served, every model has its own job stream
         - decode_responses (bool): Whether to decode responses or not
+        - image_transport (ImageTransport): How images are sent to the inference worker
+        - image_ttl_s (int): Expiration of the images stored in Redis, in seconds
+        - max_queue_depth (int): The maximum number of queued jobs, 0 disables the limit
         """
         self.host = host
         self.port = port
         self.decode_responses = decode_responses
+        self.image_transport = image_transport
+        self.image_ttl_s = image_ttl_s
 
         redis_url = f"redis://{host}:{port}"
         self.pool = redis.ConnectionPool.from_url(url=redis_url, decode_responses=decode_responses)
         self.redis_client = redis.Redis.from_pool(self.pool)
+        self.admission = AdmissionController(self.redis_client, model_names, max_queue_depth)
+
+        # Every API process has its own reply queue, drained by a single
+        # listener that resolves the future of the matching job. The
+        # listener uses a dedicated connection as it is always blocked
+        self.reply_queue = f"responses:{uuid.uuid4()}"
+        self.pending: Dict[str, asyncio.Future] = {}
+        # When every pending job was enqueued, and its priority class
+        self.enqueued: Dict[str, Tuple[float, str]] = {}
+        self.listener_client = redis.Redis.from_url(url=redis_url, decode_responses=decode_responses)
+        self.listener_task: Optional[asyncio.Task] = None
 
     async def ping(self) -> bool:
         """
@@ -33,26 +89,102 @@ class RedisManager():
         """
         return await self.redis_client.ping()
 
+    async def start(self):
+        """
+        Start the listener of the reply queue
+        """
+        self.listener_task = asyncio.create_task(self._listen())
+
     async def close(self):
         """
-        Close the connection to the Redis server
+        Stop the listener and close the connections to the Redis server
         """
+        if self.listener_task is not None:
+            self.listener_task.cancel()
+            try:
+                await self.listener_task
+            except asyncio.CancelledError:
+                pass
+        await self.listener_client.aclose()
         await self.redis_client.aclose()
 
+    async def _listen(self):
+        """
+        Drain the reply queue of this process and resolve the future
+        of every job. Replies of jobs nobody waits for anymore are dropped
+        """
+        while True:
+            try:
+                # When calling brprop, the result is a tuple of 2 elements
+                # The first element is the key of the list, 
+                # the second element is the value of the list   
+                result = await self.listener_client.brpop(self.reply_queue, timeout=1)
+                if result is None:
+                    continue
+                replies = [result[1]]
+                # Take the other replies that are already waiting
+                more = await self.listener_client.rpop(self.reply_queue, 100)
+                if more:
+                    replies.extend(more)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error while reading the reply queue: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            for reply in replies:
+                try:
+                    response = redis_models.RedisResponseItem.from_json(reply)
+                except ValueError as e:
+                    print(f"Invalid reply: {e}")
+                    continue
+                if response.timings is not None:
+                    response.timings.received = time.time()
+                future = self.pending.get(response.job_id)
+                if future is not None and not future.done():
+                    future.set_result(response)
+
     async def enqueue_job(
             self, 
             job_id: str, 
+            model_name: str,
             texts: Optional[Union[str, List[str]]] = None, 
-            images: Optional[Union[str, List[str]]] = None):
+            images: Optional[Union[bytes, List[bytes]]] = None,
+            texts_embedding: Optional[List[Optional[str]]] = None,
+            images_id: Optional[List[str]] = None,
+            images_embedding: Optional[List[Optional[str]]] = None,
+            label_set: Optional[redis_models.RedisLabelSetRef] = None,
+            top_k: Optional[int] = None,
+            deadline: Optional[float] = None,
+            priority: str = redis_models.INTERACTIVE_PRIORITY):
         """
-        Enqueue a job to the Redis server using the 
-        `requests` queue.
+        Enqueue a job to the Redis server adding it to the job stream
+        of `model_name`, of its modality (see `redis_models.job_modality`)
+        and of its priority class. The image bytes are shipped according
+        to `image_transport`, either as binary Redis values
+        pushed together with the job or as files in `/img_store`
 
         Args:
         - job_id (str): The ID of the job
+        - model_name (str): The CLIP model that runs the job
         - texts (Union[str, List[str]]): The text to be enqueued
-        - images (Union[str, List[str]]): The images to be enqueued
+        - images (Union[bytes, List[bytes]]): The raw bytes of the images to be enqueued
+        - texts_embedding (List[Optional[str]]): The packed features of the texts
+            that are already known, aligned with `texts`, None for the others
+        - images_id (List[str]): The ids of the images, aligned with `images`
+        - images_embedding (List[Optional[str]]): The packed features of the images
+            that are already known, aligned with `images`, None for the others.
+            The bytes of these images are not sent and can be None
+        - label_set (RedisLabelSetRef): The label set to classify the images against
+        - top_k (int): The number of best labels returned for every image
+        - deadline (float): The unix time after which the job is dropped
+        - priority (str): The priority class of the job, see `redis_models.PRIORITY_CLASSES`
+
+        Raises:
+        - AdmissionRejected: If the inference workers are overloaded
         """
+        await self.admission.check(priority, deadline)
 
         if texts is None: texts = []
         if images is None: images = []
@@ -68,39 +200,154 @@ class RedisManager():
         
         _images = []
 
-        if isinstance(images, str):
-            images.append(images)
+        if isinstance(images, bytes):
+            _images.append(images)
         elif isinstance(images, list):
             _images.extend(images)
         else:
-            raise ValueError("Invalid type for images, expected str or list of str")
+            raise ValueError("Invalid type for images, expected bytes or list of bytes")
+
+        if texts_embedding is None:
+            texts_embedding = [None] * len(_texts)
+        elif len(texts_embedding) != len(_texts):
+            raise ValueError("texts_embedding must have the same length of texts")
+
+        if images_id is None:
+            images_id = [None] * len(_images)
+        if images_embedding is None:
+            images_embedding = [None] * len(_images)
+        if len(images_id) != len(_images) or len(images_embedding) != len(_images):
+            raise ValueError("images_id and images_embedding must have the same length of images")
+
+        pipeline = self.redis_client.pipeline(transaction=True)
+
+        image_items = [
+            redis_models.RedisImageItem(image_id=image_id, embedding=embedding)
+            for image_id, embedding in zip(images_id, images_embedding)]
+        # only the images with unknown features are shipped
+        to_send = [_id for _id, embedding in enumerate(images_embedding) if embedding is None]
+
+        if self.image_transport == ImageTransport.VOLUME:
+            images_path = [f"/img_store/{job_id}_{_id}" for _id in to_send]
+            await asyncio.to_thread(_write_images, images_path, [_images[_id] for _id in to_send])
+            for _id, path in zip(to_send, images_path):
+                image_items[_id].image_path = path
+        else:
+            for _id in to_send:
+                key = f"{job_id}-image-{_id}"
+                # The worker deletes the key once the job is acknowledged,
+                # the expiration only kicks in if the job is never consumed
+                pipeline.set(key, _images[_id], ex=self.image_ttl_s)
+                image_items[_id].image_key = key
 
         redis_data = redis_models.RedisRequestItem(
             job_id=job_id,
-            texts=[redis_models.RedisTextItem(text=text) for text in _texts],
-            images=[redis_models.RedisImageItem(image_path=image) for image in _images]
+            model_name=model_name,
+            reply_to=self.reply_queue,
+            texts=[
+                redis_models.RedisTextItem(text=text, embedding=embedding) 
+                for text, embedding in zip(_texts, texts_embedding)],
+            images=image_items,
+            label_set=label_set,
+            top_k=top_k,
+            deadline=deadline,
+            timings=redis_models.JobTimings(enqueued=time.time())
         )
 
-        # Push the data to the requests queue head
-        await self.redis_client.lpush(f"requests", redis_data.to_json())
+        # Add the job to the stream, the images are stored in the
+        # same transaction so they are always available when the
+        # job is read
+        modality = redis_models.job_modality(bool(_texts) or label_set is not None, bool(_images))
+        pipeline.xadd(redis_models.job_stream(model_name, modality, priority), {"job": redis_data.to_json()})
 
-    async def get_result(self, job_id: str) -> str:
+        # The future must exist before the job can be answered
+        self.pending[job_id] = asyncio.get_running_loop().create_future()
+        try:
+            await pipeline.execute()
+        except Exception:
+            self.pending.pop(job_id, None)
+            raise
+        self.enqueued[job_id] = (time.perf_counter(), priority)
+
+    async def save_label_set(self, key: str, labels: List[str], embeddings: bytes) -> str:
+        """
+        Store a label set, replacing the previous one with the same key
+
+        Args:
+        - key (str): The key of the label set
+        - labels (List[str]): The labels
+        - embeddings (bytes): The normalized label embeddings, row-major
+            little-endian float32 matrix
+
+        Returns:
+        - str: The new version of the label set
+        """
+        version = str(uuid.uuid4())
+        await self.redis_client.hset(key, mapping={
+            "labels": json.dumps(labels),
+            "embeddings": embeddings,
+            "version": version,
+            "labels_count": len(labels),
+        })
+        return version
+
+    async def get_label_set_info(self, key: str) -> Optional[Tuple[redis_models.RedisLabelSetRef, int]]:
+        """
+        Get the reference and size of a label set
+
+        Args:
+        - key (str): The key of the label set
+
+        Returns:
+        - Optional[Tuple[RedisLabelSetRef, int]]: The reference to the label set
+            and the number of labels, None if it does not exist
         """
-        Get the result of a job from the Redis server,
-        awaits the queue named `{job_id}-response` for the result
+        version, labels_count = await self.redis_client.hmget(key, ["version", "labels_count"])
+        if version is None:
+            return None
+        if isinstance(version, bytes):
+            version = version.decode()
+        return redis_models.RedisLabelSetRef(key=key, version=version), int(labels_count)
+
+    async def delete_label_set(self, key: str) -> bool:
+        """
+        Delete a label set
+
+        Args:
+        - key (str): The key of the label set
+
+        Returns:
+        - bool: True if the label set existed
+        """
+        return await self.redis_client.delete(key) > 0
+
+    async def get_result(self, job_id: str, deadline: Optional[float] = None) -> redis_models.RedisResponseItem:
+        """
+        Get the result of a job enqueued with `enqueue_job`, awaits
+        the reply delivered by the listener of the reply queue. The
+        timings of the job are recorded for the current request
         
         Args:
         - job_id (str): The ID of the job
+        - deadline (Optional[float]): The unix time to wait until, None waits forever
         
         Returns:
-        - str: The Redis response item as a JSON string
+        - RedisResponseItem: The response of the job
+
+        Raises:
+        - TimeoutError: If the deadline passes before the response arrives
+        - JobFailed: If the worker answered the job with an error
         """
-        while True:
-            # When calling brprop, the result is a tuple of 2 elements
-            # The first element is the key of the list, 
-            # the second element is the value of the list   
-            result = await self.redis_client.brpop(f"{job_id}-response", timeout=1)
-            if result is not None:
-                return result[1]
-            else:
-                continue
\ No newline at end of file
+        try:
+            timeout = None if deadline is None else max(0.0, deadline - time.time())
+            result = await asyncio.wait_for(self.pending[job_id], timeout=timeout)
+        finally:
+            self.pending.pop(job_id, None)
+            enqueued_at, priority = self.enqueued.pop(job_id, (None, None))
+
+        if enqueued_at is not None:
+            metrics.JOB_LATENCY.labels(priority).observe(time.perf_counter() - enqueued_at)
+        job_timing.record_job(job_id, result.timings)
+        if result.error is not None:
+            raise JobFailed(result.error)
+        return result
@@ -1,29 +1,184 @@
 """
 Models for the Redis request and response items
 """
+import base64
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
+from typing import Dict, List, Optional
+import numpy as np
+
+# Consumer group of the inference workers reading the job streams,
+# one stream per model, modality and priority class. Jobs failing too
+# many times are moved to the dead-letter stream
+JOB_GROUP = "inference-workers"
+DEAD_LETTER_STREAM = "requests:dead-letter"
+
+# Jobs are split by the towers they need, so that text and image
+# jobs are served by their own workers and never wait for each other.
+# Classification jobs come with the features of the labels and the
+# images, they only need the logit scale of the model
+TEXT_JOBS = "text"
+IMAGE_JOBS = "image"
+CLASSIFICATION_JOBS = "classification"
+JOB_MODALITIES = [TEXT_JOBS, IMAGE_JOBS, CLASSIFICATION_JOBS]
+
+# Hash of the learned logit scale of every served model, already
+# exponentiated. Published by the workers, so that the API scores
+# zero-shot classifications itself once it has the features
+LOGIT_SCALES_KEY = "models:logit-scale"
+
+# Priority classes of the jobs, highest first. The workers read the
+# streams of every class according to `PRIORITY_POLICY`, so bulk
+# jobs do not delay the interactive ones
+INTERACTIVE_PRIORITY = "interactive"
+BULK_PRIORITY = "bulk"
+PRIORITY_CLASSES = [INTERACTIVE_PRIORITY, BULK_PRIORITY]
+
+
+def job_stream(model_name: str, modality: str, priority: str) -> str:
+    """
+    Get the stream the API adds the jobs of a modality
+    and priority class for a model to
+    """
+    return f"requests:stream:{model_name}:{modality}:{priority}"
+
+
+def job_modality(has_texts: bool, has_images: bool) -> str:
+    """
+    Get the modality of a job from its inputs, jobs with both texts
+    (or a label set) and images are classification jobs
+    """
+    if has_images:
+        return CLASSIFICATION_JOBS if has_texts else IMAGE_JOBS
+    return TEXT_JOBS
+
+
+def pack_embeddings(embeddings: np.ndarray) -> List[str]:
+    """
+    Pack every row of an embedding matrix as the base64
+    encoding of its little-endian float32 bytes
+
+    Args:
+    - embeddings (np.ndarray): The embeddings, one per row
+
+    Returns:
+    - List[str]: The packed embeddings
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype="<f4")
+    return [base64.b64encode(row.tobytes()).decode("ascii") for row in embeddings]
+
+
+def unpack_embedding(embedding: str) -> np.ndarray:
+    """
+    Unpack an embedding packed with `pack_embeddings`
+
+    Args:
+    - embedding (str): The packed embedding
+
+    Returns:
+    - np.ndarray: The float32 embedding
+    """
+    return np.frombuffer(base64.b64decode(embedding), dtype="<f4")
 
 class RedisImageItem(BaseModel):
     """
-    RedisImageItem model, used to store the image path
+    RedisImageItem model, used to store where the image data is.
+    Exactly one of the following fields is set:
+    - image_key: the Redis key holding the raw image bytes
+    - image_path: the path of the image in the shared volume
+    - embedding: the image features, packed with `pack_embeddings`,
+      when already known. The image is not run through the model
+    
+    `image_id` is the id returned with the embedding, the content
+    hash of the image
     """
-    image_path: str
+    image_id: Optional[str] = None
+    image_key: Optional[str] = None
+    image_path: Optional[str] = None
+    embedding: Optional[str] = None
 
 class RedisTextItem(BaseModel):
     """
-    RedisTextItem model, used to store the text
+    RedisTextItem model, used to store the text. When `embedding`
+    is set (packed with `pack_embeddings`) the text features are
+    already known and the text is not run through the model
     """
     text: str
+    embedding: Optional[str] = None
+
+class RedisLabelSetRef(BaseModel):
+    """
+    RedisLabelSetRef model, used to reference a registered label set.
+    `version` changes every time the label set is registered again
+    """
+    key: str
+    version: str
+
+class JobTimings(BaseModel):
+    """
+    JobTimings model, the unix times a job went through every stage.
+    Set by the API (`enqueued`, `received`) and by the inference worker
+    (the others), durations across them assume synchronized clocks.
+    The preprocess times are only set for jobs with images to decode
+    """
+    enqueued: Optional[float] = None
+    dequeued: Optional[float] = None
+    preprocess_start: Optional[float] = None
+    preprocess_end: Optional[float] = None
+    forward_start: Optional[float] = None
+    forward_end: Optional[float] = None
+    pushed: Optional[float] = None
+    received: Optional[float] = None
+
+    def stages_ms(self) -> Dict[str, float]:
+        """
+        Get the milliseconds spent in every stage, the stages whose
+        times are missing are left out
+        - queue: waiting in the job stream
+        - preprocess: decoding and preprocessing the images
+        - wait: waiting in the worker for the batch and the model, preprocess excluded
+        - forward: running the model on the batch
+        - serialize: building and pushing the responses of the batch
+        - reply: waiting in the reply queue of the API
+        """
+        def duration(start: Optional[float], end: Optional[float]) -> Optional[float]:
+            return None if start is None or end is None else max(0.0, (end - start) * 1000)
+
+        preprocess = duration(self.preprocess_start, self.preprocess_end)
+        wait = duration(self.dequeued, self.forward_start)
+        if wait is not None and preprocess is not None:
+            wait = max(0.0, wait - preprocess)
+
+        stages = {
+            "queue": duration(self.enqueued, self.dequeued),
+            "preprocess": preprocess,
+            "wait": wait,
+            "forward": duration(self.forward_start, self.forward_end),
+            "serialize": duration(self.forward_end, self.pushed),
+            "reply": duration(self.pushed, self.received),
+        }
+        return {stage: value for stage, value in stages.items() if value is not None}
 
 class RedisRequestItem(BaseModel):
     """
     RedisRequestItem model, used to store the request data
-    in the Redis server
+    in the Redis server. The response is pushed to the `reply_to`
+    queue, or to `{job_id}-response` if not set. When `label_set` is set the images are
+    classified against the registered label set instead of `texts`,
+    `top_k` limits the classification output to the best labels.
+    `deadline` is the unix time after which nobody waits for the
+    response anymore, the job is then dropped by the worker.
+    `model_name` is the CLIP model that runs the job, `timings`
+    the times of the stages the job went through so far
     """
     job_id: str
+    model_name: Optional[str] = None
+    reply_to: Optional[str] = None
     texts: Optional[List[RedisTextItem]] = Field(default_factory=list)
     images: Optional[List[RedisImageItem]] = Field(default_factory=list) 
+    label_set: Optional[RedisLabelSetRef] = None
+    top_k: Optional[int] = None
+    deadline: Optional[float] = None
+    timings: Optional[JobTimings] = None
 
     def to_json(self):
         """
@@ -37,25 +192,57 @@ class RedisRequestItem(BaseModel):
     
 class ImageEmbedding(BaseModel):
     """
-    ImageEmbedding model, used to store the image embeddings
+    ImageEmbedding model, used to store the image embeddings.
+    `scale` is only set for int8 embeddings
     """
     image_id: str
     embedding: List[float]
+    scale: Optional[float] = None
 
 class TextEmbedding(BaseModel):
     """
-    TextEmbedding model, used to store the text embeddings
+    TextEmbedding model, used to store the text embeddings.
+    `scale` is only set for int8 embeddings
     """
     text: str
     embedding: List[float]
+    scale: Optional[float] = None
+
+class RedisImageEmbedding(BaseModel):
+    """
+    RedisImageEmbedding model, used to send the image embeddings
+    from the inference worker, the embedding is packed
+    with `pack_embeddings`
+    """
+    image_id: str
+    embedding: str
+
+class RedisTextEmbedding(BaseModel):
+    """
+    RedisTextEmbedding model, used to send the text embeddings
+    from the inference worker, the embedding is packed
+    with `pack_embeddings`
+    """
+    text: str
+    embedding: str
 
 class SoftmaxOutput(BaseModel):
     """
     SoftmaxOutput model, used to store the softmax scores for
-    a classification task
+    a classification task. With `top_k` only the best labels are
+    returned, in `labels`, sorted by descending score
     """
     image_id: str
     softmax_scores: List[float]
+    labels: Optional[List[str]] = None
+
+class ImageError(BaseModel):
+    """
+    ImageError model, used to report an image that could
+    not be decoded or preprocessed
+    """
+    image_index: int
+    error: str
 
 class ClassificationResult(BaseModel):
     """
@@ -69,7 +256,10 @@ class ClassificationResult(BaseModel):
 class RedisResponseItem(BaseModel):
     """
     RedisResponseItem model, used to store the response data
-    for every job in the Redis server
+    for every job in the Redis server. Embeddings are packed
+    as base64 little-endian float32, see `pack_embeddings`.
+    `errors` reports the images that failed, `error` is set when
+    the whole job failed. `timings` are the times of the stages of the job
     
     Example:
     ```json
@@ -78,17 +268,17 @@ class RedisResponseItem(BaseModel):
         "text_embeddings": [
             {
             "text": "a photo of a cat",
-            "embedding": [0.12, 0.21, 0.38, ..., 0.512]
+            "embedding": "HoXrPXsUrj4K1yM/...AAAAPw=="
             }
         ],
         "image_embeddings": [
             {
             "image_id": "36d2e446-e5ad-423e-a847-b7da1a2b4d70",
-            "embedding": [0.44, 0.55, 0.61, ..., 0.512]
+            "embedding": "rkfhPs3MDD9mZhw/...AAAAPw=="
             },
             {
             "image_id": "f1b87bfe-9b1c-4f93-b87d-1a51fb9e5795",
-            "embedding": [0.34, 0.52, 0.68, ..., 0.512]
+            "embedding": "PQquPgrXBT9SuC4/...AAAAPw=="
             }
         ],
         "classification_results": {
@@ -108,10 +298,14 @@ class RedisResponseItem(BaseModel):
     ```
     """
     model_config  = ConfigDict(protected_namespaces=())
+    job_id: Optional[str] = None
     model_name: str
-    text_embeddings: Optional[List[TextEmbedding]] = None
-    image_embeddings: Optional[List[ImageEmbedding]] = None
+    text_embeddings: Optional[List[RedisTextEmbedding]] = None
+    image_embeddings: Optional[List[RedisImageEmbedding]] = None
     classification_result: Optional[ClassificationResult] = None
+    errors: Optional[List[ImageError]] = None
+    error: Optional[str] = None
+    timings: Optional[JobTimings] = None
 
     def to_json(self):
         return self.model_dump_json(exclude_unset=True)
@@ -0,0 +1,169 @@
+"""
+Encoding of the inference results into HTTP responses
+"""
+import base64
+from typing import Any, Dict, List, Optional, Tuple
+
+import msgpack
+import numpy as np
+from fastapi.responses import JSONResponse, Response
+
+import redis_models
+from models import EmbeddingEncoding, EmbeddingDtype
+from embedding_transform import EmbeddingTransform, quantize
+
+IDENTITY = EmbeddingTransform()
+
+
+def _convert(
+        packed: str,
+        dtype: EmbeddingDtype,
+        transform: EmbeddingTransform) -> Tuple[np.ndarray, Optional[float]]:
+    """
+    Transform an embedding packed by the inference worker and
+    convert it to the little-endian `dtype`
+    """
+    embedding = redis_models.unpack_embedding(packed)
+    if not transform.is_identity():
+        embedding = transform.apply(embedding)
+    return quantize(embedding, dtype)
+
+
+def encode_embedding(
+        packed: str,
+        encoding: EmbeddingEncoding,
+        dtype: EmbeddingDtype,
+        transform: EmbeddingTransform = IDENTITY) -> Dict[str, Any]:
+    """
+    Convert an embedding packed by the inference worker
+    to the requested encoding
+
+    Args:
+    - packed (str): The embedding packed with `pack_embeddings`
+    - encoding (EmbeddingEncoding): The encoding of the response
+    - dtype (EmbeddingDtype): The data type of the embedding
+    - transform (EmbeddingTransform): The transforms applied before the conversion
+
+    Returns:
+    - Dict[str, Any]: The `embedding`, as a list of numbers, a base64 string
+        or raw bytes, and its `scale` for int8 embeddings
+    """
+    if encoding == EmbeddingEncoding.BASE64 and dtype == EmbeddingDtype.FLOAT32 and transform.is_identity():
+        # Already in the requested format, no need to decode it
+        return {"embedding": packed}
+
+    embedding, scale = _convert(packed, dtype, transform)
+
+    if encoding == EmbeddingEncoding.FLOAT:
+        fields = {"embedding": embedding.tolist()}
+    elif encoding == EmbeddingEncoding.BASE64:
+        fields = {"embedding": base64.b64encode(embedding.tobytes()).decode("ascii")}
+    else:
+        fields = {"embedding": embedding.tobytes()}
+
+    if scale is not None:
+        fields["scale"] = scale
+    return fields
+
+
+def _encode_content(
+        result: redis_models.RedisResponseItem,
+        encoding: EmbeddingEncoding,
+        dtype: EmbeddingDtype,
+        transform: EmbeddingTransform) -> Dict[str, Any]:
+    """
+    Build the response body, with the same layout of the API
+    response models and the embeddings in the requested encoding
+    """
+    content: Dict[str, Any] = {"model_name": result.model_name}
+
+    if encoding != EmbeddingEncoding.FLOAT:
+        content["encoding"] = encoding.value
+        content["dtype"] = dtype.value
+
+    if result.text_embeddings is not None:
+        content["text_embeddings"] = [
+            {"text": item.text, **encode_embedding(item.embedding, encoding, dtype, transform)}
+            for item in result.text_embeddings]
+
+    if result.image_embeddings is not None:
+        content["image_embeddings"] = [
+            {"image_id": item.image_id, **encode_embedding(item.embedding, encoding, dtype, transform)}
+            for item in result.image_embeddings]
+
+    if result.classification_result is not None:
+        content["classification_result"] = result.classification_result.model_dump(exclude_none=True)
+
+    if result.image_embeddings is not None or result.errors is not None:
+        content["errors"] = [error.model_dump() for error in result.errors or []]
+
+    return content
+
+
+def _encode_binary(
+        result: redis_models.RedisResponseItem,
+        dtype: EmbeddingDtype,
+        transform: EmbeddingTransform) -> Response:
+    """
+    Build an `application/octet-stream` response holding the embedding
+    matrix of a text or image job, the metadata is sent in the headers.
+    The scales of int8 embeddings are sent in `X-Embedding-Scales`
+    """
+    items: List[Any] = result.text_embeddings or result.image_embeddings or []
+    converted = [_convert(item.embedding, dtype, transform) for item in items]
+    if converted:
+        matrix = np.stack([embedding for embedding, _ in converted])
+    else:
+        matrix = quantize(np.empty((0,), dtype="<f4"), dtype)[0].reshape(0, 0)
+
+    headers = {
+        "X-Model-Name": result.model_name,
+        "X-Embedding-Shape": f"{matrix.shape[0]},{matrix.shape[1]}",
+        "X-Embedding-Dtype": dtype.value,
+    }
+    if result.image_embeddings is not None:
+        headers["X-Image-Ids"] = ",".join(item.image_id for item in result.image_embeddings)
+    if dtype == EmbeddingDtype.INT8:
+        headers["X-Embedding-Scales"] = ",".join(repr(scale) for _, scale in converted)
+    if result.errors:
+        headers["X-Image-Errors"] = ",".join(str(error.image_index) for error in result.errors)
+
+    return Response(
+        content=matrix.tobytes(),
+        media_type="application/octet-stream",
+        headers=headers)
+
+
+def encode_response(
+        result: redis_models.RedisResponseItem,
+        encoding: EmbeddingEncoding,
+        dtype: EmbeddingDtype,
+        transform: EmbeddingTransform = IDENTITY,
+        timings: Optional[List[Dict[str, Any]]] = None) -> Response:
+    """
+    Encode the result of a job as an HTTP response
+
+    Args:
+    - result (RedisResponseItem): The result from the inference worker
+    - encoding (EmbeddingEncoding): The encoding of the response
+    - dtype (EmbeddingDtype): The data type of the embeddings
+    - transform (EmbeddingTransform): The transforms applied to the embeddings
+    - timings (Optional[List[Dict[str, Any]]]): The stages of the jobs of
+        the request, added to the JSON and msgpack responses if set
+
+    Returns:
+    - Response: The JSON, msgpack or binary response
+    """
+    if encoding == EmbeddingEncoding.BINARY:
+        return _encode_binary(result, dtype, transform)
+
+    content = _encode_content(result, encoding, dtype, transform)
+    if timings is not None:
+        content["timings"] = timings
+
+    if encoding == EmbeddingEncoding.MSGPACK:
+        return Response(
+            content=msgpack.packb(content, use_bin_type=True),
+            media_type="application/msgpack")
+
+    return JSONResponse(content=content)
@@ -0,0 +1,221 @@
+"""
+Streaming of bulk embedding requests. The NDJSON body is read line by
+line and split in chunks of worker sized jobs, with a bounded number
+of chunks in flight. The results are written back as NDJSON as soon
+as each chunk completes, so memory use does not grow with the input.
+"""
+import json
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Tuple
+
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+
+from admission import AdmissionRejected
+
+# Longest accepted NDJSON line, a single base64 encoded image
+MAX_LINE_BYTES = 64 * 1024 * 1024
+# Number of times a chunk is retried when rejected by the admission control
+MAX_ADMISSION_RETRIES = 3
+
+# (index of the line, id given by the client, text or base64 image)
+StreamItem = Tuple[int, Any, str]
+EmbedChunk = Callable[[str, List[StreamItem]], Awaitable[List[Dict[str, Any]]]]
+
+
+async def read_ndjson(stream: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Any]]:
+    """
+    Parse an NDJSON body while it is received, blank lines are skipped
+
+    Args:
+    - stream (AsyncIterator[bytes]): The chunks of the request body
+
+    Returns:
+    - AsyncIterator[Tuple[int, Any]]: The index of every line and its
+        parsed value, or the `ValueError` if it is not valid JSON
+
+    Raises:
+    - ValueError: If a line is longer than `MAX_LINE_BYTES`
+    """
+    buffer = bytearray()
+    index = 0
+    async for data in stream:
+        buffer.extend(data)
+        start = 0
+        while (end := buffer.find(b"\n", start)) != -1:
+            line = bytes(buffer[start:end])
+            start = end + 1
+            if line.strip():
+                try:
+                    yield index, json.loads(line)
+                except ValueError as e:
+                    yield index, e
+                index += 1
+        del buffer[:start]
+
+        if len(buffer) > MAX_LINE_BYTES:
+            raise ValueError(f"Line {index} is longer than {MAX_LINE_BYTES} bytes")
+
+    if bytes(buffer).strip():
+        try:
+            yield index, json.loads(bytes(buffer))
+        except ValueError as e:
+            yield index, e
+
+
+def _error_line(index: int, item_id: Any, error: str) -> Dict[str, Any]:
+    line = {"index": index, "error": error}
+    if item_id is not None:
+        line["id"] = item_id
+    return line
+
+
+async def stream_embeddings(
+        stream: AsyncIterator[bytes],
+        embed_chunk: EmbedChunk,
+        chunk_size: int,
+        max_in_flight: int) -> AsyncIterator[bytes]:
+    """
+    Embed the texts and images of an NDJSON body. Every line is an object
+    with either `text` or `image_b64`, and an optional `id` echoed in the
+    output. The output lines have the `index` of the input line and either
+    the embedding fields or an `error`, chunks complete out of order
+
+    Args:
+    - stream (AsyncIterator[bytes]): The chunks of the request body
+    - embed_chunk (EmbedChunk): Embeds a chunk of `text` or `image` items,
+        returning one output line per item
+    - chunk_size (int): The number of items of every job sent to the workers
+    - max_in_flight (int): The maximum number of chunks embedded at once
+
+    Returns:
+    - AsyncIterator[bytes]: The NDJSON output lines
+    """
+    results: asyncio.Queue = asyncio.Queue()
+    in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def run_chunk(kind: str, items: List[StreamItem]):
+        try:
+            for attempt in range(MAX_ADMISSION_RETRIES + 1):
+                try:
+                    lines = await embed_chunk(kind, items)
+                    break
+                except AdmissionRejected as e:
+                    if attempt == MAX_ADMISSION_RETRIES:
+                        raise
+                    # the workers are overloaded, slow down the stream
+                    await asyncio.sleep(e.retry_after_s)
+        except Exception as e:
+            error = e.detail if isinstance(e, AdmissionRejected) else f"{type(e).__name__}: {e}"
+            lines = [_error_line(index, item_id, error) for index, item_id, _ in items]
+        # the chunk stays in flight until its results are
+        # consumed, so a slow client slows down the stream
+        await results.put((lines, True))
+
+    async def submit(kind: str, items: List[StreamItem]):
+        await in_flight.acquire()
+        task = asyncio.create_task(run_chunk(kind, items))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def produce():
+        buffers: Dict[str, List[StreamItem]] = {"text": [], "image": []}
+        try:
+            async for index, value in read_ndjson(stream):
+                if isinstance(value, ValueError):
+                    await results.put(([_error_line(index, None, f"Invalid JSON: {value}")], False))
+                    continue
+                if not isinstance(value, dict) or ("text" in value) == ("image_b64" in value):
+                    await results.put(([_error_line(
+                        index, None, "Every line must be an object with either text or image_b64")], False))
+                    continue
+
+                kind = "text" if "text" in value else "image"
+                payload = value["text"] if kind == "text" else value["image_b64"]
+                if not isinstance(payload, str):
+                    await results.put(([_error_line(index, value.get("id"), f"{kind} must be a string")], False))
+                    continue
+
+                buffers[kind].append((index, value.get("id"), payload))
+                if len(buffers[kind]) >= chunk_size:
+                    await submit(kind, buffers[kind])
+                    buffers[kind] = []
+        except Exception as e:
+            # the body could not be read to the end, the
+            # chunks received so far are still completed
+            await results.put(([{"error": f"{type(e).__name__}: {e}"}], False))
+
+        for kind, items in buffers.items():
+            if items:
+                await submit(kind, items)
+        while tasks:
+            await asyncio.gather(*list(tasks))
+        await results.put((None, False))
+
+    tasks: set = set()
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            lines, from_chunk = await results.get()
+            if lines is None:
+                break
+            yield "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+            if from_chunk:
+                in_flight.release()
+    finally:
+        producer.cancel()
+        for task in list(tasks):
+            task.cancel()
+
+
+class DuplexStreamingResponse(StreamingResponse):
+    """
+    Streaming response sent while the request body is still being read.
+    `StreamingResponse` listens for the client disconnect by calling
+    `receive` while the response is sent, which consumes the body
+    messages the endpoint is waiting for. Here the body is read only by
+    the endpoint, through `read_body`, and the disconnect is listened for once
+    the whole body has been received
+    """
+    def __init__(
+            self,
+            request: Request,
+            content: Callable[[AsyncIterator[bytes]], AsyncIterator[bytes]],
+            media_type: str = "application/x-ndjson"):
+        """
+        Constructor for the DuplexStreamingResponse class
+
+        Args:
+        - request (Request): The request whose body is streamed
+        - content (Callable): Builds the response lines from the chunks of the body
+        - media_type (str): The media type of the response
+        """
+        self.request = request
+        self.body_received = asyncio.Event()
+        super().__init__(content(self.read_body()), media_type=media_type)
+
+    async def read_body(self) -> AsyncIterator[bytes]:
+        """
+        The chunks of the request body
+        """
+        try:
+            async for data in self.request.stream():
+                yield data
+        finally:
+            self.body_received.set()
+
+    async def __call__(self, scope, receive, send):
+        async def listen_for_disconnect():
+            await self.body_received.wait()
+            await self.listen_for_disconnect(receive)
+
+        response = asyncio.create_task(self.stream_response(send))
+        listener = asyncio.create_task(listen_for_disconnect())
+        try:
+            # a client disconnect cancels the embedding of the remaining chunks
+            await asyncio.wait((response, listener), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            response.cancel()
+            listener.cancel()
+        if not response.cancelled() and response.done():
+            response.result()
@@ -0,0 +1,204 @@
+"""
+Tenants of the API and their limits. Every request is tagged with the
+tenant of its `X-API-Key` header and a priority class, which selects the
+job streams of its jobs. Requests without a key are served as the bulk
+`default` tenant, requests with an unknown key are rejected with 401.
+Requests over the concurrency or rate limit of their tenant are rejected
+with 429 before any job is enqueued.
+"""
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+import redis.asyncio as redis
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers
+
+import redis_models
+import metrics
+
+API_KEY_HEADER = "x-api-key"
+PRIORITY_HEADER = "x-priority"
+# Requests without an API key share the limits of this one, which
+# is bulk unless configured otherwise
+DEFAULT_TENANT = "default"
+# Expiration of the per second request counters, slightly longer than the window
+RATE_COUNTER_TTL_S = 2
+
+
+@dataclass
+class TenantConfig:
+    """
+    The priority class and the limits of a tenant, 0 disables a limit
+    """
+    name: str
+    priority: str = redis_models.INTERACTIVE_PRIORITY
+    max_concurrency: int = 0
+    max_requests_per_s: int = 0
+
+
+class TenantLimitExceeded(Exception):
+    """
+    Raised when a request exceeds the limits of its tenant
+    """
+    def __init__(self, detail: str, retry_after_s: int = 1):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after_s = retry_after_s
+
+
+class InvalidApiKey(Exception):
+    """
+    Raised when a request has an API key not configured
+    """
+
+
+class TenantLimiter():
+    """
+    Enforces the limits of the tenants. The requests in flight are counted
+    by every API process, the requests per second are counted in Redis so
+    that the rate limit holds across all the API processes
+    """
+    def __init__(self, tenants: Dict[str, TenantConfig], api_keys: Dict[str, str]):
+        """
+        Constructor for the TenantLimiter class
+
+        Args:
+        - tenants (Dict[str, TenantConfig]): The configured tenants by name,
+            the `default` one applies to the requests without an API key
+        - api_keys (Dict[str, str]): The tenant of every API key, keys
+            of tenants not configured are ignored
+        """
+        self.tenants = tenants
+        self.default = tenants.get(
+            DEFAULT_TENANT, TenantConfig(name=DEFAULT_TENANT, priority=redis_models.BULK_PRIORITY))
+        self.api_keys: Dict[str, TenantConfig] = {}
+        for key, tenant_name in api_keys.items():
+            if tenant_name not in tenants:
+                print(f"Ignoring an API key of tenant {tenant_name}, which is not configured")
+                continue
+            self.api_keys[key] = tenants[tenant_name]
+        self.redis_client: Optional[redis.Redis] = None
+        self.in_flight: Dict[str, int] = {}
+
+    def start(self, redis_client: redis.Redis):
+        """
+        Start counting the requests per second in Redis
+        """
+        self.redis_client = redis_client
+
+    def resolve(self, api_key: Optional[str], priority: Optional[str]) -> Tuple[TenantConfig, str]:
+        """
+        Get the tenant of a request from its API key and its priority class.
+        A request can ask for a lower priority than the one of its tenant,
+        never a higher one
+
+        Args:
+        - api_key (Optional[str]): The API key of the request
+        - priority (Optional[str]): The priority class asked by the request
+
+        Returns:
+        - TenantConfig: The tenant, the `default` one without an API key
+        - str: The priority class of the request
+
+        Raises:
+        - InvalidApiKey: If the API key is not configured
+        - ValueError: If the priority class does not exist
+        """
+        if api_key:
+            tenant = self.api_keys.get(api_key)
+            if tenant is None:
+                raise InvalidApiKey("Invalid API key")
+        else:
+            tenant = self.default
+        if priority is None:
+            return tenant, tenant.priority
+        if priority not in redis_models.PRIORITY_CLASSES:
+            raise ValueError(f"Invalid priority {priority}, expected one of {redis_models.PRIORITY_CLASSES}")
+        rank = max(
+            redis_models.PRIORITY_CLASSES.index(priority),
+            redis_models.PRIORITY_CLASSES.index(tenant.priority))
+        return tenant, redis_models.PRIORITY_CLASSES[rank]
+
+    async def acquire(self, tenant: TenantConfig):
+        """
+        Count a new request of a tenant, `release` must be called once answered
+
+        Raises:
+        - TenantLimitExceeded: If the request exceeds the limits of the tenant
+        """
+        in_flight = self.in_flight.get(tenant.name, 0)
+        if tenant.max_concurrency > 0 and in_flight >= tenant.max_concurrency:
+            metrics.REJECTIONS.labels("tenant_concurrency").inc()
+            raise TenantLimitExceeded(
+                f"Tenant {tenant.name} has {in_flight} requests in flight, the limit is {tenant.max_concurrency}")
+
+        if tenant.max_requests_per_s > 0 and self.redis_client is not None:
+            # Fixed one second windows, a single round trip per request
+            key = f"tenant-rate:{tenant.name}:{int(time.time())}"
+            pipeline = self.redis_client.pipeline(transaction=False)
+            pipeline.incr(key)
+            pipeline.expire(key, RATE_COUNTER_TTL_S)
+            requests_count, _ = await pipeline.execute()
+            if requests_count > tenant.max_requests_per_s:
+                metrics.REJECTIONS.labels("tenant_rate").inc()
+                raise TenantLimitExceeded(
+                    f"Tenant {tenant.name} exceeded {tenant.max_requests_per_s} requests per second")
+
+        self.in_flight[tenant.name] = in_flight + 1
+
+    def release(self, tenant: TenantConfig):
+        """
+        Stop counting a request of a tenant
+        """
+        self.in_flight[tenant.name] -= 1
+
+
+class TenantMiddleware():
+    """
+    ASGI middleware applying the tenant limits to the POST requests, the
+    ones that run the models. The request is counted as in flight until
+    its response is fully sent, streamed responses included. The priority
+    class of the request is stored in its state, see `request_priority`
+    """
+    def __init__(self, app, limiter: TenantLimiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+
+        headers = Headers(scope=scope)
+        try:
+            tenant, priority = self.limiter.resolve(headers.get(API_KEY_HEADER), headers.get(PRIORITY_HEADER))
+            await self.limiter.acquire(tenant)
+        except InvalidApiKey as e:
+            await JSONResponse(status_code=401, content={"detail": str(e)})(scope, receive, send)
+            return
+        except ValueError as e:
+            await JSONResponse(status_code=400, content={"detail": str(e)})(scope, receive, send)
+            return
+        except TenantLimitExceeded as e:
+            response = JSONResponse(
+                status_code=429,
+                content={"detail": e.detail},
+                headers={"Retry-After": str(e.retry_after_s)})
+            await response(scope, receive, send)
+            return
+
+        scope.setdefault("state", {})["priority"] = priority
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.limiter.release(tenant)
+
+
+def request_priority(request: Request) -> str:
+    """
+    Dependency giving the priority class of a request, the
+    bulk one for the requests not seen by the middleware
+    """
+    return getattr(request.state, "priority", redis_models.BULK_PRIORITY)
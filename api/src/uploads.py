@@ -0,0 +1,75 @@
+"""
+Images uploaded as raw bytes, either as the files of a
+`multipart/form-data` body or as an `application/octet-stream`
+body, without the base64 and JSON overhead. The format of every
+image is sniffed from its first bytes, never from a declared type.
+"""
+from typing import List, Optional
+
+from fastapi import HTTPException, Request
+
+# Form field holding the uploaded image files
+IMAGES_FIELD = "images"
+
+SUPPORTED_FORMATS = ["jpeg", "png", "gif", "webp", "bmp", "tiff"]
+
+
+def sniff_image_format(data: bytes) -> Optional[str]:
+    """
+    Get the format of an image from its magic bytes
+
+    Args:
+    - data (bytes): The raw bytes of the image
+
+    Returns:
+    - Optional[str]: One of `SUPPORTED_FORMATS`, None if not recognized
+    """
+    if data.startswith(b"\xff\xd8\xff"):
+        return "jpeg"
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "png"
+    if data.startswith((b"GIF87a", b"GIF89a")):
+        return "gif"
+    if data.startswith(b"RIFF") and data[8:12] == b"WEBP":
+        return "webp"
+    if data.startswith(b"BM"):
+        return "bmp"
+    if data.startswith((b"II*\x00", b"MM\x00*")):
+        return "tiff"
+    return None
+
+
+async def read_uploaded_images(request: Request) -> List[bytes]:
+    """
+    Read the images of an upload request, the `images` files of
+    a multipart body or a single image as the whole body
+
+    Args:
+    - request (Request): The request
+
+    Returns:
+    - List[bytes]: The raw bytes of the images, in upload order
+
+    Raises:
+    - HTTPException: If the body is neither multipart nor raw bytes, or has no images
+    """
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        images_data = []
+        for upload in form.getlist(IMAGES_FIELD):
+            if isinstance(upload, str):
+                raise HTTPException(
+                    status_code=400, detail=f"The {IMAGES_FIELD} form fields must be files")
+            images_data.append(await upload.read())
+            await upload.close()
+    elif content_type.startswith(("application/octet-stream", "image/")):
+        images_data = [await request.body()]
+    else:
+        raise HTTPException(
+            status_code=415,
+            detail="Send the images as multipart/form-data files or as an application/octet-stream body")
+
+    if not images_data or not all(images_data):
+        raise HTTPException(status_code=400, detail="No image data in the request")
+    return images_data
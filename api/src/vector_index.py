@@ -0,0 +1,483 @@
+"""
+Vector indexes of normalized embeddings, searched by inner product
+(cosine similarity). Every index is a directory with the embeddings in
+a memory-mapped float32 or float16 matrix and the ids of its rows.
+Small indexes are searched exactly with a blocked matrix product, once
+an index grows past `ivf_min_vectors` an IVF-PQ approximate index is
+trained: the vectors are assigned to the nearest of `n_lists` coarse
+centroids and their residuals compressed with product quantization.
+A search scans the compressed vectors of the `nprobe` closest lists
+only, and the best candidates are scored again with the exact vectors.
+"""
+import json
+import os
+import shutil
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+META_FILE = "meta.json"
+IDS_FILE = "ids.jsonl"
+VECTORS_FILE = "vectors.npy"
+IVF_FILE = "ivf.npz"
+LISTS_FILE = "lists.npy"
+CODES_FILE = "codes.npy"
+
+# Rows scored at once by the exact search, bounds the memory used
+BLOCK_ROWS = 65536
+# Minimum number of rows allocated, the matrices double when full
+MIN_CAPACITY = 1024
+# Maximum number of vectors the coarse centroids and the PQ codebooks are trained on
+TRAIN_SAMPLE = 65536
+PQ_TRAIN_SAMPLE = 16384
+KMEANS_ITERATIONS = 10
+# Dimensions of every product quantization sub-vector, and codes per sub-vector
+PQ_SUB_DIMENSIONS = 8
+PQ_CODES = 256
+# Candidates scored again with the exact vectors, as a multiple of top_k
+RERANK_FACTOR = 10
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    """
+    L2 normalize the rows of `embeddings` as float32
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.where(norms > 0, norms, 1)
+
+
+def _nearest(data: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    """
+    Index of the closest centroid (L2) of every row of `data`
+    """
+    half_norms = 0.5 * (centroids ** 2).sum(axis=1)
+    nearest = np.empty(data.shape[0], dtype=np.int64)
+    for start in range(0, data.shape[0], BLOCK_ROWS):
+        block = data[start:start + BLOCK_ROWS]
+        nearest[start:start + BLOCK_ROWS] = (block @ centroids.T - half_norms).argmax(axis=1)
+    return nearest
+
+
+def kmeans(data: np.ndarray, k: int, seed: int = 0) -> np.ndarray:
+    """
+    Lloyd's k-means, empty clusters are moved to random rows
+
+    Args:
+    - data (np.ndarray): The float32 vectors, (n, dim)
+    - k (int): The number of clusters, at most n
+    - seed (int): The seed of the initialization
+
+    Returns:
+    - np.ndarray: The centroids, (k, dim)
+    """
+    rng = np.random.default_rng(seed)
+    centroids = data[rng.choice(data.shape[0], k, replace=False)].copy()
+    for _ in range(KMEANS_ITERATIONS):
+        assignments = _nearest(data, centroids)
+        counts = np.bincount(assignments, minlength=k)
+        order = np.argsort(assignments, kind="stable")
+        empty = counts == 0
+        # sums of the rows of every non empty cluster, in cluster order
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[~empty]
+        centroids[~empty] = np.add.reduceat(data[order], starts) / counts[~empty, None]
+        centroids[empty] = data[rng.choice(data.shape[0], int(empty.sum()))]
+    return centroids
+
+
+@dataclass
+class IvfPq:
+    """
+    The trained part of an IVF-PQ index, `codebooks` is
+    (n_subvectors, PQ_CODES, PQ_SUB_DIMENSIONS)
+    """
+    centroids: np.ndarray
+    codebooks: np.ndarray
+
+    @classmethod
+    def train(cls, sample: np.ndarray, n_lists: int) -> "IvfPq":
+        """
+        Train the coarse centroids and the codebooks of the residuals
+
+        Args:
+        - sample (np.ndarray): The normalized float32 training vectors
+        - n_lists (int): The number of inverted lists
+
+        Returns:
+        - IvfPq: The trained index
+        """
+        centroids = kmeans(sample, min(n_lists, sample.shape[0]))
+        sample = sample[np.random.default_rng(0).permutation(sample.shape[0])[:PQ_TRAIN_SAMPLE]]
+        residuals = sample - centroids[_nearest(sample, centroids)]
+        sub_vectors = residuals.reshape(sample.shape[0], -1, PQ_SUB_DIMENSIONS)
+        codebooks = np.stack([
+            kmeans(np.ascontiguousarray(sub_vectors[:, idx]), min(PQ_CODES, sample.shape[0]), seed=idx + 1)
+            for idx in range(sub_vectors.shape[1])])
+        if codebooks.shape[1] < PQ_CODES:
+            # tiny samples, pad so that every code is valid
+            padding = np.repeat(codebooks[:, :1], PQ_CODES - codebooks.shape[1], axis=1)
+            codebooks = np.concatenate([codebooks, padding], axis=1)
+        return cls(centroids=centroids, codebooks=codebooks)
+
+    def encode(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Assign normalized float32 vectors to their list and compress them
+
+        Returns:
+        - np.ndarray: The list of every vector, int32
+        - np.ndarray: The PQ codes of the residuals, (n, n_subvectors) uint8
+        """
+        lists = _nearest(vectors, self.centroids)
+        residuals = (vectors - self.centroids[lists]).reshape(vectors.shape[0], -1, PQ_SUB_DIMENSIONS)
+        codes = np.stack([
+            _nearest(residuals[:, idx], self.codebooks[idx])
+            for idx in range(self.codebooks.shape[0])], axis=1)
+        return lists.astype(np.int32), codes.astype(np.uint8)
+
+
+class VectorIndex():
+    """
+    A persistent index of normalized embeddings of a single CLIP model.
+    Adding an existing id replaces its embedding. Writes are serialized,
+    searches run concurrently on the rows already written
+    """
+    def __init__(self, path: str, meta: dict):
+        """
+        Constructor for the VectorIndex class, use `create` or `load`
+
+        Args:
+        - path (str): The directory of the index
+        - meta (dict): The metadata stored in `meta.json`
+        """
+        self.path = path
+        self.model_name: str = meta["model_name"]
+        self.dimensions: int = meta["dimensions"]
+        self.dtype: str = meta["dtype"]
+        self.count: int = meta["count"]
+        self.lock = threading.Lock()
+
+        self.vectors = np.load(self._file(VECTORS_FILE), mmap_mode="r+")
+        with open(self._file(IDS_FILE)) as f:
+            # lines past `count` were written by an interrupted add
+            self.ids: List[str] = [json.loads(line) for _, line in zip(range(self.count), f)]
+        self.rows: Dict[str, int] = {item_id: row for row, item_id in enumerate(self.ids)}
+
+        self.ivf: Optional[IvfPq] = None
+        self.lists = self.codes = None
+        if meta.get("ivf"):
+            with np.load(self._file(IVF_FILE)) as ivf:
+                self.ivf = IvfPq(centroids=ivf["centroids"], codebooks=ivf["codebooks"])
+            self.lists = np.load(self._file(LISTS_FILE), mmap_mode="r+")
+            self.codes = np.load(self._file(CODES_FILE), mmap_mode="r+")
+        # (row order sorted by list, start offset of every list), built lazily
+        self._inverted = None
+
+    @classmethod
+    def create(cls, path: str, model_name: str, dimensions: int, dtype: str) -> "VectorIndex":
+        """
+        Create an empty index
+
+        Args:
+        - path (str): The directory of the index, must not exist
+        - model_name (str): The model of the embeddings
+        - dimensions (int): The dimensions of the embeddings
+        - dtype (str): `float32` or `float16`
+
+        Returns:
+        - VectorIndex: The index
+        """
+        if dimensions % PQ_SUB_DIMENSIONS:
+            raise ValueError(f"The dimensions must be a multiple of {PQ_SUB_DIMENSIONS}")
+        os.makedirs(path, exist_ok=True)
+        meta = {"model_name": model_name, "dimensions": dimensions, "dtype": dtype, "count": 0, "ivf": False}
+        np.lib.format.open_memmap(
+            os.path.join(path, VECTORS_FILE), mode="w+", dtype=dtype, shape=(MIN_CAPACITY, dimensions)).flush()
+        open(os.path.join(path, IDS_FILE), "w").close()
+        _write_json(os.path.join(path, META_FILE), meta)
+        return cls(path, meta)
+
+    @classmethod
+    def load(cls, path: str) -> "VectorIndex":
+        """
+        Open an existing index
+        """
+        with open(os.path.join(path, META_FILE)) as f:
+            return cls(path, json.load(f))
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _save_meta(self):
+        _write_json(self._file(META_FILE), {
+            "model_name": self.model_name, "dimensions": self.dimensions, "dtype": self.dtype,
+            "count": self.count, "ivf": self.ivf is not None})
+
+    def _grown(self, name: str, array: np.ndarray, capacity: int) -> np.ndarray:
+        """
+        Copy a memory-mapped matrix to a larger file, replacing it
+        """
+        path = self._file(name)
+        grown = np.lib.format.open_memmap(
+            path + ".tmp", mode="w+", dtype=array.dtype, shape=(capacity, *array.shape[1:]))
+        grown[:self.count] = array[:self.count]
+        grown.flush()
+        del grown
+        os.replace(path + ".tmp", path)
+        return np.load(path, mmap_mode="r+")
+
+    def _reserve(self, rows: int):
+        if rows <= self.vectors.shape[0]:
+            return
+        capacity = max(rows, 2 * self.vectors.shape[0])
+        self.vectors = self._grown(VECTORS_FILE, self.vectors, capacity)
+        if self.ivf is not None:
+            self.lists = self._grown(LISTS_FILE, self.lists, capacity)
+            self.codes = self._grown(CODES_FILE, self.codes, capacity)
+
+    def add(self, ids: List[str], embeddings: np.ndarray, ivf_min_vectors: int = 0) -> int:
+        """
+        Add or replace embeddings, the IVF-PQ index is trained
+        when the index reaches `ivf_min_vectors` vectors
+
+        Args:
+        - ids (List[str]): The ids of the embeddings
+        - embeddings (np.ndarray): The embeddings, (len(ids), dimensions)
+        - ivf_min_vectors (int): The size that triggers the training, 0 to never train
+
+        Returns:
+        - int: The number of new ids
+        """
+        embeddings = normalize(embeddings)
+        with self.lock:
+            new_ids = []
+            rows = []
+            for item_id in ids:
+                row = self.rows.get(item_id)
+                if row is None:
+                    row = self.count + len(new_ids)
+                    new_ids.append(item_id)
+                    self.rows[item_id] = row
+                rows.append(row)
+
+            self._reserve(self.count + len(new_ids))
+            self.vectors[rows] = embeddings.astype(self.dtype)
+            self.vectors.flush()
+            if self.ivf is not None:
+                self.lists[rows], self.codes[rows] = self.ivf.encode(embeddings)
+                self.lists.flush()
+                self.codes.flush()
+
+            with open(self._file(IDS_FILE), "a") as f:
+                f.writelines(json.dumps(item_id) + "\n" for item_id in new_ids)
+            self.ids.extend(new_ids)
+            self.count += len(new_ids)
+            self._inverted = None
+            self._save_meta()
+
+            if self.ivf is None and ivf_min_vectors and self.count >= ivf_min_vectors:
+                self._train()
+        return len(new_ids)
+
+    def train(self):
+        """
+        Train the IVF-PQ index again on the current vectors, the
+        number of lists grows with the square root of the size
+        """
+        with self.lock:
+            self._train()
+
+    def _train(self):
+        print(f"Training the IVF-PQ index {self.path} on {self.count} vectors")
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(rng.choice(self.count, min(self.count, TRAIN_SAMPLE), replace=False))
+        sample = np.asarray(self.vectors[sample_rows], dtype=np.float32)
+        ivf = IvfPq.train(sample, n_lists=max(1, int(4 * np.sqrt(self.count))))
+
+        capacity = self.vectors.shape[0]
+        lists = np.lib.format.open_memmap(self._file(LISTS_FILE), mode="w+", dtype=np.int32, shape=(capacity,))
+        codes = np.lib.format.open_memmap(
+            self._file(CODES_FILE), mode="w+", dtype=np.uint8, shape=(capacity, ivf.codebooks.shape[0]))
+        for start in range(0, self.count, BLOCK_ROWS):
+            end = min(start + BLOCK_ROWS, self.count)
+            lists[start:end], codes[start:end] = ivf.encode(np.asarray(self.vectors[start:end], dtype=np.float32))
+        lists.flush()
+        codes.flush()
+        np.savez(self._file(IVF_FILE), centroids=ivf.centroids, codebooks=ivf.codebooks)
+
+        self.ivf, self.lists, self.codes = ivf, lists, codes
+        self._inverted = None
+        self._save_meta()
+
+    def search(
+            self,
+            query: np.ndarray,
+            top_k: int,
+            nprobe: int,
+            exact: bool = False) -> Tuple[List[Tuple[str, float]], str]:
+        """
+        Find the embeddings most similar to `query`
+
+        Args:
+        - query (np.ndarray): The query embedding, normalized here
+        - top_k (int): The number of results
+        - nprobe (int): The number of lists scanned by the approximate search
+        - exact (bool): Whether to always search exactly
+
+        Returns:
+        - List[Tuple[str, float]]: The ids and cosine similarities, best first
+        - str: The search method used, `exact` or `ivfpq`
+        """
+        query = normalize(query)
+        # snapshot of the rows written so far
+        count, vectors, ivf, lists, codes = self.count, self.vectors, self.ivf, self.lists, self.codes
+        if exact or ivf is None:
+            rows, scores = self._search_exact(query, top_k, vectors, count)
+            method = "exact"
+        else:
+            rows, scores = self._search_ivf(query, top_k, nprobe, vectors, count, ivf, lists, codes)
+            method = "ivfpq"
+        return [(self.ids[row], float(score)) for row, score in zip(rows, scores)], method
+
+    def _search_exact(
+            self, query: np.ndarray, top_k: int, vectors: np.ndarray, count: int) -> Tuple[np.ndarray, np.ndarray]:
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, count, BLOCK_ROWS):
+            block = np.asarray(vectors[start:min(start + BLOCK_ROWS, count)], dtype=np.float32)
+            scores = block @ query
+            candidates = _top_k(scores, top_k)
+            best_rows = np.concatenate([best_rows, candidates + start])
+            best_scores = np.concatenate([best_scores, scores[candidates]])
+            keep = _top_k(best_scores, top_k)
+            best_rows, best_scores = best_rows[keep], best_scores[keep]
+        order = np.argsort(-best_scores)
+        return best_rows[order], best_scores[order]
+
+    def _search_ivf(
+            self,
+            query: np.ndarray,
+            top_k: int,
+            nprobe: int,
+            vectors: np.ndarray,
+            count: int,
+            ivf: IvfPq,
+            lists: np.ndarray,
+            codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        order, offsets = self._inverted_lists(lists, count, ivf.centroids.shape[0])
+        centroid_scores = ivf.centroids @ query
+        probed = _top_k(centroid_scores, nprobe)
+        candidates = np.concatenate([order[offsets[idx]:offsets[idx + 1]] for idx in probed])
+        if candidates.size == 0:
+            return candidates, np.empty(0, dtype=np.float32)
+
+        # query . (centroid + residual), the residual part from a lookup
+        # table of the query sub-vectors against every codebook entry
+        lookup = np.einsum("sd,scd->sc", query.reshape(-1, PQ_SUB_DIMENSIONS), ivf.codebooks)
+        candidate_codes = codes[candidates]
+        approximate = centroid_scores[lists[candidates]] + lookup[
+            np.arange(lookup.shape[0]), candidate_codes].sum(axis=1)
+
+        shortlist = np.sort(candidates[_top_k(approximate, top_k * RERANK_FACTOR)])
+        scores = np.asarray(vectors[shortlist], dtype=np.float32) @ query
+        best = _top_k(scores, top_k)
+        best = best[np.argsort(-scores[best])]
+        return shortlist[best], scores[best]
+
+    def _inverted_lists(self, lists: np.ndarray, count: int, n_lists: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Rows grouped by list, rebuilt after every write
+        """
+        inverted = self._inverted
+        if inverted is None or inverted[0].shape[0] != count:
+            assignments = np.asarray(lists[:count])
+            order = np.argsort(assignments, kind="stable")
+            offsets = np.searchsorted(assignments[order], np.arange(n_lists + 1))
+            inverted = (order, offsets)
+            self._inverted = inverted
+        return inverted
+
+    def info(self) -> dict:
+        return {
+            "model_name": self.model_name,
+            "dimensions": self.dimensions,
+            "dtype": self.dtype,
+            "count": self.count,
+            "approximate": self.ivf is not None,
+        }
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the `k` largest scores, in no particular order
+    """
+    if scores.shape[0] <= k:
+        return np.arange(scores.shape[0])
+    return np.argpartition(-scores, k)[:k]
+
+
+def _write_json(path: str, value: dict):
+    with open(path + ".tmp", "w") as f:
+        json.dump(value, f)
+    os.replace(path + ".tmp", path)
+
+
+class IndexStore():
+    """
+    The vector indexes stored under `index_dir`, one directory per
+    index. Indexes are opened on their first use and kept open
+    """
+    def __init__(self, index_dir: str, ivf_min_vectors: int, nprobe: int):
+        """
+        Constructor for the IndexStore class
+
+        Args:
+        - index_dir (str): The directory of the indexes
+        - ivf_min_vectors (int): The size that triggers the IVF-PQ training, 0 to never train
+        - nprobe (int): The default number of lists scanned by the approximate search
+        """
+        self.index_dir = index_dir
+        self.ivf_min_vectors = ivf_min_vectors
+        self.nprobe = nprobe
+        self.indexes: Dict[str, VectorIndex] = {}
+        self.lock = threading.Lock()
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.index_dir, name)
+
+    def get(self, name: str) -> Optional[VectorIndex]:
+        """
+        Get an index, None if it does not exist
+        """
+        with self.lock:
+            index = self.indexes.get(name)
+            if index is None and os.path.exists(os.path.join(self._path(name), META_FILE)):
+                index = self.indexes[name] = VectorIndex.load(self._path(name))
+            return index
+
+    def get_or_create(self, name: str, model_name: str, dimensions: int, dtype: str) -> VectorIndex:
+        """
+        Get an index, creating it if it does not exist
+        """
+        index = self.get(name)
+        if index is not None:
+            return index
+        with self.lock:
+            if name not in self.indexes:
+                self.indexes[name] = VectorIndex.create(self._path(name), model_name, dimensions, dtype)
+            return self.indexes[name]
+
+    def delete(self, name: str) -> bool:
+        """
+        Delete an index and its files
+
+        Returns:
+        - bool: Whether the index existed
+        """
+        with self.lock:
+            self.indexes.pop(name, None)
+            if not os.path.exists(self._path(name)):
+                return False
+            shutil.rmtree(self._path(name))
+            return True
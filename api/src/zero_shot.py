@@ -0,0 +1,215 @@
+"""
+Zero-shot classification in the API. The label and image features come
+from the embedding caches or from the inference workers, so scoring them
+is a matrix product and a softmax, run here rather than sent back to the
+workers as another job. Same as `CLIPModel.forward`, the features are
+normalized and the logits scaled by the learned temperature of the model.
+"""
+import json
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import redis.asyncio as redis
+
+import redis_models
+
+# Logit scale of the OpenAI CLIP checkpoints, clamped to 100 during
+# training, used until a worker of the model publishes its own
+DEFAULT_LOGIT_SCALE = 100.0
+# Number of labels scored at once when only the top-k labels are requested
+LABEL_CHUNK_SIZE = 4096
+# Number of label sets kept in memory by every API process
+MAX_CACHED_LABEL_SETS = 16
+
+
+def normalize(embeddings: np.ndarray) -> np.ndarray:
+    """
+    L2 normalize the rows of a matrix
+    """
+    return embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+
+def _logsumexp(logits: np.ndarray) -> np.ndarray:
+    top = logits.max(axis=1, keepdims=True)
+    return (top + np.log(np.exp(logits - top).sum(axis=1, keepdims=True)))[:, 0]
+
+
+def classify(
+        image_embeds: np.ndarray,
+        label_embeds: np.ndarray,
+        logit_scale: float,
+        top_k: Optional[int] = None,
+        chunk_size: int = LABEL_CHUNK_SIZE) -> Tuple[Optional[np.ndarray], np.ndarray]:
+    """
+    Compute the softmax scores of normalized image embeddings over
+    normalized label embeddings. With `top_k` the labels are scored in
+    chunks keeping a running log-sum-exp and the best candidates, so
+    the full (images x labels) matrix is never materialized
+
+    Args:
+    - image_embeds (np.ndarray): The normalized image embeddings, (n_images, dim)
+    - label_embeds (np.ndarray): The normalized label embeddings, (n_labels, dim)
+    - logit_scale (float): The learned temperature, already exponentiated
+    - top_k (Optional[int]): The number of best labels to keep, None for all
+    - chunk_size (int): The number of labels scored at once
+
+    Returns:
+    - Optional[np.ndarray]: The indices of the best labels, (n_images, k),
+        None when `top_k` is None
+    - np.ndarray: The softmax scores, (n_images, k) or (n_images, n_labels)
+    """
+    if top_k is None:
+        logits = logit_scale * image_embeds @ label_embeds.T
+        return None, np.exp(logits - _logsumexp(logits)[:, None])
+
+    n_images, n_labels = image_embeds.shape[0], label_embeds.shape[0]
+    k = min(top_k, n_labels)
+
+    log_sum_exp = np.full((n_images,), -np.inf, dtype=np.float32)
+    best_logits = np.empty((n_images, 0), dtype=np.float32)
+    best_indices = np.empty((n_images, 0), dtype=np.int64)
+
+    for start in range(0, n_labels, chunk_size):
+        logits = logit_scale * image_embeds @ label_embeds[start:start + chunk_size].T
+        log_sum_exp = np.logaddexp(log_sum_exp, _logsumexp(logits))
+
+        chunk_indices = np.broadcast_to(np.arange(start, start + logits.shape[1]), logits.shape)
+        candidate_logits = np.concatenate([best_logits, logits], axis=1)
+        candidate_indices = np.concatenate([best_indices, chunk_indices], axis=1)
+
+        order = np.argsort(-candidate_logits, axis=1, kind="stable")[:, :k]
+        best_logits = np.take_along_axis(candidate_logits, order, axis=1)
+        best_indices = np.take_along_axis(candidate_indices, order, axis=1)
+
+    return best_indices, np.exp(best_logits - log_sum_exp[:, None])
+
+
+def classification_response(
+        model_name: str,
+        labels: List[str],
+        label_embeds: np.ndarray,
+        images_embedding: List[redis_models.RedisImageEmbedding],
+        logit_scale: float,
+        top_k: Optional[int] = None,
+        return_labels_embedding: bool = True) -> redis_models.RedisResponseItem:
+    """
+    Classify images against labels, with the response an inference
+    worker gives to a classification job
+
+    Args:
+    - model_name (str): The CLIP model of the features
+    - labels (List[str]): The labels
+    - label_embeds (np.ndarray): The normalized label embeddings, (n_labels, dim)
+    - images_embedding (List[RedisImageEmbedding]): The packed image features
+    - logit_scale (float): The learned temperature of the model, already exponentiated
+    - top_k (Optional[int]): The number of best labels of every image, None for all
+    - return_labels_embedding (bool): Whether the label embeddings are returned,
+        not for registered label sets as they can be thousands
+
+    Returns:
+    - RedisResponseItem: The normalized embeddings and the classification result
+    """
+    response = redis_models.RedisResponseItem(model_name=model_name)
+    if return_labels_embedding:
+        response.text_embeddings = [
+            redis_models.RedisTextEmbedding(text=label, embedding=embedding)
+            for label, embedding in zip(labels, redis_models.pack_embeddings(label_embeds))]
+
+    image_embeds = normalize(np.stack([
+        redis_models.unpack_embedding(item.embedding) for item in images_embedding]))
+    indices, probs = classify(image_embeds, label_embeds, logit_scale, top_k)
+    probs = probs.tolist()
+
+    response.image_embeddings = [
+        redis_models.RedisImageEmbedding(image_id=item.image_id, embedding=embedding)
+        for item, embedding in zip(images_embedding, redis_models.pack_embeddings(image_embeds))]
+
+    if indices is None:
+        softmax_outputs = [
+            redis_models.SoftmaxOutput(image_id=item.image_id, softmax_scores=probs[idx])
+            for idx, item in enumerate(images_embedding)]
+    else:
+        # With top_k every image has its own labels, the
+        # full list of labels is not returned
+        softmax_outputs = [
+            redis_models.SoftmaxOutput(
+                image_id=item.image_id,
+                softmax_scores=probs[idx],
+                labels=[labels[label_idx] for label_idx in indices[idx].tolist()])
+            for idx, item in enumerate(images_embedding)]
+        labels = []
+
+    response.classification_result = redis_models.ClassificationResult(
+        labels=labels,
+        softmax_outputs=softmax_outputs)
+    return response
+
+
+class ZeroShotStore():
+    """
+    Reads from Redis what the API needs to score zero-shot classifications:
+    the logit scale of every model, published by the inference workers,
+    and the registered label sets. Both are kept in memory, the label
+    sets by version and only the most recently used ones
+    """
+    def __init__(self, redis_client: redis.Redis):
+        """
+        Constructor for the ZeroShotStore class
+
+        Args:
+        - redis_client (redis.Redis): The Redis client
+        """
+        self.redis_client = redis_client
+        self.logit_scales: Dict[str, float] = {}
+        self.label_sets: OrderedDict = OrderedDict()
+
+    async def logit_scale(self, model_name: str) -> float:
+        """
+        Get the learned temperature of a model, already exponentiated
+
+        Args:
+        - model_name (str): The name of the CLIP model
+
+        Returns:
+        - float: The logit scale, `DEFAULT_LOGIT_SCALE` until a worker publishes it
+        """
+        if model_name in self.logit_scales:
+            return self.logit_scales[model_name]
+
+        value = await self.redis_client.hget(redis_models.LOGIT_SCALES_KEY, model_name)
+        if value is None:
+            return DEFAULT_LOGIT_SCALE
+        self.logit_scales[model_name] = float(value)
+        return self.logit_scales[model_name]
+
+    async def label_set(self, ref: redis_models.RedisLabelSetRef) -> Tuple[List[str], np.ndarray]:
+        """
+        Get a label set, reading it from Redis if not cached
+
+        Args:
+        - ref (RedisLabelSetRef): The label set
+
+        Returns:
+        - List[str]: The labels
+        - np.ndarray: The normalized label embeddings, (n_labels, dim)
+
+        Raises:
+        - KeyError: If the label set does not exist or was registered again
+        """
+        cache_key = (ref.key, ref.version)
+        if cache_key in self.label_sets:
+            self.label_sets.move_to_end(cache_key)
+            return self.label_sets[cache_key]
+
+        labels, embeddings, version = await self.redis_client.hmget(ref.key, ["labels", "embeddings", "version"])
+        if version is None or (version.decode() if isinstance(version, bytes) else version) != ref.version:
+            raise KeyError(f"Label set {ref.key} version {ref.version} not found")
+
+        labels = json.loads(labels)
+        label_embeds = np.frombuffer(embeddings, dtype="<f4").reshape(len(labels), -1)
+
+        self.label_sets[cache_key] = (labels, label_embeds)
+        while len(self.label_sets) > MAX_CACHED_LABEL_SETS:
+            self.label_sets.popitem(last=False)
+        return labels, label_embeds
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the API modules are flat in src, as when run by uvicorn
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
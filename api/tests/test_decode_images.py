@@ -0,0 +1,39 @@
+import asyncio
+import base64
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import api
+from api import decode_images
+
+IMAGE_BYTES = b"\x89PNG\r\n\x1a\n not really a png"
+IMAGE_B64 = base64.b64encode(IMAGE_BYTES).decode()
+
+
+def test_decode_plain_and_data_uri():
+    images = decode_images([IMAGE_B64, "data:image/png;base64," + IMAGE_B64])
+
+    assert images == [IMAGE_BYTES, IMAGE_BYTES]
+
+
+@pytest.mark.parametrize("image_b64", ["@@@", "data:image/png;base64,@@@", "abcde", IMAGE_B64 + "!"])
+def test_invalid_base64_is_rejected(image_b64):
+    with pytest.raises(HTTPException) as e:
+        decode_images([IMAGE_B64, image_b64])
+
+    assert e.value.status_code == 400
+    assert "Image 1" in e.value.detail
+
+
+def test_embed_images_answers_400():
+    async def post():
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/embed-images", json={"image_b64": ["data:image/png;base64,@@@"]})
+
+    response = asyncio.run(post())
+
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Image 0 is not valid base64"
@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+import httpx
+import numpy as np
+
+import api
+import redis_models
+
+
+async def fake_embed_texts(texts, model_name, deadline, priority):
+    embeddings = np.ones((len(texts), 4), dtype=np.float32)
+    return [
+        redis_models.RedisTextEmbedding(text=text, embedding=embedding)
+        for text, embedding in zip(texts, redis_models.pack_embeddings(embeddings))]
+
+
+async def post_stream(content) -> httpx.Response:
+    transport = httpx.ASGITransport(app=api.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        # the transport ignores the client timeouts, a body that is never
+        # read must fail the test rather than hang it
+        return await asyncio.wait_for(client.post("/embed/stream", content=content), timeout=10)
+
+
+def test_embed_stream_answers_every_line(monkeypatch):
+    monkeypatch.setattr(api, "embed_texts", fake_embed_texts)
+    monkeypatch.setattr(api, "stream_chunk_size", 8)
+    lines = [json.dumps({"text": f"text {idx}", "id": idx}) for idx in range(50)]
+    lines.append(json.dumps({"image_b64": "@@@", "id": "image"}))
+    lines.append("not json")
+
+    async def body():
+        # sent in several chunks, as a client streaming its input
+        for line in lines:
+            yield (line + "\n").encode()
+
+    response = asyncio.run(post_stream(body()))
+
+    assert response.status_code == 200
+    output = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(line["index"] for line in output) == list(range(len(lines)))
+    by_index = {line["index"]: line for line in output}
+    for idx in range(50):
+        assert by_index[idx]["id"] == idx
+        assert by_index[idx]["embedding"] == [1.0] * 4
+    assert by_index[50]["error"] == "Invalid base64 image"
+    assert by_index[51]["error"].startswith("Invalid JSON")
+
+
+def test_embed_stream_single_body(monkeypatch):
+    monkeypatch.setattr(api, "embed_texts", fake_embed_texts)
+    body = "".join(json.dumps({"text": f"text {idx}"}) + "\n" for idx in range(3))
+
+    response = asyncio.run(post_stream(body))
+
+    assert response.status_code == 200
+    assert len(response.text.splitlines()) == 3
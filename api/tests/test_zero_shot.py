@@ -0,0 +1,76 @@
+import asyncio
+
+import fakeredis
+import httpx
+import numpy as np
+
+import api
+import redis_models
+from zero_shot import ZeroShotStore, classify, normalize
+
+DIM = 8
+
+
+def random_embeds(rng: np.random.Generator, rows: int) -> np.ndarray:
+    return normalize(rng.standard_normal((rows, DIM)).astype(np.float32))
+
+
+def test_classify_scores_are_a_softmax():
+    rng = np.random.default_rng(0)
+    image_embeds, label_embeds = random_embeds(rng, 3), random_embeds(rng, 5)
+
+    indices, probs = classify(image_embeds, label_embeds, 100.0)
+
+    assert indices is None
+    logits = 100.0 * image_embeds @ label_embeds.T
+    expected = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    np.testing.assert_allclose(probs, expected, rtol=1e-4, atol=1e-6)
+
+
+def test_classify_top_k_in_chunks_matches_the_full_softmax():
+    rng = np.random.default_rng(1)
+    image_embeds, label_embeds = random_embeds(rng, 4), random_embeds(rng, 50)
+
+    _, full = classify(image_embeds, label_embeds, 100.0)
+    indices, probs = classify(image_embeds, label_embeds, 100.0, top_k=3, chunk_size=7)
+
+    np.testing.assert_array_equal(indices, np.argsort(-full, axis=1)[:, :3])
+    np.testing.assert_allclose(probs, np.take_along_axis(full, indices, axis=1), rtol=1e-4, atol=1e-6)
+
+
+def test_zero_shot_is_scored_without_a_job(monkeypatch):
+    rng = np.random.default_rng(2)
+    label_embeds, image_embeds = random_embeds(rng, 2), random_embeds(rng, 1)
+
+    async def fake_embed_texts(texts, model_name, deadline, priority):
+        return [
+            redis_models.RedisTextEmbedding(text=text, embedding=embedding)
+            for text, embedding in zip(texts, redis_models.pack_embeddings(label_embeds))]
+
+    async def fake_embed_images(images_data, model_name, deadline, priority):
+        return [redis_models.RedisImageEmbedding(
+            image_id="image", embedding=redis_models.pack_embeddings(image_embeds)[0])], []
+
+    redis_client = fakeredis.FakeAsyncRedis()
+    # the API must not enqueue any job, redis_helper is not set
+    monkeypatch.setattr(api, "embed_texts", fake_embed_texts)
+    monkeypatch.setattr(api, "embed_images", fake_embed_images)
+    monkeypatch.setattr(api, "zero_shot_store", ZeroShotStore(redis_client))
+
+    async def post():
+        await redis_client.hset(redis_models.LOGIT_SCALES_KEY, api.clip_model_names[0], 50.0)
+        transport = httpx.ASGITransport(app=api.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/zero-shot-classification", json={
+                "labels": ["cat", "dog"],
+                "images_b64": ["aW1hZ2U="]})
+
+    response = asyncio.run(post())
+
+    assert response.status_code == 200
+    result = response.json()
+    logits = 50.0 * image_embeds @ label_embeds.T
+    expected = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    scores = result["classification_result"]["softmax_outputs"][0]["softmax_scores"]
+    np.testing.assert_allclose(scores, expected[0], rtol=1e-4, atol=1e-6)
+    assert result["classification_result"]["labels"] == ["cat", "dog"]
@@ -0,0 +1,80 @@
+"""
+Baselines of the benchmark, the summary of every scenario stored as
+JSON, and the comparison of a run with them. A run regresses when its
+throughput drops, or its p95 or p99 latency grows, by more than the
+threshold. Baselines only compare with runs of the same settings on
+the same machine.
+"""
+import json
+import platform
+import time
+from typing import Dict, List
+
+from load import ScenarioResult
+
+BASELINE_VERSION = 1
+
+
+def save_baseline(path: str, results: List[ScenarioResult], settings: Dict):
+    """
+    Store the results of a run as a baseline
+
+    Args:
+    - path (str): The JSON file
+    - results (List[ScenarioResult]): The results of the run
+    - settings (Dict): The settings the run depends on, e.g. the size of the requests
+    """
+    baseline = {
+        "version": BASELINE_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"platform": platform.platform(), "processor": platform.processor()},
+        "settings": settings,
+        "results": {result.key: result.summary() for result in results},
+    }
+    with open(path, "w") as f:
+        json.dump(baseline, f, indent=2)
+
+
+def load_baseline(path: str) -> Dict:
+    """
+    Read a baseline stored by `save_baseline`
+
+    Raises:
+    - ValueError: If the file is not a baseline of this version
+    """
+    with open(path) as f:
+        baseline = json.load(f)
+    if baseline.get("version") != BASELINE_VERSION:
+        raise ValueError(f"{path} is not a version {BASELINE_VERSION} baseline")
+    return baseline
+
+
+def compare(results: List[ScenarioResult], baseline: Dict, threshold: float) -> List[str]:
+    """
+    Compare the results of a run with a baseline
+
+    Args:
+    - results (List[ScenarioResult]): The results of the run
+    - baseline (Dict): The baseline, from `load_baseline`
+    - threshold (float): The accepted relative change, e.g. 0.2 for 20%
+
+    Returns:
+    - List[str]: The regressions, empty if none
+    """
+    regressions = []
+    for result in results:
+        expected = baseline["results"].get(result.key)
+        if expected is None:
+            continue
+        current = result.summary()
+
+        if current["requests_per_s"] < expected["requests_per_s"] * (1 - threshold):
+            regressions.append(
+                f"{result.key}: {current['requests_per_s']:.1f} requests/s, "
+                f"baseline {expected['requests_per_s']:.1f}")
+        for percentile in ("p95_ms", "p99_ms"):
+            if current[percentile] > expected[percentile] * (1 + threshold):
+                regressions.append(
+                    f"{result.key}: {percentile[:3]} {current[percentile]:.1f} ms, "
+                    f"baseline {expected[percentile]:.1f} ms")
+    return regressions
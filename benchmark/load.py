@@ -0,0 +1,116 @@
+"""
+Closed loop load generator: `concurrency` clients send the requests of a
+scenario back to back, each waiting for its response before sending the
+next one. Reports the throughput and the latency percentiles, and the
+mean time the jobs spent in every stage from the `Server-Timing` header.
+"""
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+import httpx
+import numpy as np
+
+from scenarios import BenchmarkRequest
+
+
+@dataclass
+class ScenarioResult:
+    """
+    The measures of a scenario at a given concurrency
+    """
+    scenario: str
+    concurrency: int
+    requests: int = 0
+    errors: int = 0
+    items: int = 0
+    duration_s: float = 0.0
+    latencies_ms: List[float] = field(default_factory=list)
+    stages_ms: Dict[str, List[float]] = field(default_factory=dict)
+    error_samples: List[str] = field(default_factory=list)
+
+    @property
+    def key(self) -> str:
+        return f"{self.scenario}@{self.concurrency}"
+
+    def summary(self) -> Dict[str, float]:
+        """
+        The measures stored in the baselines, latencies in milliseconds
+        """
+        p50, p95, p99 = np.percentile(self.latencies_ms, [50, 95, 99]) if self.latencies_ms else (0, 0, 0)
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "requests_per_s": self.requests / self.duration_s if self.duration_s else 0.0,
+            "items_per_s": self.items / self.duration_s if self.duration_s else 0.0,
+            "p50_ms": float(p50),
+            "p95_ms": float(p95),
+            "p99_ms": float(p99),
+            "stages_ms": {stage: float(np.mean(values)) for stage, values in self.stages_ms.items()},
+        }
+
+
+def parse_server_timing(value: str) -> Dict[str, float]:
+    """
+    Parse a `Server-Timing` header, e.g. `queue;dur=1.2, forward;dur=8.5`
+    """
+    stages = {}
+    for metric in value.split(","):
+        name, _, params = metric.strip().partition(";")
+        for param in params.split(";"):
+            key, _, duration = param.strip().partition("=")
+            if key == "dur":
+                try:
+                    stages[name] = float(duration)
+                except ValueError:
+                    pass
+    return stages
+
+
+async def run_load(
+        client: httpx.AsyncClient,
+        scenario: str,
+        requests: List[BenchmarkRequest],
+        concurrency: int) -> ScenarioResult:
+    """
+    Send `requests` with `concurrency` clients
+
+    Args:
+    - client (httpx.AsyncClient): The client of the API
+    - scenario (str): The name of the scenario
+    - requests (List[BenchmarkRequest]): The requests, sent in order
+    - concurrency (int): The number of requests in flight
+
+    Returns:
+    - ScenarioResult: The measures, only successful requests count in the latencies
+    """
+    result = ScenarioResult(scenario=scenario, concurrency=concurrency)
+    pending = iter(requests)
+
+    async def client_loop():
+        for request in pending:
+            start = time.perf_counter()
+            try:
+                response = await client.post(request.path, json=request.payload)
+            except httpx.HTTPError as e:
+                response, error = None, f"{type(e).__name__}: {e}"
+            else:
+                error = None if response.status_code == 200 else f"{response.status_code}: {response.text[:200]}"
+            latency_ms = (time.perf_counter() - start) * 1000
+
+            result.requests += 1
+            if error is not None:
+                result.errors += 1
+                if len(result.error_samples) < 5:
+                    result.error_samples.append(error)
+                continue
+            result.items += request.items
+            result.latencies_ms.append(latency_ms)
+            for stage, duration in parse_server_timing(response.headers.get("server-timing", "")).items():
+                result.stages_ms.setdefault(stage, []).append(duration)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    result.duration_s = time.perf_counter() - start
+    return result
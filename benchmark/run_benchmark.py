@@ -0,0 +1,214 @@
+"""
+Throughput and latency benchmark of ClipServe, runnable offline on a CPU.
+Starts a local Redis, the inference workers and the API, serving a tiny
+randomly initialized CLIP model stored in a temporary Hugging Face cache,
+then sends the traffic of every scenario at every concurrency. Reports
+the requests and items per second and the p50/p95/p99 latency, stores
+them as a JSON baseline and exits with an error when a run regresses
+from a baseline by more than `--threshold`.
+
+The tiny model makes the serving overhead (HTTP, Redis, batching,
+preprocessing) visible, not the speed of the real models. Run it from
+the repository root with the dependencies of the API and the inference
+worker installed, e.g.:
+
+    python3 benchmark/run_benchmark.py --save-baseline baseline.json
+    python3 benchmark/run_benchmark.py --baseline baseline.json --threshold 0.2
+"""
+import argparse
+import asyncio
+import dataclasses
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import httpx
+
+from baseline import compare, load_baseline, save_baseline
+from load import ScenarioResult, run_load
+from scenarios import SCENARIOS, TEXT_SCENARIO, TrafficSettings, build_requests
+from services import LocalRedis, check_alive, free_port, service_env, start_api, start_workers, stop_process
+from tiny_clip import create_offline_cache
+
+# Any of the names accepted by the API and the workers, the
+# weights stored under it are the tiny ones
+MODEL_NAME = "openai/clip-vit-base-patch32"
+
+
+def parse_env(values: List[str]) -> Dict[str, str]:
+    """
+    Parse `KEY=VALUE` arguments
+    """
+    env = {}
+    for value in values:
+        key, sep, env_value = value.partition("=")
+        if not sep or not key:
+            raise SystemExit(f"Invalid environment variable {value}, expected KEY=VALUE")
+        env[key] = env_value
+    return env
+
+
+async def wait_until_serving(
+        client: httpx.AsyncClient,
+        processes: List,
+        log_dir: str,
+        timeout_s: float,
+        settings: TrafficSettings):
+    """
+    Wait for the API to answer a text request, which needs
+    a worker to have loaded the model
+    """
+    deadline = time.time() + timeout_s
+    warmup = build_requests(TEXT_SCENARIO, 1, settings, offset=-1)[0]
+    while time.time() < deadline:
+        check_alive(processes, log_dir)
+        try:
+            response = await client.post(warmup.path, json=warmup.payload)
+            if response.status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError(f"The services did not answer within {timeout_s} s, see the logs in {log_dir}")
+
+
+def print_result(result: ScenarioResult):
+    summary = result.summary()
+    print(
+        f"{result.scenario:<11}{result.concurrency:>6}{result.requests:>9}{result.errors:>8}"
+        f"{summary['requests_per_s']:>10.1f}{summary['items_per_s']:>11.1f}"
+        f"{summary['p50_ms']:>10.1f}{summary['p95_ms']:>10.1f}{summary['p99_ms']:>10.1f}")
+    if summary["stages_ms"]:
+        stages = ", ".join(f"{stage} {ms:.1f}" for stage, ms in summary["stages_ms"].items())
+        print(f"{'':<17}mean ms per request: {stages}")
+    for error in result.error_samples:
+        print(f"{'':<17}error: {error}")
+
+
+async def run_scenarios(args, settings: TrafficSettings, api_url: str, processes: List, log_dir: str) -> List[ScenarioResult]:
+    """
+    Run every scenario at every concurrency, after their warmup requests
+    """
+    timeout = httpx.Timeout(args.request_timeout_s)
+    limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+    async with httpx.AsyncClient(base_url=api_url, timeout=timeout, limits=limits) as client:
+        await wait_until_serving(client, processes, log_dir, args.startup_timeout_s, settings)
+
+        print(f"{'scenario':<11}{'conc.':>6}{'requests':>9}{'errors':>8}{'req/s':>10}{'items/s':>11}"
+              f"{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        results = []
+        run_idx = 0
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                # Every run has its own inputs, never answered by the caches
+                offset = run_idx * (args.requests + args.warmup)
+                run_idx += 1
+                requests = build_requests(scenario, args.warmup + args.requests, settings, offset)
+                if args.warmup:
+                    await run_load(client, scenario, requests[:args.warmup], concurrency)
+                result = await run_load(client, scenario, requests[args.warmup:], concurrency)
+                check_alive(processes, log_dir)
+                print_result(result)
+                results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the throughput and latency of ClipServe")
+    parser.add_argument("--scenarios", nargs="+", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8], help="Requests in flight")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario and concurrency")
+    parser.add_argument("--warmup", type=int, default=10, help="Untimed requests before every run")
+    parser.add_argument("--texts-per-request", type=int, default=8)
+    parser.add_argument("--images-per-request", type=int, default=4)
+    parser.add_argument("--image-size", type=int, default=256, help="Side of the images sent, in pixels")
+    parser.add_argument("--labels", type=int, default=10, help="Labels of the zero-shot requests")
+    parser.add_argument("--workers", type=int, default=1, help="Inference workers started")
+    parser.add_argument("--worker-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Environment variable of the workers, e.g. MAX_BATCH_SIZE=64")
+    parser.add_argument("--api-env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Environment variable of the API, e.g. IMAGE_DOWNSCALE=False")
+    parser.add_argument("--redis-url", help="An existing Redis server, one is started if not set")
+    parser.add_argument("--redis-server", default="redis-server",
+                        help="The redis-server binary started, fakeredis is used if not found")
+    parser.add_argument("--baseline", help="JSON baseline to compare with")
+    parser.add_argument("--save-baseline", help="JSON file to store the results as a baseline")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="Accepted relative drop of throughput or growth of p95/p99 latency")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup-timeout-s", type=float, default=300)
+    parser.add_argument("--request-timeout-s", type=float, default=60)
+    parser.add_argument("--keep-logs", action="store_true", help="Keep the logs of the services")
+    args = parser.parse_args()
+
+    if min(args.concurrency) < 1 or args.requests < 1 or args.workers < 1:
+        raise SystemExit("--concurrency, --requests and --workers must be positive")
+
+    settings = TrafficSettings(
+        texts_per_request=args.texts_per_request,
+        images_per_request=args.images_per_request,
+        image_size=args.image_size,
+        labels=args.labels,
+        seed=args.seed)
+    run_settings = {
+        **dataclasses.asdict(settings),
+        "requests": args.requests,
+        "workers": args.workers,
+        "worker_env": parse_env(args.worker_env),
+        "api_env": parse_env(args.api_env),
+    }
+
+    baseline = load_baseline(args.baseline) if args.baseline else None
+
+    work_dir = tempfile.mkdtemp(prefix="clipserve-benchmark-")
+    log_dir = os.path.join(work_dir, "logs")
+    os.makedirs(log_dir)
+    hf_home = os.path.join(work_dir, "huggingface")
+    create_offline_cache(hf_home, MODEL_NAME, seed=args.seed)
+
+    processes = []
+    with LocalRedis(args.redis_url, args.redis_server, log_dir) as redis:
+        run_settings["redis"] = redis.kind
+        try:
+            worker_env = service_env(redis, hf_home, work_dir, MODEL_NAME, run_settings["worker_env"])
+            processes.extend(start_workers(args.workers, worker_env, log_dir))
+            api_port = free_port()
+            api_env = service_env(redis, hf_home, work_dir, MODEL_NAME, run_settings["api_env"])
+            processes.append(start_api(api_port, api_env, log_dir))
+
+            print(f"Benchmarking {args.workers} workers with {redis.kind} Redis, logs in {log_dir}")
+            results = asyncio.run(run_scenarios(args, settings, f"http://127.0.0.1:{api_port}", processes, log_dir))
+        finally:
+            for process in processes:
+                stop_process(process)
+
+    if args.save_baseline:
+        save_baseline(args.save_baseline, results, run_settings)
+        print(f"Stored the baseline in {args.save_baseline}")
+
+    failed = False
+    errors = sum(result.errors for result in results)
+    if errors:
+        print(f"{errors} requests failed")
+        failed = True
+    if baseline is not None:
+        if baseline["settings"] != run_settings:
+            print(f"Warning: {args.baseline} was run with different settings: {baseline['settings']}")
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            failed = True
+        else:
+            print(f"No regression above {args.threshold:.0%} from {args.baseline}")
+
+    if not args.keep_logs and not failed:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
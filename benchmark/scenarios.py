@@ -0,0 +1,120 @@
+"""
+The traffic of the benchmark scenarios. Every request has its own texts
+and images, so that the embedding caches of the API do not answer them,
+except for the labels of the zero-shot requests which repeat as in real
+traffic. The requests are built before the load starts, so that the
+client does not compete with the services for the CPU while timed.
+"""
+import base64
+import io
+import random
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+import numpy as np
+from PIL import Image
+
+TEXT_SCENARIO = "text"
+IMAGES_SCENARIO = "images"
+MIXED_SCENARIO = "mixed"
+ZERO_SHOT_SCENARIO = "zero-shot"
+SCENARIOS = [TEXT_SCENARIO, IMAGES_SCENARIO, MIXED_SCENARIO, ZERO_SHOT_SCENARIO]
+
+WORDS = [
+    "a", "photo", "of", "the", "small", "large", "red", "blue", "green", "old", "young",
+    "cat", "dog", "bird", "car", "bike", "tree", "house", "street", "beach", "mountain",
+    "sitting", "running", "sleeping", "next", "to", "on", "in", "under", "near", "with",
+]
+LABELS = [
+    "cat", "dog", "bird", "car", "bicycle", "tree", "house", "street", "beach", "mountain",
+    "boat", "train", "person", "flower", "horse", "chair", "table", "computer", "phone", "book",
+]
+
+
+@dataclass
+class BenchmarkRequest:
+    """
+    A request of a scenario, `items` is the number of texts
+    and images it embeds, used for the items per second
+    """
+    path: str
+    payload: Dict
+    items: int
+
+
+@dataclass
+class TrafficSettings:
+    """
+    The size of the requests of all the scenarios
+    """
+    texts_per_request: int = 8
+    images_per_request: int = 4
+    image_size: int = 256
+    labels: int = 10
+    seed: int = 0
+
+
+def random_text(rng: random.Random, idx: int) -> str:
+    # the index keeps the text unique across the requests
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 12))) + f" #{idx}"
+
+
+def random_image_b64(rng: random.Random, size: int) -> str:
+    """
+    A JPEG of random blocks, larger than the input of the served
+    models so that the API downscales it as it would a photo
+    """
+    blocks = np.random.default_rng(rng.getrandbits(32)).integers(0, 256, (8, 8, 3), dtype=np.uint8)
+    image = Image.fromarray(blocks).resize((size, size), Image.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode()
+
+
+def text_request(rng: random.Random, idx: int, settings: TrafficSettings) -> BenchmarkRequest:
+    texts = [random_text(rng, idx * settings.texts_per_request + n) for n in range(settings.texts_per_request)]
+    return BenchmarkRequest("/embed-text", {"text": texts}, len(texts))
+
+
+def images_request(rng: random.Random, idx: int, settings: TrafficSettings) -> BenchmarkRequest:
+    images = [random_image_b64(rng, settings.image_size) for _ in range(settings.images_per_request)]
+    return BenchmarkRequest("/embed-images", {"image_b64": images}, len(images))
+
+
+def mixed_request(rng: random.Random, idx: int, settings: TrafficSettings) -> BenchmarkRequest:
+    if rng.random() < 0.5:
+        return text_request(rng, idx, settings)
+    return images_request(rng, idx, settings)
+
+
+def zero_shot_request(rng: random.Random, idx: int, settings: TrafficSettings) -> BenchmarkRequest:
+    images = [random_image_b64(rng, settings.image_size) for _ in range(settings.images_per_request)]
+    payload = {"labels": LABELS[:settings.labels], "images_b64": images}
+    return BenchmarkRequest("/zero-shot-classification", payload, len(images))
+
+
+SCENARIO_BUILDERS: Dict[str, Callable[[random.Random, int, TrafficSettings], BenchmarkRequest]] = {
+    TEXT_SCENARIO: text_request,
+    IMAGES_SCENARIO: images_request,
+    MIXED_SCENARIO: mixed_request,
+    ZERO_SHOT_SCENARIO: zero_shot_request,
+}
+
+
+def build_requests(scenario: str, count: int, settings: TrafficSettings, offset: int = 0) -> List[BenchmarkRequest]:
+    """
+    Build the requests of a scenario
+
+    Args:
+    - scenario (str): One of `SCENARIOS`
+    - count (int): The number of requests
+    - settings (TrafficSettings): The size of the requests
+    - offset (int): The index of the first request, runs with different
+        offsets never send the same texts
+
+    Returns:
+    - List[BenchmarkRequest]: The requests, the same for the same settings
+    """
+    rng = random.Random(f"{settings.seed}:{scenario}:{offset}")
+    builder = SCENARIO_BUILDERS[scenario]
+    return [builder(rng, offset + idx, settings) for idx in range(count)]
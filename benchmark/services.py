@@ -0,0 +1,180 @@
+"""
+The services driven by the benchmark, each in its own process as in the
+compose deployment: a local Redis, the inference workers and the API.
+The API and the workers are the unchanged `api/src/api.py` and
+`inference/src/inference.py`, configured with their environment variables.
+"""
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+import httpx
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+API_DIR = os.path.join(REPO_DIR, "api")
+INFERENCE_DIR = os.path.join(REPO_DIR, "inference")
+
+
+def free_port() -> int:
+    """
+    Get a TCP port nobody listens on
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class LocalRedis():
+    """
+    The Redis server shared by the API and the workers. Either an
+    existing server, a `redis-server` started on a free port, or, when
+    the binary is not available, a fakeredis server in this process.
+    fakeredis does not block on the stream reads, so the idle workers
+    poll it and the results are only comparable with other fakeredis runs
+    """
+    def __init__(self, url: Optional[str] = None, redis_server: str = "redis-server", log_dir: str = "."):
+        """
+        Constructor for the LocalRedis class
+
+        Args:
+        - url (Optional[str]): The URL of an existing server, e.g. `redis://localhost:6379`
+        - redis_server (str): The `redis-server` binary to start when `url` is not set
+        - log_dir (str): The directory of the server log
+        """
+        self.url = url
+        self.redis_server = redis_server
+        self.log_dir = log_dir
+        self.host = "127.0.0.1"
+        self.port = 0
+        self.kind = "existing"
+        self.process: Optional[subprocess.Popen] = None
+        self.fake_server = None
+
+    def __enter__(self) -> "LocalRedis":
+        if self.url is not None:
+            parsed = httpx.URL(self.url)
+            self.host, self.port = parsed.host, parsed.port or 6379
+            return self
+
+        self.port = free_port()
+        binary = shutil.which(self.redis_server)
+        if binary is not None:
+            self.kind = "redis-server"
+            with open(os.path.join(self.log_dir, "redis.log"), "w") as log_file:
+                self.process = subprocess.Popen(
+                    [binary, "--port", str(self.port), "--bind", self.host, "--save", "", "--appendonly", "no"],
+                    stdout=log_file, stderr=subprocess.STDOUT)
+            self._wait_ready()
+            return self
+
+        from fakeredis import TcpFakeServer
+        print(f"{self.redis_server} not found, using fakeredis")
+        self.kind = "fakeredis"
+        self.fake_server = TcpFakeServer((self.host, self.port))
+        # the connections of the services must not keep this process alive
+        self.fake_server.daemon_threads = True
+        threading.Thread(target=self.fake_server.serve_forever, daemon=True).start()
+        self._wait_ready()
+        return self
+
+    def _wait_ready(self, timeout_s: float = 10):
+        deadline = time.time() + timeout_s
+        while time.time() < deadline:
+            try:
+                with socket.create_connection((self.host, self.port), timeout=1):
+                    return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError(f"Redis did not start on port {self.port}")
+
+    def __exit__(self, *exc):
+        if self.process is not None:
+            stop_process(self.process)
+        if self.fake_server is not None:
+            self.fake_server.shutdown()
+
+
+def service_env(
+        redis: LocalRedis,
+        hf_home: str,
+        work_dir: str,
+        model_name: str,
+        overrides: Dict[str, str]) -> Dict[str, str]:
+    """
+    The environment of the API and of the workers: the local Redis, the
+    offline model cache and the CPU, then the `overrides` of the user
+    """
+    env = dict(os.environ)
+    env.update({
+        "REDIS_HOST": redis.host,
+        "REDIS_PORT": str(redis.port),
+        # eviction does not matter for the short runs, the embedding
+        # cache shares the server of the jobs
+        "CACHE_REDIS_HOST": redis.host,
+        "CACHE_REDIS_PORT": str(redis.port),
+        "CLIP_MODEL_NAME": model_name,
+        "HF_HOME": hf_home,
+        "HF_HUB_OFFLINE": "1",
+        "TRANSFORMERS_OFFLINE": "1",
+        "CUDA_VISIBLE_DEVICES": "",
+        "METRICS_PORT": "0",
+        "SLOW_REQUEST_MS": "0",
+        "SHOW_API_DOCS": "False",
+        "INDEX_DIR": os.path.join(work_dir, "index_data"),
+        "PYTHONUNBUFFERED": "1",
+    })
+    env.update(overrides)
+    return env
+
+
+def start_workers(count: int, env: Dict[str, str], log_dir: str) -> List[subprocess.Popen]:
+    """
+    Start `count` inference workers, logging to `worker-{idx}.log`
+    """
+    workers = []
+    for idx in range(count):
+        with open(os.path.join(log_dir, f"worker-{idx}.log"), "w") as log_file:
+            workers.append(subprocess.Popen(
+                [sys.executable, "-u", "src/inference.py"],
+                cwd=INFERENCE_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT))
+    return workers
+
+
+def start_api(port: int, env: Dict[str, str], log_dir: str) -> subprocess.Popen:
+    """
+    Start the API with uvicorn on `port`, logging to `api.log`
+    """
+    with open(os.path.join(log_dir, "api.log"), "w") as log_file:
+        return subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "api:app", "--app-dir", "src",
+             "--host", "127.0.0.1", "--port", str(port), "--no-access-log"],
+            cwd=API_DIR, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+
+def check_alive(processes: List[subprocess.Popen], log_dir: str):
+    """
+    Raise if any of the services exited, e.g. because of a missing dependency
+    """
+    for process in processes:
+        if process.poll() is not None:
+            raise RuntimeError(
+                f"{' '.join(process.args)} exited with code {process.returncode}, see the logs in {log_dir}")
+
+
+def stop_process(process: subprocess.Popen, timeout_s: float = 10):
+    """
+    Stop a service, killing it if it does not exit in `timeout_s`
+    """
+    if process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout=timeout_s)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
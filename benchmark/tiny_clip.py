@@ -0,0 +1,113 @@
+"""
+A tiny randomly initialized CLIP model stored in an offline Hugging Face
+cache under the name of a served model, so that the unchanged inference
+worker loads it with `from_pretrained` without a network or a GPU. The
+embeddings are meaningless, the model only exercises the serving path.
+"""
+import os
+
+import torch
+from tokenizers import Tokenizer, decoders, models, normalizers, pre_tokenizers, processors
+from transformers import CLIPConfig, CLIPImageProcessor, CLIPModel, CLIPTokenizerFast
+
+# Any revision name works, the cache only maps refs to snapshots
+SNAPSHOT_REVISION = "0" * 40
+# Same as the OpenAI checkpoints
+MAX_TEXT_TOKENS = 77
+BOS_TOKEN = "<|startoftext|>"
+EOS_TOKEN = "<|endoftext|>"
+
+
+def tiny_tokenizer() -> CLIPTokenizerFast:
+    """
+    A byte level BPE tokenizer with no merges, every byte is a token
+    with and without the end of word marker. Built with `tokenizers`
+    as transformers 5 does not load the vocabulary files of the slow
+    tokenizer, the pre-tokenizer is a `Sequence` as `CLIPTokenizerFast`
+    of transformers 4 rejects a bare `ByteLevel` one
+    """
+    byte_tokens = sorted(pre_tokenizers.ByteLevel.alphabet())
+    tokens = byte_tokens + [token + "</w>" for token in byte_tokens] + [BOS_TOKEN, EOS_TOKEN]
+    vocab = {token: idx for idx, token in enumerate(tokens)}
+
+    tokenizer = Tokenizer(models.BPE(vocab=vocab, merges=[], end_of_word_suffix="</w>", unk_token=EOS_TOKEN))
+    tokenizer.normalizer = normalizers.Lowercase()
+    tokenizer.pre_tokenizer = pre_tokenizers.Sequence([pre_tokenizers.ByteLevel(add_prefix_space=False)])
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single=f"{BOS_TOKEN} $A {EOS_TOKEN}",
+        special_tokens=[(BOS_TOKEN, vocab[BOS_TOKEN]), (EOS_TOKEN, vocab[EOS_TOKEN])])
+
+    return CLIPTokenizerFast(
+        tokenizer_object=tokenizer,
+        bos_token=BOS_TOKEN,
+        eos_token=EOS_TOKEN,
+        pad_token=EOS_TOKEN,
+        unk_token=EOS_TOKEN,
+        model_max_length=MAX_TEXT_TOKENS)
+
+
+def tiny_clip_config(vocab_size: int, bos_token_id: int, eos_token_id: int, image_size: int) -> CLIPConfig:
+    """
+    A CLIP configuration with 2 layers of width 32 in both towers
+    """
+    return CLIPConfig(
+        text_config={
+            "vocab_size": vocab_size,
+            "hidden_size": 32,
+            "intermediate_size": 64,
+            "num_hidden_layers": 2,
+            "num_attention_heads": 2,
+            "max_position_embeddings": MAX_TEXT_TOKENS,
+            "bos_token_id": bos_token_id,
+            "eos_token_id": eos_token_id,
+            "pad_token_id": eos_token_id,
+        },
+        vision_config={
+            "image_size": image_size,
+            "patch_size": 8,
+            "hidden_size": 32,
+            "intermediate_size": 64,
+            "num_hidden_layers": 2,
+            "num_attention_heads": 2,
+        },
+        projection_dim=32)
+
+
+def create_offline_cache(hf_home: str, model_name: str, image_size: int = 32, seed: int = 0) -> str:
+    """
+    Store a tiny random CLIP model, its tokenizer and its image processor
+    in the Hugging Face cache of `hf_home` as the `main` revision of
+    `model_name`. Processes using the cache must set `HF_HUB_OFFLINE=1`
+
+    Args:
+    - hf_home (str): The directory used as `HF_HOME`
+    - model_name (str): The served model name, e.g. `openai/clip-vit-base-patch32`
+    - image_size (int): The input resolution of the vision tower
+    - seed (int): The seed of the random weights
+
+    Returns:
+    - str: The snapshot directory with the model files
+    """
+    repo_dir = os.path.join(hf_home, "hub", "models--" + model_name.replace("/", "--"))
+    snapshot_dir = os.path.join(repo_dir, "snapshots", SNAPSHOT_REVISION)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    os.makedirs(os.path.join(repo_dir, "refs"), exist_ok=True)
+    with open(os.path.join(repo_dir, "refs", "main"), "w") as f:
+        f.write(SNAPSHOT_REVISION)
+
+    tokenizer = tiny_tokenizer()
+    tokenizer.save_pretrained(snapshot_dir)
+
+    CLIPImageProcessor(
+        size={"shortest_edge": image_size},
+        crop_size={"height": image_size, "width": image_size}).save_pretrained(snapshot_dir)
+
+    torch.manual_seed(seed)
+    config = tiny_clip_config(
+        vocab_size=len(tokenizer),
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        image_size=image_size)
+    CLIPModel(config).save_pretrained(snapshot_dir, safe_serialization=True)
+    return snapshot_dir
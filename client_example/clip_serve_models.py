@@ -1,10 +1,27 @@
 from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Union
+from typing import List, Optional, Union
 
 """
 Request models
 """
-class TextRequest(BaseModel):
+class EmbeddingOptions(BaseModel):
+    # one of the models listed by /models, None for the default one
+    model: Optional[str] = None
+    # "float", "base64", "msgpack" or "binary"
+    encoding: str = "float"
+    # "float32", "float16", "int8" or "binary"
+    dtype: str = "float32"
+    normalize: bool = False
+    dimensions: Optional[int] = None
+    # name of a projection fitted with fit_projection.py
+    projection: Optional[str] = None
+    # seconds to wait for the inference, None for the server default
+    timeout_s: Optional[float] = None
+    # return the time every job spent in each stage
+    include_timings: bool = False
+
+
+class TextRequest(EmbeddingOptions):
     """
     TextRequest model, used to send text to the API
     and get the embeddings. 
@@ -21,7 +38,7 @@ class TextRequest(BaseModel):
         return self.model_dump_json()
 
 
-class ImageRequest(BaseModel):
+class ImageRequest(EmbeddingOptions):
     """
     ImageRequest model, used to send image to the API
     and get the embeddings.
@@ -38,7 +55,7 @@ class ImageRequest(BaseModel):
         return self.model_dump_json()
 
 
-class ZeroShotClassificationRequest(BaseModel):
+class ZeroShotClassificationRequest(EmbeddingOptions):
     """
     ZeroShotClassificationRequest model, used to send
     labels and images to the API and get the classification
@@ -53,6 +70,17 @@ class ZeroShotClassificationRequest(BaseModel):
     """
     labels: List[str] = Field(default_factory=list)
     images_b64: List[str] = Field(default_factory=list)
+    label_set: Optional[str] = None
+    top_k: Optional[int] = None
+
+    def to_json(self):
+        return self.model_dump_json(exclude_none=True)
+
+
+class LabelSetRequest(BaseModel):
+    name: str
+    labels: List[str] = Field(default_factory=list)
+    model: Optional[str] = None
 
     def to_json(self):
         return self.model_dump_json()
@@ -66,14 +94,23 @@ Response models
 class ImageEmbedding(BaseModel):
     image_id: str
     embedding: List[float]
+    # only set with dtype "int8"
+    scale: Optional[float] = None
 
 class TextEmbedding(BaseModel):
     text: str
     embedding: List[float]
+    # only set with dtype "int8"
+    scale: Optional[float] = None
 
 class SoftmaxOutput(BaseModel):
     image_id: str
     softmax_scores: List[float]
+    labels: Optional[List[str]] = None
+
+class ImageError(BaseModel):
+    image_index: int
+    error: str
 
 class ClassificationResult(BaseModel):
     labels: List[str] = Field(default_factory=list)
@@ -122,6 +159,7 @@ class ImageEmbeddingResponse(BaseModel):
     model_config  = ConfigDict(protected_namespaces=())
     model_name: str
     image_embeddings: List[ImageEmbedding] = Field(default_factory=list)
+    errors: List[ImageError] = Field(default_factory=list)
 
 
 class ClassificationResponse(BaseModel):
@@ -162,4 +200,18 @@ class ClassificationResponse(BaseModel):
     model_name: str
     text_embeddings: List[TextEmbedding] = Field(default_factory=list)
     image_embeddings: List[ImageEmbedding] = Field(default_factory=list)
-    classification_result: ClassificationResult = Field(default_factory=list)
\ No newline at end of file
+    classification_result: ClassificationResult = Field(default_factory=list)
+    errors: List[ImageError] = Field(default_factory=list)
+
+
+class LabelSetResponse(BaseModel):
+    model_config  = ConfigDict(protected_namespaces=())
+    name: str
+    model_name: str
+    labels_count: int
+    version: str
+
+
+class ModelsResponse(BaseModel):
+    default_model: str
+    models: List[str]
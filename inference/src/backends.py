@@ -0,0 +1,496 @@
+"""
+Inference backends running the CLIP towers. All the backends expose
+the same `encode_text`, `encode_image` and `classify` methods, the
+compiled and ONNX Runtime ones are prepared at startup and checked
+against the eager PyTorch model before being used.
+"""
+import os
+import time
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+from transformers import CLIPModel, CLIPTokenizerFast
+
+import worker_metrics
+from zero_shot import classify
+from environment_variables import InferenceBackendType
+
+# Minimum cosine similarity between the features of a backend
+# and the ones of the eager model for the backend to be used
+PARITY_MIN_COSINE = 0.999
+# Texts used to check the parity of the text tower
+PARITY_TEXTS = ["a photo of a cat", "a diagram", "a dog playing in the snow at night"]
+# ONNX opset of the exported towers
+ONNX_OPSET = 17
+# Token lengths texts are grouped by, every group is run separately
+# so short texts are never padded to the length of long ones
+TEXT_LENGTH_BUCKETS = [16, 32]
+
+
+def _pad_rows(tensor: torch.Tensor, rows: int) -> torch.Tensor:
+    """
+    Pad a batch to `rows` rows repeating its first row, padding with
+    zeros would give fully masked attention rows for the texts
+    """
+    if tensor.shape[0] == rows:
+        return tensor
+    padding = tensor[:1].expand(rows - tensor.shape[0], *tensor.shape[1:])
+    return torch.cat([tensor, padding])
+
+
+def model_size_bytes(model: torch.nn.Module) -> int:
+    """
+    Get the memory taken by the weights and buffers of a model,
+    the weights of quantized layers are packed in tuples
+    """
+    size_bytes = 0
+    for value in model.state_dict().values():
+        tensors = value if isinstance(value, tuple) else (value,)
+        size_bytes += sum(
+            tensor.numel() * tensor.element_size()
+            for tensor in tensors
+            if isinstance(tensor, torch.Tensor))
+    return size_bytes
+
+
+def _unwrap_features(output) -> torch.Tensor:
+    """
+    The projected features returned by `get_text_features` or
+    `get_image_features`. transformers 5 returns a model output
+    holding them as its `pooler_output`, earlier versions the tensor
+    """
+    return output if isinstance(output, torch.Tensor) else output.pooler_output
+
+
+class InferenceBackend():
+    """
+    Eager PyTorch backend, runs the `CLIPModel` as is. Batches larger
+    than the largest bucket are run in chunks, subclasses that need
+    static shapes also pad every chunk to the next bucket size. Texts
+    are run sorted by token length and grouped by `TEXT_LENGTH_BUCKETS`,
+    so that every chunk is only padded to the longest of similar texts.
+    The model can have a single tower loaded, see `towers.ClipTowers`
+    """
+    pad_to_buckets = False
+
+    def __init__(
+            self,
+            model: CLIPModel,
+            tokenizer: CLIPTokenizerFast,
+            device: str,
+            buckets: List[int]):
+        """
+        Constructor for the InferenceBackend class
+
+        Args:
+        - model (CLIPModel): The CLIP model, or its `ClipTowers`, already on `device`
+        - tokenizer (CLIPTokenizerFast): The CLIP tokenizer
+        - device (str): The device to run the inference on
+        - buckets (List[int]): The batch sizes the backend is prepared for, ascending
+        """
+        self.model = model
+        self.has_text = getattr(model, "has_text", True)
+        self.has_image = getattr(model, "has_image", True)
+        self.tokenizer = tokenizer
+        self.device = device
+        self.dtype = model.dtype
+        self.buckets = buckets
+        self.max_length = tokenizer.model_max_length
+        self.image_size = model.config.vision_config.image_size
+        self.logit_scale = model.logit_scale.exp().detach()
+
+    def prepare(self):
+        """
+        Compile or export the model, run once at startup
+        """
+
+    def memory_bytes(self) -> int:
+        """
+        Get the memory taken by the weights the backend runs with
+        """
+        return model_size_bytes(self.model)
+
+    def _bucket(self, rows: int) -> int:
+        """
+        Get the batch size a chunk of `rows` rows is run with
+        """
+        if not self.pad_to_buckets:
+            return rows
+        return next(bucket for bucket in self.buckets if bucket >= rows)
+
+    def _tokenize(self, texts: List[str]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Tokenize texts, padded to the longest one or, when the
+        backend needs static shapes, to the maximum length
+        """
+        inputs = self.tokenizer(
+            texts,
+            return_tensors="pt",
+            padding="max_length" if self.pad_to_buckets else True,
+            max_length=self.max_length,
+            truncation=True)
+        return inputs["input_ids"].to(self.device), inputs["attention_mask"].to(self.device)
+
+    def _length_chunks(self, order: List[int], lengths: List[int]) -> List[List[int]]:
+        """
+        Split the texts sorted by token length in chunks of at most the
+        largest bucket, a new chunk starts at every `TEXT_LENGTH_BUCKETS` boundary
+        """
+        chunks = []
+        chunk, chunk_bucket = [], None
+        for idx, length in zip(order, lengths):
+            bucket = next((bucket for bucket in TEXT_LENGTH_BUCKETS if length <= bucket), self.max_length)
+            if chunk and (bucket != chunk_bucket or len(chunk) == self.buckets[-1]):
+                chunks.append(chunk)
+                chunk = []
+            chunk.append(idx)
+            chunk_bucket = bucket
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _pad(self, input_ids: List[List[int]]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Pad texts already tokenized to the longest one
+        """
+        inputs = self.tokenizer.pad({"input_ids": input_ids}, padding=True, return_tensors="pt")
+        return inputs["input_ids"].to(self.device), inputs["attention_mask"].to(self.device)
+
+    def _synchronize(self):
+        """
+        Wait for the kernels queued on the GPU, so that they are timed
+        as part of the forward pass and not of the next stage
+        """
+        if self.device == "cuda":
+            torch.cuda.synchronize()
+
+    def _text_features(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return _unwrap_features(self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask))
+
+    def _image_features(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return _unwrap_features(self.model.get_image_features(pixel_values=pixel_values))
+
+    @torch.inference_mode()
+    def encode_text(self, texts: List[str]) -> torch.Tensor:
+        """
+        Compute the (not normalized) text features
+
+        Args:
+        - texts (List[str]): The texts
+
+        Returns:
+        - torch.Tensor: The text features, (n_texts, dim)
+
+        Raises:
+        - RuntimeError: If the text tower is not loaded
+        """
+        if not self.has_text:
+            raise RuntimeError("The text tower is not loaded by this worker")
+        start = time.perf_counter()
+        tokenization_s = 0.0
+        if self.pad_to_buckets:
+            # static shapes, all the texts are padded to the maximum length anyway
+            tokenized = None
+            order = list(range(len(texts)))
+            chunks = [order[start:start + self.buckets[-1]] for start in range(0, len(texts), self.buckets[-1])]
+        else:
+            tokenized = self.tokenizer(texts, truncation=True, max_length=self.max_length)["input_ids"]
+            order = sorted(range(len(texts)), key=lambda idx: len(tokenized[idx]))
+            chunks = self._length_chunks(order, [len(tokenized[idx]) for idx in order])
+        tokenization_s += time.perf_counter() - start
+
+        features = []
+        for chunk in chunks:
+            tokenization_start = time.perf_counter()
+            if tokenized is None:
+                input_ids, attention_mask = self._tokenize([texts[idx] for idx in chunk])
+            else:
+                input_ids, attention_mask = self._pad([tokenized[idx] for idx in chunk])
+            tokenization_s += time.perf_counter() - tokenization_start
+            rows = self._bucket(len(chunk))
+            chunk_features = self._text_features(
+                _pad_rows(input_ids, rows), _pad_rows(attention_mask, rows))
+            features.append(chunk_features[:len(chunk)])
+        features = torch.cat(features)
+
+        # Back to the order of `texts`
+        restored = torch.empty_like(features)
+        restored[torch.tensor(order, device=features.device)] = features
+        self._synchronize()
+
+        elapsed_s = time.perf_counter() - start
+        worker_metrics.STAGE_SECONDS.labels(worker_metrics.TOKENIZATION_STAGE, "text").observe(tokenization_s)
+        worker_metrics.STAGE_SECONDS.labels(worker_metrics.FORWARD_STAGE, "text").observe(elapsed_s - tokenization_s)
+        return restored
+
+    @torch.inference_mode()
+    def encode_image(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """
+        Compute the (not normalized) image features
+
+        Args:
+        - pixel_values (torch.Tensor): The preprocessed images, (n_images, 3, size, size)
+
+        Returns:
+        - torch.Tensor: The image features, (n_images, dim)
+
+        Raises:
+        - RuntimeError: If the vision tower is not loaded
+        """
+        if not self.has_image:
+            raise RuntimeError("The vision tower is not loaded by this worker")
+        forward_start = time.perf_counter()
+        features = []
+        for start in range(0, pixel_values.shape[0], self.buckets[-1]):
+            chunk = pixel_values[start:start + self.buckets[-1]].to(self.device, dtype=self.dtype)
+            rows = self._bucket(chunk.shape[0])
+            features.append(self._image_features(_pad_rows(chunk, rows))[:chunk.shape[0]])
+        features = torch.cat(features)
+        self._synchronize()
+        worker_metrics.observe_stage(worker_metrics.FORWARD_STAGE, forward_start, "image")
+        return features
+
+    @torch.inference_mode()
+    def classify(
+            self,
+            image_embeds: torch.Tensor,
+            label_embeds: torch.Tensor,
+            top_k: Optional[int] = None) -> Tuple[Optional[torch.Tensor], torch.Tensor]:
+        """
+        Compute the softmax scores of normalized image embeddings
+        over normalized label embeddings, see `zero_shot.classify`
+        """
+        return classify(
+            image_embeds,
+            label_embeds.to(device=image_embeds.device, dtype=image_embeds.dtype),
+            self.logit_scale.to(image_embeds.device),
+            top_k)
+
+
+class CompiledBackend(InferenceBackend):
+    """
+    Runs the towers compiled with `torch.compile`. Shapes are static,
+    every bucket is compiled once at startup so that no request pays
+    for a recompilation
+    """
+    pad_to_buckets = True
+
+    def prepare(self):
+        if self.has_text:
+            self.text_tower = torch.compile(self.model.get_text_features, dynamic=False)
+        if self.has_image:
+            self.image_tower = torch.compile(self.model.get_image_features, dynamic=False)
+
+        for bucket in self.buckets:
+            print(f"Compiling batch size {bucket}")
+            if self.has_text:
+                self.encode_text(PARITY_TEXTS[:1] * bucket)
+            if self.has_image:
+                self.encode_image(torch.zeros((bucket, 3, self.image_size, self.image_size)))
+
+    def _text_features(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        return _unwrap_features(self.text_tower(input_ids=input_ids, attention_mask=attention_mask))
+
+    def _image_features(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return _unwrap_features(self.image_tower(pixel_values=pixel_values))
+
+
+class _TextTower(torch.nn.Module):
+    def __init__(self, model: CLIPModel):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return _unwrap_features(self.model.get_text_features(input_ids=input_ids, attention_mask=attention_mask))
+
+
+class _ImageTower(torch.nn.Module):
+    def __init__(self, model: CLIPModel):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values):
+        return _unwrap_features(self.model.get_image_features(pixel_values=pixel_values))
+
+
+class OnnxBackend(InferenceBackend):
+    """
+    Runs the towers exported to ONNX with ONNX Runtime. The towers
+    are exported once to `cache_dir` and reused by the next starts,
+    the backend drops the PyTorch model once the sessions are created
+    and `create_backend` once the parity is checked. Batches are
+    padded to the buckets so that ONNX Runtime reuses its buffers
+    """
+    pad_to_buckets = True
+
+    def __init__(
+            self,
+            model: CLIPModel,
+            tokenizer: CLIPTokenizerFast,
+            device: str,
+            buckets: List[int],
+            model_name: str,
+            cache_dir: str):
+        """
+        Constructor for the OnnxBackend class
+
+        Args:
+        - model (CLIPModel): The CLIP model, already on `device`
+        - tokenizer (CLIPTokenizerFast): The CLIP tokenizer
+        - device (str): The device to run the inference on
+        - buckets (List[int]): The batch sizes the backend is prepared for, ascending
+        - model_name (str): The name of the CLIP model, used to name the exported files
+        - cache_dir (str): The directory the exported towers are stored in
+        """
+        super().__init__(model, tokenizer, device, buckets)
+        self.export_dir = os.path.join(cache_dir, model_name.replace("/", "--"), str(self.dtype).split(".")[-1])
+        self.session_paths: List[str] = []
+
+    def _export(self, path: str, tower: torch.nn.Module, args: tuple, input_names: List[str]):
+        """
+        Export a tower with a dynamic batch (and sequence) axis
+        """
+        dynamic_axes = {name: {0: "batch"} for name in input_names + ["features"]}
+        if "input_ids" in input_names:
+            dynamic_axes["input_ids"][1] = "sequence"
+            dynamic_axes["attention_mask"][1] = "sequence"
+
+        print(f"Exporting {path}")
+        os.makedirs(self.export_dir, exist_ok=True)
+        with torch.no_grad():
+            torch.onnx.export(
+                tower,
+                args,
+                path + ".tmp",
+                input_names=input_names,
+                output_names=["features"],
+                dynamic_axes=dynamic_axes,
+                opset_version=ONNX_OPSET)
+        # Concurrent workers never load a partial export
+        os.replace(path + ".tmp", path)
+
+    def prepare(self):
+        # Only needed by this backend, imported here so the
+        # other backends work without ONNX Runtime installed
+        import onnxruntime
+
+        text_path = os.path.join(self.export_dir, "text.onnx")
+        image_path = os.path.join(self.export_dir, "image.onnx")
+
+        if self.has_text and not os.path.exists(text_path):
+            input_ids, attention_mask = self._tokenize(PARITY_TEXTS[:2])
+            self._export(text_path, _TextTower(self.model), (input_ids, attention_mask), ["input_ids", "attention_mask"])
+        if self.has_image and not os.path.exists(image_path):
+            pixel_values = torch.zeros((2, 3, self.image_size, self.image_size), device=self.device, dtype=self.dtype)
+            self._export(image_path, _ImageTower(self.model), (pixel_values,), ["pixel_values"])
+
+        providers = ["CPUExecutionProvider"]
+        if self.device == "cuda":
+            providers.insert(0, "CUDAExecutionProvider")
+        if self.has_text:
+            self.text_session = onnxruntime.InferenceSession(text_path, providers=providers)
+            self.session_paths.append(text_path)
+        if self.has_image:
+            self.image_session = onnxruntime.InferenceSession(image_path, providers=providers)
+            self.session_paths.append(image_path)
+
+        self.model = None
+
+    def memory_bytes(self) -> int:
+        # The sessions hold the weights of the exported files
+        return sum(os.path.getsize(path) for path in self.session_paths)
+
+    def _text_features(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        features, = self.text_session.run(None, {
+            "input_ids": input_ids.cpu().numpy().astype(np.int64),
+            "attention_mask": attention_mask.cpu().numpy().astype(np.int64)})
+        return torch.from_numpy(features).to(self.device)
+
+    def _image_features(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        features, = self.image_session.run(None, {"pixel_values": pixel_values.cpu().numpy()})
+        return torch.from_numpy(features).to(self.device)
+
+
+def check_parity(backend: InferenceBackend, reference: InferenceBackend) -> float:
+    """
+    Compare the features of a backend with the ones of the eager model
+    on fixed texts and random images, for the towers loaded
+
+    Args:
+    - backend (InferenceBackend): The backend to check
+    - reference (InferenceBackend): The eager backend of the same model
+
+    Returns:
+    - float: The lowest cosine similarity between the features
+    """
+    generator = torch.Generator().manual_seed(0)
+    pixel_values = torch.randn((2, 3, reference.image_size, reference.image_size), generator=generator)
+
+    checks = []
+    if reference.has_text:
+        checks.append(("encode_text", PARITY_TEXTS))
+    if reference.has_image:
+        checks.append(("encode_image", pixel_values))
+
+    similarities = []
+    for method, inputs in checks:
+        expected = getattr(reference, method)(inputs).float()
+        actual = getattr(backend, method)(inputs).float().to(expected.device)
+        similarities.append(torch.nn.functional.cosine_similarity(expected, actual, dim=-1).min().item())
+
+    return min(similarities)
+
+
+def create_backend(
+        backend_type: InferenceBackendType,
+        model: CLIPModel,
+        tokenizer: CLIPTokenizerFast,
+        device: str,
+        buckets: List[int],
+        model_name: str,
+        cache_dir: str) -> InferenceBackend:
+    """
+    Create and prepare a backend, falling back to the eager one if
+    the preparation fails or its features do not match the eager model.
+    The ONNX backend is returned without any reference to `model`, the
+    caller has to drop its own for the PyTorch weights to be released
+
+    Args:
+    - backend_type (InferenceBackendType): The backend to create
+    - model (CLIPModel): The CLIP model, already on `device`
+    - tokenizer (CLIPTokenizerFast): The CLIP tokenizer
+    - device (str): The device to run the inference on
+    - buckets (List[int]): The batch sizes the backend is prepared for, ascending
+    - model_name (str): The name of the CLIP model
+    - cache_dir (str): The directory the exported models are stored in
+
+    Returns:
+    - InferenceBackend: The prepared backend
+    """
+    eager = InferenceBackend(model, tokenizer, device, buckets)
+    if backend_type == InferenceBackendType.EAGER:
+        return eager
+
+    try:
+        if backend_type == InferenceBackendType.COMPILE:
+            backend = CompiledBackend(model, tokenizer, device, buckets)
+        else:
+            backend = OnnxBackend(model, tokenizer, device, buckets, model_name, cache_dir)
+        backend.prepare()
+        similarity = check_parity(backend, eager)
+    except Exception as e:
+        print(f"Could not prepare the {backend_type.value} backend of {model_name}: {type(e).__name__}: {e}")
+        print("Using the eager backend")
+        return eager
+
+    if similarity < PARITY_MIN_COSINE:
+        print(f"The {backend_type.value} backend of {model_name} does not match the eager model, "
+              f"cosine similarity {similarity:.5f} < {PARITY_MIN_COSINE}")
+        print("Using the eager backend")
+        return eager
+
+    print(f"Using the {backend_type.value} backend for {model_name}, cosine similarity {similarity:.5f}")
+    # The eager backend was only needed for the parity check
+    eager.model = None
+    return backend
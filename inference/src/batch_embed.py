@@ -0,0 +1,349 @@
+"""
+Offline batch embedding, for backfills that do not need to go through
+the API. Reads a directory of images or a JSONL/CSV manifest of images
+or texts and writes the embeddings either to a memory-mapped `.npy`
+with an id index or to Parquet files. The model is loaded with the
+same `ModelPool` as the inference worker, so `INFERENCE_BACKEND` and
+`CLIP_PRECISION` apply, and the images are decoded by a pool of
+threads while the model runs the previous batch.
+
+Progress is checkpointed every `--checkpoint-every` items, running the
+same command again after the job was killed resumes from the last
+checkpoint.
+
+Run it inside the inference container, e.g.:
+
+    python3 src/batch_embed.py --input /data/images --output /data/embeddings
+
+Manifests have an `id` and either an `image` path (relative to the
+manifest) or a `text` on every line, e.g. `{"id": "doc-1", "text": "a cat"}`,
+CSV manifests have a header with the same columns.
+"""
+import argparse
+import csv
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+from transformers import CLIPImageProcessor
+
+from evaluate_precision import IMAGE_EXTENSIONS
+from image_pipeline import prepare_image
+from model_pool import ModelPool
+from precision import resolve_precision
+from environment_variables import (
+    valid_clip_model_names, get_inference_backend, get_clip_precision,
+    get_batch_buckets, get_onnx_cache_dir, get_preprocess_workers, WorkerMode)
+
+CHECKPOINT_FILE = "checkpoint.json"
+IDS_FILE = "ids.jsonl"
+ERRORS_FILE = "errors.jsonl"
+EMBEDDINGS_FILE = "embeddings.npy"
+
+# (id, image path or text)
+Item = Tuple[str, str]
+
+
+def read_items(input_path: str) -> Tuple[str, List[Item]]:
+    """
+    Read the items to embed from a directory or a manifest
+
+    Args:
+    - input_path (str): A directory of images, or a `.jsonl` or `.csv` manifest
+
+    Returns:
+    - str: The kind of the items, `image` or `text`
+    - List[Item]: The id and the image path or text of every item
+    """
+    if os.path.isdir(input_path):
+        paths = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(input_path)
+            for name in names
+            if name.lower().endswith(IMAGE_EXTENSIONS))
+        return "image", [(os.path.relpath(path, input_path), path) for path in paths]
+
+    if input_path.endswith(".jsonl"):
+        with open(input_path) as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    elif input_path.endswith(".csv"):
+        with open(input_path, newline="") as f:
+            rows = list(csv.DictReader(f))
+    else:
+        raise SystemExit(f"{input_path} is not a directory, a .jsonl or a .csv manifest")
+
+    if not rows:
+        raise SystemExit(f"{input_path} is empty")
+    kind = "image" if "image" in rows[0] else "text"
+    if any(kind not in row or "id" not in row for row in rows):
+        raise SystemExit(f"Every line of {input_path} must have an id and the same image or text field")
+
+    base_dir = os.path.dirname(os.path.abspath(input_path))
+    items = [
+        (str(row["id"]), os.path.join(base_dir, row["image"]) if kind == "image" else row["text"])
+        for row in rows]
+    return kind, items
+
+
+def load_checkpoint(output_dir: str, settings: dict) -> int:
+    """
+    Get the number of items already embedded in `output_dir`
+
+    Args:
+    - output_dir (str): The output directory
+    - settings (dict): The settings of this run, must match the checkpointed ones
+
+    Returns:
+    - int: The number of items embedded, 0 without a checkpoint
+    """
+    path = os.path.join(output_dir, CHECKPOINT_FILE)
+    if not os.path.exists(path):
+        return 0
+
+    with open(path) as f:
+        checkpoint = json.load(f)
+    changed = [key for key, value in settings.items() if checkpoint.get(key) != value]
+    if changed:
+        raise SystemExit(
+            f"{output_dir} holds a different job ({', '.join(changed)} changed), "
+            "use --overwrite to start over")
+    return checkpoint["done"]
+
+
+def save_checkpoint(output_dir: str, settings: dict, done: int):
+    """
+    Record that the first `done` items are embedded, the file
+    is replaced atomically so a kill never corrupts it
+    """
+    path = os.path.join(output_dir, CHECKPOINT_FILE)
+    with open(path + ".tmp", "w") as f:
+        json.dump({**settings, "done": done}, f)
+    os.replace(path + ".tmp", path)
+
+
+def prepared_batches(
+        kind: str,
+        items: List[Item],
+        start: int,
+        batch_size: int,
+        executor: ThreadPoolExecutor,
+        image_processor) -> Iterator[Tuple[int, list]]:
+    """
+    Yield the batches of items from `start`, the images of the next
+    batch are decoded while the current one is embedded
+
+    Returns:
+    - Iterator[Tuple[int, list]]: The index of the first item of every
+        batch and its texts or `PreparedImage`s
+    """
+    offsets = range(start, len(items), batch_size)
+    if kind == "text":
+        for offset in offsets:
+            yield offset, [value for _, value in items[offset:offset + batch_size]]
+        return
+
+    pending = deque()
+    for offset in offsets:
+        pending.append((offset, [
+            executor.submit(prepare_image, image_processor, image_path=path)
+            for _, path in items[offset:offset + batch_size]]))
+        if len(pending) > 1:
+            ready_offset, futures = pending.popleft()
+            yield ready_offset, [future.result() for future in futures]
+    while pending:
+        ready_offset, futures = pending.popleft()
+        yield ready_offset, [future.result() for future in futures]
+
+
+def embed_batch(kind: str, batch: list, backend, normalize: bool) -> Tuple[np.ndarray, List[Optional[str]]]:
+    """
+    Embed a batch, the rows of the images that fail are left to zero
+
+    Returns:
+    - np.ndarray: The float32 embeddings, (len(batch), dim)
+    - List[Optional[str]]: The error of every item, None if embedded
+    """
+    if kind == "text":
+        features = backend.encode_text(batch).float()
+        errors = [None] * len(batch)
+    else:
+        errors = [prepared.error for prepared in batch]
+        valid = [prepared.pixel_values for prepared in batch if prepared.pixel_values is not None]
+        features = backend.encode_image(torch.stack(valid)).float() if valid else None
+
+    if normalize and features is not None:
+        features = features / features.norm(p=2, dim=-1, keepdim=True)
+    if features is None:
+        return None, errors
+
+    features = features.cpu().numpy()
+    if kind == "image" and len(valid) < len(batch):
+        rows = np.zeros((len(batch), features.shape[1]), dtype=np.float32)
+        rows[[idx for idx, error in enumerate(errors) if error is None]] = features
+        features = rows
+    return features, errors
+
+
+class NpyWriter():
+    """
+    Writes the embeddings to a memory-mapped `.npy` of (n_items, dim),
+    created on the first batch when the dimension is known. Row `i`
+    is the item on line `i` of the id index
+    """
+    def __init__(self, output_dir: str, items: List[Item], dtype: str):
+        self.path = os.path.join(output_dir, EMBEDDINGS_FILE)
+        self.n_items = len(items)
+        self.dtype = dtype
+        self.embeddings = None
+        if os.path.exists(self.path):
+            self.embeddings = np.load(self.path, mmap_mode="r+")
+
+        ids_path = os.path.join(output_dir, IDS_FILE)
+        if not os.path.exists(ids_path):
+            with open(ids_path + ".tmp", "w") as f:
+                f.writelines(json.dumps(item_id) + "\n" for item_id, _ in items)
+            os.replace(ids_path + ".tmp", ids_path)
+
+    def write(self, offset: int, features: Optional[np.ndarray], errors: List[Optional[str]]):
+        if features is None:
+            # nothing embedded, the rows are left to zero
+            return
+        if self.embeddings is None:
+            self.embeddings = np.lib.format.open_memmap(
+                self.path, mode="w+", dtype=self.dtype, shape=(self.n_items, features.shape[1]))
+        self.embeddings[offset:offset + features.shape[0]] = features
+
+    def flush(self):
+        if self.embeddings is not None:
+            self.embeddings.flush()
+
+
+class ParquetWriter():
+    """
+    Writes the embeddings to Parquet files with the `id`, `embedding`
+    and `error` columns, one `part-<first item>.parquet` per checkpoint
+    """
+    def __init__(self, output_dir: str, items: List[Item], dtype: str):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("The parquet format needs pyarrow, install it with `pip install pyarrow`")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.output_dir = output_dir
+        self.items = items
+        self.dtype = dtype
+        self.rows = []
+
+    def write(self, offset: int, features: Optional[np.ndarray], errors: List[Optional[str]]):
+        for idx, error in enumerate(errors):
+            embedding = features[idx].astype(self.dtype) if features is not None and error is None else None
+            self.rows.append((offset + idx, embedding, error))
+
+    def flush(self):
+        if not self.rows:
+            return
+        first = self.rows[0][0]
+        table = self.pa.table({
+            "id": [self.items[idx][0] for idx, _, _ in self.rows],
+            "embedding": [embedding.tolist() if embedding is not None else None for _, embedding, _ in self.rows],
+            "error": [error for _, _, error in self.rows],
+        })
+        path = os.path.join(self.output_dir, f"part-{first:010d}.parquet")
+        self.pq.write_table(table, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        self.rows = []
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embed a directory or a manifest of images or texts")
+    parser.add_argument("--input", required=True, help="Directory of images, or .jsonl/.csv manifest")
+    parser.add_argument("--output", required=True, help="Output directory")
+    parser.add_argument("--format", default="npy", choices=["npy", "parquet"])
+    parser.add_argument("--model", default=valid_clip_model_names[0], choices=valid_clip_model_names)
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16"])
+    parser.add_argument("--normalize", action="store_true", help="L2 normalize the embeddings")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=get_preprocess_workers(), help="Image decoding threads")
+    parser.add_argument("--checkpoint-every", type=int, default=10000, help="Items between checkpoints")
+    parser.add_argument("--overwrite", action="store_true", help="Start over instead of resuming")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    kind, items = read_items(args.input)
+    os.makedirs(args.output, exist_ok=True)
+    if args.overwrite:
+        for name in os.listdir(args.output):
+            if name in (CHECKPOINT_FILE, IDS_FILE, ERRORS_FILE, EMBEDDINGS_FILE) or name.startswith("part-"):
+                os.remove(os.path.join(args.output, name))
+
+    settings = {
+        "input": os.path.abspath(args.input), "items": len(items), "kind": kind, "model": args.model,
+        "format": args.format, "dtype": args.dtype, "normalize": args.normalize,
+    }
+    done = load_checkpoint(args.output, settings)
+    if done >= len(items):
+        print(f"All the {len(items)} items of {args.input} are already embedded")
+        return
+    if done:
+        print(f"Resuming after {done} of {len(items)} items")
+
+    # Large batches are run as a single chunk by the backend
+    buckets = sorted(set(get_batch_buckets() + [args.batch_size]))
+    model_pool = ModelPool(
+        args.device,
+        backend_type=get_inference_backend(),
+        precision=resolve_precision(get_clip_precision(), args.device),
+        buckets=buckets,
+        onnx_cache_dir=get_onnx_cache_dir(),
+        worker_mode=WorkerMode.IMAGE if kind == "image" else WorkerMode.TEXT)
+    backend = model_pool.get(args.model).backend
+    image_processor = CLIPImageProcessor.from_pretrained(args.model) if kind == "image" else None
+
+    writer_class = NpyWriter if args.format == "npy" else ParquetWriter
+    writer = writer_class(args.output, items, args.dtype)
+    errors_file = open(os.path.join(args.output, ERRORS_FILE), "a")
+
+    print(f"Embedding {len(items) - done} {kind}s of {args.input} with {args.model}")
+    start_time = time.perf_counter()
+    last_report = start_time
+    embedded = 0
+    pending_errors = []
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix="decode") as executor:
+        for offset, batch in prepared_batches(kind, items, done, args.batch_size, executor, image_processor):
+            features, errors = embed_batch(kind, batch, backend, args.normalize)
+            writer.write(offset, features, errors)
+            pending_errors.extend(
+                {"index": offset + idx, "id": items[offset + idx][0], "error": error}
+                for idx, error in enumerate(errors) if error is not None)
+            embedded += len(batch)
+
+            end = offset + len(batch)
+            if end - done >= args.checkpoint_every or end == len(items):
+                # the errors of a batch can be written twice if killed right
+                # here, they are keyed by index so duplicates are harmless
+                writer.flush()
+                errors_file.writelines(json.dumps(error) + "\n" for error in pending_errors)
+                errors_file.flush()
+                save_checkpoint(args.output, settings, end)
+                pending_errors = []
+                done = end
+
+            now = time.perf_counter()
+            if now - last_report >= 10 or end == len(items):
+                print(f"{end}/{len(items)} items, {embedded / (now - start_time):.1f} items/sec")
+                last_report = now
+
+    errors_file.close()
+    elapsed = time.perf_counter() - start_time
+    print(f"Embedded {embedded} items in {elapsed:.1f} s, {embedded / elapsed:.1f} items/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Dynamic micro-batching for the inference worker. Jobs from the
+job queue are merged in a single batch so that the model runs
+one forward pass per modality instead of one per job.
+"""
+import time
+from typing import List, Tuple
+
+import redis_models
+from job_queue import JobQueue
+
+
+def collect_batch(
+        job_queue: JobQueue,
+        max_batch_size: int,
+        max_wait_ms: int) -> List[redis_models.RedisRequestItem]:
+    """
+    Collect a batch of jobs from the job queue. Jobs reclaimed from
+    crashed workers come first, otherwise blocks up to 1 second for the
+    first new job. Then keeps reading the queue until either
+    `max_batch_size` jobs have been collected or `max_wait_ms`
+    milliseconds have passed since the first job was received.
+
+    Args:
+    - job_queue (JobQueue): The job queue
+    - max_batch_size (int): The maximum number of jobs in the batch
+    - max_wait_ms (int): The maximum time to wait for the batch to fill up
+
+    Returns:
+    - List[RedisRequestItem]: The jobs in the batch, oldest first.
+        Empty if no job was received
+    """
+    batch = job_queue.claim_stale(max_batch_size)
+    if not batch:
+        batch = job_queue.read(max_batch_size, block_ms=1000)
+    if not batch:
+        return []
+
+    deadline = time.monotonic() + max_wait_ms / 1000
+
+    while len(batch) < max_batch_size:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+
+        # Returns right away with the jobs already queued, otherwise
+        # waits for a new job until the deadline. A block of 0 would
+        # wait forever, hence the lower bound
+        jobs = job_queue.read(max_batch_size - len(batch), block_ms=max(1, int(remaining * 1000)))
+        if not jobs:
+            break
+        batch.extend(jobs)
+
+    return batch
+
+
+def group_jobs(
+        jobs: List[redis_models.RedisRequestItem]
+    ) -> Tuple[
+        List[redis_models.RedisRequestItem],
+        List[redis_models.RedisRequestItem],
+        List[redis_models.RedisRequestItem]]:
+    """
+    Split the jobs by kind
+
+    Args:
+    - jobs (List[RedisRequestItem]): The jobs to split
+
+    Returns:
+    - Tuple[List[RedisRequestItem], ...]: The text-only, image-only and
+        classification (text and images, or label set) jobs
+    """
+    text_jobs, image_jobs, classification_jobs = [], [], []
+
+    for job in jobs:
+        if job.label_set is not None:
+            classification_jobs.append(job)
+        elif not job.images:
+            text_jobs.append(job)
+        elif not job.texts:
+            image_jobs.append(job)
+        else:
+            classification_jobs.append(job)
+
+    return text_jobs, image_jobs, classification_jobs
+
+
+def split_expired(
+        jobs: List[redis_models.RedisRequestItem],
+        now: float
+    ) -> Tuple[List[redis_models.RedisRequestItem], List[redis_models.RedisRequestItem]]:
+    """
+    Split the jobs whose deadline has already passed
+
+    Args:
+    - jobs (List[RedisRequestItem]): The jobs to split
+    - now (float): The current unix time
+
+    Returns:
+    - Tuple[List[RedisRequestItem], List[RedisRequestItem]]: The live and the expired jobs
+    """
+    live, expired = [], []
+    for job in jobs:
+        if job.deadline is not None and job.deadline < now:
+            expired.append(job)
+        else:
+            live.append(job)
+    return live, expired
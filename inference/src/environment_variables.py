@@ -1,8 +1,75 @@
 import os
 from enum import Enum
+from typing import List
 
 class EnvironmentKeys(Enum):
     CLIP_MODEL_NAME = "CLIP_MODEL_NAME"
+    CLIP_MODEL_NAMES = "CLIP_MODEL_NAMES"
+    MAX_BATCH_SIZE = "MAX_BATCH_SIZE"
+    MAX_BATCH_WAIT_MS = "MAX_BATCH_WAIT_MS"
+    PREPROCESS_WORKERS = "PREPROCESS_WORKERS"
+    PREFETCH_BATCHES = "PREFETCH_BATCHES"
+    JOB_CLAIM_IDLE_MS = "JOB_CLAIM_IDLE_MS"
+    JOB_MAX_DELIVERIES = "JOB_MAX_DELIVERIES"
+    MODEL_MEMORY_BUDGET_MB = "MODEL_MEMORY_BUDGET_MB"
+    INFERENCE_BACKEND = "INFERENCE_BACKEND"
+    BATCH_BUCKETS = "BATCH_BUCKETS"
+    ONNX_CACHE_DIR = "ONNX_CACHE_DIR"
+    CLIP_PRECISION = "CLIP_PRECISION"
+    WORKER_MODE = "WORKER_MODE"
+    PRIORITY_POLICY = "PRIORITY_POLICY"
+    PRIORITY_WEIGHTS = "PRIORITY_WEIGHTS"
+    METRICS_PORT = "METRICS_PORT"
+    REDIS_HOST = "REDIS_HOST"
+    REDIS_PORT = "REDIS_PORT"
+
+
+class InferenceBackendType(Enum):
+    """
+    How the CLIP towers are run
+    - EAGER: the PyTorch model as is
+    - COMPILE: the PyTorch model compiled with torch.compile
+    - ONNX: the towers exported to ONNX and run with ONNX Runtime
+    """
+    EAGER = "eager"
+    COMPILE = "compile"
+    ONNX = "onnx"
+
+
+class ClipPrecision(Enum):
+    """
+    Precision of the CLIP model weights
+    - FP32: float32
+    - FP16: float16, GPU only
+    - BF16: bfloat16
+    - INT8: linear layers quantized to int8, CPU only
+    """
+    FP32 = "fp32"
+    FP16 = "fp16"
+    BF16 = "bf16"
+    INT8 = "int8"
+
+class WorkerMode(Enum):
+    """
+    The jobs served by a worker and the part of the model it loads
+    - FULL: all the jobs, the full CLIP model
+    - TEXT: text and classification jobs, only the text tower
+    - IMAGE: image jobs, only the vision tower
+    """
+    FULL = "full"
+    TEXT = "text"
+    IMAGE = "image"
+
+class PriorityPolicy(Enum):
+    """
+    How the jobs of the priority classes are read
+    - WEIGHTED: every class gets a share of every batch proportional to
+        its weight, the share of the classes without jobs goes to the others
+    - STRICT: the jobs of a class are read only when the higher
+        classes have no jobs left to fill the batch
+    """
+    WEIGHTED = "weighted"
+    STRICT = "strict"
 
 valid_clip_model_names = [
     "openai/clip-vit-base-patch32",
@@ -11,6 +78,21 @@ valid_clip_model_names = [
     "openai/clip-vit-large-patch14-336",
 ]
 
+default_max_batch_size = 32
+default_max_batch_wait_ms = 10
+default_preprocess_workers = min(4, os.cpu_count() or 1)
+default_prefetch_batches = 2
+default_job_claim_idle_ms = 15000
+default_job_max_deliveries = 3
+default_model_memory_budget_mb = 0
+default_batch_buckets = [1, 4, 16, 64]
+default_onnx_cache_dir = "/onnx_cache"
+# interactive, bulk
+default_priority_weights = [8, 1]
+default_metrics_port = 9100
+default_redis_host = "redis"
+default_redis_port = 6379
+
 
 def get_clip_model_name():
     """
@@ -22,4 +104,234 @@ def get_clip_model_name():
         print(f"Using default value: {valid_clip_model_names[0]}")
         clip_model_name = valid_clip_model_names[0]
     
-    return clip_model_name
\ No newline at end of file
+    return clip_model_name
+
+
+def get_clip_model_names() -> List[str]:
+    """
+    Get the names of the CLIP models served, a comma separated list.
+    Defaults to the `CLIP_MODEL_NAME` model only, which is always served
+    and used by the requests that do not ask for a specific model
+    """
+    default_model_name = get_clip_model_name()
+    value = os.environ.get(EnvironmentKeys.CLIP_MODEL_NAMES.value, "")
+
+    model_names = [default_model_name]
+    for model_name in (name.strip() for name in value.split(",")):
+        if not model_name or model_name in model_names:
+            continue
+        if model_name not in valid_clip_model_names:
+            print(f"Invalid CLIP model name in {EnvironmentKeys.CLIP_MODEL_NAMES.value}: {model_name}. Valid values are: {valid_clip_model_names}")
+            continue
+        model_names.append(model_name)
+
+    return model_names
+
+
+def _get_positive_int(key: EnvironmentKeys, default: int) -> int:
+    """
+    Read a strictly positive integer from the environment variables,
+    falling back to `default` when missing or invalid
+    """
+    value = os.environ.get(key.value, str(default))
+    try:
+        int_value = int(value)
+    except ValueError:
+        int_value = -1
+
+    if int_value <= 0:
+        print(f"Invalid value for {key.value}: {value}. Expected a positive integer")
+        print(f"Using default value: {default}")
+        int_value = default
+
+    return int_value
+
+
+def get_max_batch_size() -> int:
+    """
+    Get the maximum number of jobs that are merged in a single batch
+    """
+    return _get_positive_int(EnvironmentKeys.MAX_BATCH_SIZE, default_max_batch_size)
+
+
+def get_max_batch_wait_ms() -> int:
+    """
+    Get the maximum time, in milliseconds, to wait for a batch to fill up
+    after the first job has been received
+    """
+    return _get_positive_int(EnvironmentKeys.MAX_BATCH_WAIT_MS, default_max_batch_wait_ms)
+
+
+def get_preprocess_workers() -> int:
+    """
+    Get the number of threads used to decode and preprocess images
+    """
+    return _get_positive_int(EnvironmentKeys.PREPROCESS_WORKERS, default_preprocess_workers)
+
+
+def get_prefetch_batches() -> int:
+    """
+    Get the maximum number of batches that are prepared ahead
+    of the one currently running on the model
+    """
+    return _get_positive_int(EnvironmentKeys.PREFETCH_BATCHES, default_prefetch_batches)
+
+
+def get_job_claim_idle_ms() -> int:
+    """
+    Get the time, in milliseconds, after which a job left pending
+    by a worker is reclaimed by another one
+    """
+    return _get_positive_int(EnvironmentKeys.JOB_CLAIM_IDLE_MS, default_job_claim_idle_ms)
+
+
+def get_job_max_deliveries() -> int:
+    """
+    Get the number of times a job is delivered to the workers
+    before being moved to the dead-letter stream
+    """
+    return _get_positive_int(EnvironmentKeys.JOB_MAX_DELIVERIES, default_job_max_deliveries)
+
+
+def get_model_memory_budget_mb() -> int:
+    """
+    Get the memory, in MB, available for the models loaded by the
+    worker. The least recently used models are unloaded to stay
+    within it, 0 disables the limit
+    """
+    value = os.environ.get(EnvironmentKeys.MODEL_MEMORY_BUDGET_MB.value, str(default_model_memory_budget_mb))
+    try:
+        int_value = int(value)
+    except ValueError:
+        int_value = -1
+
+    if int_value < 0:
+        print(f"Invalid value for {EnvironmentKeys.MODEL_MEMORY_BUDGET_MB.value}: {value}. Expected a non negative integer")
+        print(f"Using default value: {default_model_memory_budget_mb}")
+        int_value = default_model_memory_budget_mb
+
+    return int_value
+
+
+def get_inference_backend() -> InferenceBackendType:
+    """
+    Get the backend that runs the CLIP towers
+    """
+    backend = os.environ.get(EnvironmentKeys.INFERENCE_BACKEND.value, InferenceBackendType.EAGER.value)
+    try:
+        return InferenceBackendType(backend.lower())
+    except ValueError:
+        print(f"Invalid inference backend. Valid values are: {[b.value for b in InferenceBackendType]}")
+        print(f"Using default value: {InferenceBackendType.EAGER.value}")
+        return InferenceBackendType.EAGER
+
+
+def get_batch_buckets() -> List[int]:
+    """
+    Get the batch sizes the backends are compiled for, a comma separated
+    list. Larger batches are split in chunks of the largest bucket
+    """
+    value = os.environ.get(EnvironmentKeys.BATCH_BUCKETS.value, ",".join(map(str, default_batch_buckets)))
+    try:
+        buckets = sorted({int(bucket) for bucket in value.split(",") if bucket.strip()})
+    except ValueError:
+        buckets = []
+
+    if not buckets or buckets[0] <= 0:
+        print(f"Invalid value for {EnvironmentKeys.BATCH_BUCKETS.value}: {value}. Expected a comma separated list of positive integers")
+        print(f"Using default value: {default_batch_buckets}")
+        buckets = default_batch_buckets
+
+    return buckets
+
+
+def get_onnx_cache_dir() -> str:
+    """
+    Get the directory the models exported to ONNX are stored in
+    """
+    return os.environ.get(EnvironmentKeys.ONNX_CACHE_DIR.value, default_onnx_cache_dir)
+
+
+def get_clip_precision() -> ClipPrecision:
+    """
+    Get the precision the CLIP models are converted to when loaded
+    """
+    precision = os.environ.get(EnvironmentKeys.CLIP_PRECISION.value, ClipPrecision.FP32.value)
+    try:
+        return ClipPrecision(precision.lower())
+    except ValueError:
+        print(f"Invalid CLIP precision. Valid values are: {[p.value for p in ClipPrecision]}")
+        print(f"Using default value: {ClipPrecision.FP32.value}")
+        return ClipPrecision.FP32
+
+
+def get_worker_mode() -> WorkerMode:
+    """
+    Get the jobs served by the worker and the towers it loads
+    """
+    mode = os.environ.get(EnvironmentKeys.WORKER_MODE.value, WorkerMode.FULL.value)
+    try:
+        return WorkerMode(mode.lower())
+    except ValueError:
+        print(f"Invalid worker mode. Valid values are: {[m.value for m in WorkerMode]}")
+        print(f"Using default value: {WorkerMode.FULL.value}")
+        return WorkerMode.FULL
+
+
+def get_priority_policy() -> PriorityPolicy:
+    """
+    Get how the jobs of the priority classes are read
+    """
+    policy = os.environ.get(EnvironmentKeys.PRIORITY_POLICY.value, PriorityPolicy.WEIGHTED.value)
+    try:
+        return PriorityPolicy(policy.lower())
+    except ValueError:
+        print(f"Invalid priority policy. Valid values are: {[p.value for p in PriorityPolicy]}")
+        print(f"Using default value: {PriorityPolicy.WEIGHTED.value}")
+        return PriorityPolicy.WEIGHTED
+
+
+def get_priority_weights() -> List[int]:
+    """
+    Get the weights of the priority classes with the weighted policy, a comma
+    separated list in the order of the classes, highest priority first
+    """
+    value = os.environ.get(EnvironmentKeys.PRIORITY_WEIGHTS.value, ",".join(map(str, default_priority_weights)))
+    try:
+        weights = [int(weight) for weight in value.split(",") if weight.strip()]
+    except ValueError:
+        weights = []
+
+    if len(weights) != len(default_priority_weights) or min(weights) <= 0:
+        print(f"Invalid value for {EnvironmentKeys.PRIORITY_WEIGHTS.value}: {value}. Expected {len(default_priority_weights)} comma separated positive integers")
+        print(f"Using default value: {default_priority_weights}")
+        weights = default_priority_weights
+
+    return weights
+
+
+def get_redis_url() -> str:
+    """
+    Get the URL of the Redis server, from its host and port
+    """
+    host = os.environ.get(EnvironmentKeys.REDIS_HOST.value, default_redis_host)
+    port = _get_positive_int(EnvironmentKeys.REDIS_PORT, default_redis_port)
+    return f"redis://{host}:{port}"
+
+
+def get_metrics_port() -> int:
+    """
+    Get the port the Prometheus metrics of the worker are served on, 0 disables them
+    """
+    value = os.environ.get(EnvironmentKeys.METRICS_PORT.value, str(default_metrics_port))
+    try:
+        port = int(value)
+    except ValueError:
+        port = -1
+
+    if not 0 <= port <= 65535:
+        print(f"Invalid value for {EnvironmentKeys.METRICS_PORT.value}: {value}. Expected a port number or 0")
+        print(f"Using default value: {default_metrics_port}")
+        port = default_metrics_port
+
+    return port
@@ -0,0 +1,101 @@
+"""
+Check that the images downscaled by the API (`IMAGE_DOWNSCALE`) give
+the same embeddings as the full size images, on a local sample of
+images. Reports the cosine similarity between the two embeddings of
+every image, the bytes sent to the worker and the time the worker
+spends decoding and preprocessing. Exits with an error when the
+similarity of any image is below `--min-cosine`.
+
+Run it inside the inference container, e.g.:
+
+    python3 src/evaluate_downscale.py --images /samples
+"""
+import argparse
+import os
+import sys
+import time
+from typing import List, Tuple
+
+import torch
+from transformers import CLIPImageProcessor, CLIPModel, CLIPTokenizerFast
+
+from backends import InferenceBackend
+from evaluate_precision import IMAGE_EXTENSIONS
+from image_downscale import downscale_image, model_input_size
+from image_pipeline import prepare_image
+from environment_variables import valid_clip_model_names
+
+
+def preprocess(
+        images_bytes: List[bytes],
+        image_processor: CLIPImageProcessor) -> Tuple[torch.Tensor, float]:
+    """
+    Decode and preprocess images like the inference worker
+
+    Returns:
+    - torch.Tensor: The pixel values of the images
+    - float: The seconds spent per image
+    """
+    start = time.perf_counter()
+    prepared = [prepare_image(image_processor, image_bytes=data) for data in images_bytes]
+    seconds_per_image = (time.perf_counter() - start) / len(images_bytes)
+
+    errors = [image.error for image in prepared if image.error is not None]
+    if errors:
+        raise SystemExit(f"Could not decode {len(errors)} images, e.g. {errors[0]}")
+    return torch.stack([image.pixel_values for image in prepared]), seconds_per_image
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the downscaled images with the full size ones")
+    parser.add_argument("--images", required=True, help="Directory with the sample images")
+    parser.add_argument("--model", default=valid_clip_model_names[0], choices=valid_clip_model_names)
+    parser.add_argument("--quality", type=int, default=95, help="JPEG quality of the downscaled images")
+    parser.add_argument("--min-cosine", type=float, default=0.99, help="Minimum accepted similarity")
+    parser.add_argument("--limit", type=int, default=256, help="Maximum number of images")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    paths = sorted(
+        os.path.join(args.images, name)
+        for name in os.listdir(args.images)
+        if name.lower().endswith(IMAGE_EXTENSIONS))[:args.limit]
+    if not paths:
+        raise SystemExit(f"No images found in {args.images}")
+    full_bytes = []
+    for path in paths:
+        with open(path, "rb") as f:
+            full_bytes.append(f.read())
+
+    start = time.perf_counter()
+    downscaled_bytes = [
+        downscale_image(data, model_input_size(args.model), args.quality) for data in full_bytes]
+    downscale_seconds = (time.perf_counter() - start) / len(full_bytes)
+
+    image_processor = CLIPImageProcessor.from_pretrained(args.model)
+    full_pixels, full_seconds = preprocess(full_bytes, image_processor)
+    downscaled_pixels, downscaled_seconds = preprocess(downscaled_bytes, image_processor)
+
+    tokenizer = CLIPTokenizerFast.from_pretrained(args.model)
+    model = CLIPModel.from_pretrained(args.model).to(args.device).eval()
+    backend = InferenceBackend(model, tokenizer, args.device, [args.batch_size])
+    full_embeds = backend.encode_image(full_pixels).float()
+    downscaled_embeds = backend.encode_image(downscaled_pixels).float()
+    cosine = torch.nn.functional.cosine_similarity(full_embeds, downscaled_embeds, dim=-1).cpu()
+
+    print(f"Evaluated {args.model} on {len(paths)} images")
+    print(f"{'':<12}{'MB sent':>10}{'worker ms/image':>17}{'api ms/image':>14}")
+    print(f"{'full size':<12}{sum(map(len, full_bytes)) / 2**20:>10.2f}{full_seconds * 1000:>17.2f}{0:>14.2f}")
+    print(f"{'downscaled':<12}{sum(map(len, downscaled_bytes)) / 2**20:>10.2f}"
+          f"{downscaled_seconds * 1000:>17.2f}{downscale_seconds * 1000:>14.2f}")
+    print(f"Cosine similarity: mean {cosine.mean().item():.5f}, min {cosine.min().item():.5f}")
+
+    worst = cosine.argmin().item()
+    if cosine[worst].item() < args.min_cosine:
+        print(f"{paths[worst]} is below the minimum cosine similarity {args.min_cosine}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
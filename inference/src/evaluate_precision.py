@@ -0,0 +1,135 @@
+"""
+Compare the reduced precision modes of a CLIP model with float32 on
+a local sample of images. Reports the cosine similarity between the
+embeddings of every precision and the float32 ones (the drift), the
+agreement of the zero-shot top-1 labels and the time per image.
+
+Run it inside the inference container, e.g.:
+
+    python3 src/evaluate_precision.py --images /samples --labels labels.txt
+
+`--labels` is a text file with one label per line, a small generic
+set of labels is used if not provided.
+"""
+import argparse
+import os
+import time
+from typing import Dict, List
+
+import torch
+from PIL import Image
+from transformers import CLIPImageProcessor, CLIPModel, CLIPTokenizerFast
+
+from backends import InferenceBackend
+from precision import apply_precision, resolve_precision
+from environment_variables import ClipPrecision, valid_clip_model_names
+
+DEFAULT_LABELS = [
+    "a photo of a person", "a photo of a dog", "a photo of a cat", "a photo of a car",
+    "a photo of a building", "a photo of food", "a photo of a landscape", "a photo of a bird",
+    "a screenshot", "a drawing",
+]
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif")
+
+
+def load_images(images_dir: str, image_processor: CLIPImageProcessor, limit: int) -> torch.Tensor:
+    """
+    Load and preprocess up to `limit` images of a directory,
+    images that cannot be decoded are skipped
+    """
+    paths = sorted(
+        os.path.join(images_dir, name)
+        for name in os.listdir(images_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS))[:limit]
+
+    pixel_values = []
+    for path in paths:
+        try:
+            with Image.open(path) as img:
+                pixel_values.append(image_processor(images=img.convert("RGB"), return_tensors="pt")["pixel_values"][0])
+        except Exception as e:
+            print(f"Skipping {path}: {type(e).__name__}: {e}")
+
+    if not pixel_values:
+        raise SystemExit(f"No images found in {images_dir}")
+    return torch.stack(pixel_values)
+
+
+def evaluate(
+        backend: InferenceBackend,
+        pixel_values: torch.Tensor,
+        labels: List[str]) -> Dict[str, torch.Tensor]:
+    """
+    Embed the images and labels and classify the images
+
+    Returns:
+    - Dict[str, torch.Tensor]: The normalized `text` and `image` embeddings
+        as float32, the `top1` label index of every image and the
+        `seconds_per_image` spent embedding the images
+    """
+    text_embeds = backend.encode_text(labels).float()
+    text_embeds = text_embeds / text_embeds.norm(p=2, dim=-1, keepdim=True)
+
+    start = time.perf_counter()
+    image_embeds = backend.encode_image(pixel_values).float()
+    seconds_per_image = (time.perf_counter() - start) / pixel_values.shape[0]
+    image_embeds = image_embeds / image_embeds.norm(p=2, dim=-1, keepdim=True)
+
+    _, probs = backend.classify(image_embeds, text_embeds)
+    return {
+        "text": text_embeds.cpu(),
+        "image": image_embeds.cpu(),
+        "top1": probs.argmax(dim=1).cpu(),
+        "seconds_per_image": torch.tensor(seconds_per_image),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the CLIP precision modes with float32")
+    parser.add_argument("--images", required=True, help="Directory with the sample images")
+    parser.add_argument("--labels", help="Text file with one label per line")
+    parser.add_argument("--model", default=valid_clip_model_names[0], choices=valid_clip_model_names)
+    parser.add_argument(
+        "--precisions", nargs="+", default=[p.value for p in ClipPrecision if p != ClipPrecision.FP32],
+        choices=[p.value for p in ClipPrecision if p != ClipPrecision.FP32])
+    parser.add_argument("--limit", type=int, default=256, help="Maximum number of images")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    labels = DEFAULT_LABELS
+    if args.labels:
+        with open(args.labels) as f:
+            labels = [line.strip() for line in f if line.strip()]
+
+    tokenizer = CLIPTokenizerFast.from_pretrained(args.model)
+    image_processor = CLIPImageProcessor.from_pretrained(args.model)
+    pixel_values = load_images(args.images, image_processor, args.limit)
+    print(f"Evaluating {args.model} on {pixel_values.shape[0]} images and {len(labels)} labels")
+
+    def load(precision: ClipPrecision) -> InferenceBackend:
+        model = CLIPModel.from_pretrained(args.model).to(args.device).eval()
+        return InferenceBackend(apply_precision(model, precision), tokenizer, args.device, [args.batch_size])
+
+    reference = evaluate(load(ClipPrecision.FP32), pixel_values, labels)
+
+    print(f"{'precision':<10}{'text cos mean':>15}{'text cos min':>14}{'image cos mean':>16}"
+          f"{'image cos min':>15}{'top-1 agree':>13}{'ms/image':>10}")
+    rows = [(ClipPrecision.FP32, reference)]
+    for value in args.precisions:
+        precision = resolve_precision(ClipPrecision(value), args.device)
+        if precision == ClipPrecision.FP32:
+            continue
+        rows.append((precision, evaluate(load(precision), pixel_values, labels)))
+
+    for precision, result in rows:
+        text_cos = (result["text"] * reference["text"]).sum(dim=1)
+        image_cos = (result["image"] * reference["image"]).sum(dim=1)
+        agreement = (result["top1"] == reference["top1"]).float().mean().item()
+        print(f"{precision.value:<10}{text_cos.mean().item():>15.5f}{text_cos.min().item():>14.5f}"
+              f"{image_cos.mean().item():>16.5f}{image_cos.min().item():>15.5f}"
+              f"{agreement:>12.1%}{result['seconds_per_image'].item() * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
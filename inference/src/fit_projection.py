@@ -0,0 +1,89 @@
+"""
+Fit a PCA projection of the CLIP embeddings on a local sample set and
+store it in Redis, where the API loads it for the requests with
+`projection`. The projection is fitted on the normalized image (and
+text) embeddings, its components are sorted by explained variance so
+the projected embeddings can be truncated further with `dimensions`.
+
+Run it inside the inference container, e.g.:
+
+    python3 src/fit_projection.py --name photos-128 --dimensions 128 --images /samples
+"""
+import argparse
+import uuid
+
+import numpy as np
+import redis
+import torch
+from transformers import CLIPImageProcessor, CLIPModel, CLIPTokenizerFast
+
+from backends import InferenceBackend
+from evaluate_precision import load_images
+from environment_variables import valid_clip_model_names
+
+
+def fit_pca(embeddings: np.ndarray, dimensions: int):
+    """
+    Fit a PCA on the rows of `embeddings`
+
+    Args:
+    - embeddings (np.ndarray): The normalized embeddings, (n_samples, dim)
+    - dimensions (int): The number of principal components kept
+
+    Returns:
+    - np.ndarray: The mean of the embeddings, (dim,)
+    - np.ndarray: The principal components, (dim, dimensions)
+    - np.ndarray: The fraction of the variance explained by every component
+    """
+    mean = embeddings.mean(axis=0)
+    _, singular_values, vt = np.linalg.svd(embeddings - mean, full_matrices=False)
+    variance = singular_values ** 2
+    return mean, vt[:dimensions].T, variance[:dimensions] / variance.sum()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fit a PCA projection of the CLIP embeddings")
+    parser.add_argument("--name", required=True, help="Name of the projection used by the requests")
+    parser.add_argument("--dimensions", type=int, required=True, help="Dimensions of the projected embeddings")
+    parser.add_argument("--images", required=True, help="Directory with the sample images")
+    parser.add_argument("--texts", help="Text file with one sample text per line")
+    parser.add_argument("--model", default=valid_clip_model_names[0], choices=valid_clip_model_names)
+    parser.add_argument("--limit", type=int, default=10000, help="Maximum number of images")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--redis-url", default="redis://redis:6379")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+
+    tokenizer = CLIPTokenizerFast.from_pretrained(args.model)
+    image_processor = CLIPImageProcessor.from_pretrained(args.model)
+    model = CLIPModel.from_pretrained(args.model).to(args.device).eval()
+    backend = InferenceBackend(model, tokenizer, args.device, [args.batch_size])
+
+    embeddings = [backend.encode_image(load_images(args.images, image_processor, args.limit)).float()]
+    if args.texts:
+        with open(args.texts) as f:
+            texts = [line.strip() for line in f if line.strip()]
+        embeddings.append(backend.encode_text(texts).float())
+
+    embeddings = torch.cat(embeddings)
+    embeddings = (embeddings / embeddings.norm(p=2, dim=-1, keepdim=True)).cpu().numpy()
+    if args.dimensions > min(embeddings.shape):
+        raise SystemExit(f"At least {args.dimensions} samples of {embeddings.shape[1]} dimensions are needed")
+
+    mean, components, explained = fit_pca(embeddings, args.dimensions)
+    print(f"Fitted on {embeddings.shape[0]} embeddings, explained variance {explained.sum():.1%}")
+
+    version = str(uuid.uuid4())
+    redis_client = redis.Redis.from_url(args.redis_url)
+    redis_client.hset(f"projection:{args.model}:{args.name}", mapping={
+        "mean": mean.astype("<f4").tobytes(),
+        "components": np.ascontiguousarray(components, dtype="<f4").tobytes(),
+        "dimensions": args.dimensions,
+        "samples": embeddings.shape[0],
+        "version": version,
+    })
+    print(f"Stored projection {args.name} for {args.model}, version {version}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+Prefetch pipeline for the inference worker. Batches are pulled from the
+queue and their images decoded and preprocessed by a pool of threads
+while the model is busy with the previous batch.
+"""
+import io
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import redis
+import torch
+from PIL import Image
+from transformers import CLIPImageProcessor
+
+import redis_models
+import worker_metrics
+from batch_scheduler import collect_batch, split_expired
+from job_queue import JobQueue
+
+
+@dataclass
+class PreparedImage:
+    """
+    A preprocessed image, either `pixel_values` or `error` is set.
+    Neither is set for images whose features were sent with the job
+    """
+    pixel_values: Optional[torch.Tensor] = None
+    error: Optional[str] = None
+
+
+@dataclass
+class PreparedBatch:
+    """
+    A batch of jobs together with their preprocessed images,
+    `images[i]` holds the images of `jobs[i]` in request order
+    """
+    jobs: List[redis_models.RedisRequestItem]
+    images: List[List[PreparedImage]] = field(default_factory=list)
+
+
+def prepare_image(
+        image_processor: CLIPImageProcessor,
+        image_bytes: Optional[bytes] = None,
+        image_path: Optional[str] = None) -> PreparedImage:
+    """
+    Decode and preprocess a single image, read either from `image_bytes`
+    or from the file at `image_path`. The image file is kept until the
+    job is acknowledged, so that it can be retried by another worker
+
+    Args:
+    - image_processor (CLIPImageProcessor): The CLIP image processor
+    - image_bytes (Optional[bytes]): The raw bytes of the image
+    - image_path (Optional[str]): The path of the image
+
+    Returns:
+    - PreparedImage: The `pixel_values` of the image, or the error message
+    """
+    try:
+        if image_bytes is not None:
+            source = io.BytesIO(image_bytes)
+        elif image_path is not None:
+            source = image_path
+        else:
+            raise ValueError("Image data not found, it may have expired before being processed")
+
+        start = time.perf_counter()
+        with Image.open(source) as img:
+            # Image.open is lazy, force the decoding on this thread
+            img.load()
+            worker_metrics.observe_stage(worker_metrics.IMAGE_DECODE_STAGE, start, "image")
+            start = time.perf_counter()
+            pixel_values = image_processor(images=img, return_tensors="pt")["pixel_values"][0]
+            worker_metrics.observe_stage(worker_metrics.PREPROCESS_STAGE, start, "image")
+        return PreparedImage(pixel_values=pixel_values)
+    except Exception as e:
+        return PreparedImage(error=f"{type(e).__name__}: {e}")
+
+
+def _time_preprocess(job: redis_models.RedisRequestItem, futures: List[Future]):
+    """
+    Set the preprocess times of a job, from the submission of its
+    images to the last one decoded. Jobs without images to decode
+    have no preprocess times
+    """
+    if job.timings is None or all(future.done() for future in futures):
+        return
+    job.timings.preprocess_start = time.time()
+
+    def done(_: Future):
+        # Called by the thread that decoded the image, the
+        # last image of the job sets the end
+        end = time.time()
+        if job.timings.preprocess_end is None or end > job.timings.preprocess_end:
+            job.timings.preprocess_end = end
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+class ImagePrefetcher():
+    """
+    Two stage pipeline: a background thread collects batches from the
+    job queue and submits their images to a thread pool, the
+    inference loop consumes the batches with `get`. The queue between
+    the stages is bounded so that at most `prefetch_batches` batches
+    are pulled from Redis ahead of the model
+    """
+    def __init__(
+            self,
+            redis_client: redis.Redis,
+            job_queue: JobQueue,
+            image_processors: Dict[str, CLIPImageProcessor],
+            max_batch_size: int,
+            max_batch_wait_ms: int,
+            num_workers: int,
+            prefetch_batches: int):
+        """
+        Constructor for the ImagePrefetcher class
+
+        Args:
+        - redis_client (redis.Redis): The Redis client
+        - job_queue (JobQueue): The job queue
+        - image_processors (Dict[str, CLIPImageProcessor]): The image processor of every model
+        - max_batch_size (int): The maximum number of jobs in a batch
+        - max_batch_wait_ms (int): The maximum time to wait for a batch to fill up
+        - num_workers (int): The number of decoding threads
+        - prefetch_batches (int): The maximum number of batches prepared ahead
+        """
+        self.redis_client = redis_client
+        self.job_queue = job_queue
+        self.image_processors = image_processors
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait_ms = max_batch_wait_ms
+
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="preprocess")
+        self.batches: queue.Queue = queue.Queue(maxsize=prefetch_batches)
+        self.thread = threading.Thread(target=self._produce, name="prefetch", daemon=True)
+
+    def start(self):
+        """
+        Start pulling batches from the queue
+        """
+        self.thread.start()
+
+    def _produce(self):
+        """
+        Collect batches and submit the decoding of their images,
+        blocks when `prefetch_batches` batches are already waiting.
+        Errors are logged and the thread keeps running, otherwise
+        the inference loop would wait forever in `get`. Jobs read
+        when an error occurs stay pending and are reclaimed
+        """
+        while True:
+            try:
+                self._produce_batch()
+            except redis.RedisError as e:
+                print(f"Error while collecting a batch: {e}")
+                time.sleep(1)
+            except Exception as e:
+                print(f"Unexpected error while collecting a batch: {type(e).__name__}: {e}")
+                traceback.print_exc()
+                time.sleep(1)
+
+    def _produce_batch(self):
+        """
+        Collect a batch and submit the decoding of its images
+        """
+        jobs = collect_batch(self.job_queue, self.max_batch_size, self.max_batch_wait_ms)
+        if not jobs:
+            return
+
+        jobs, expired = split_expired(jobs, time.time())
+        if expired:
+            self._discard(expired)
+        if not jobs:
+            return
+
+        try:
+            images_bytes = self._fetch_images_bytes(jobs)
+        except redis.RedisError as e:
+            print(f"Error while fetching the images of a batch: {e}")
+            images_bytes = {}
+
+        futures = []
+        for job in jobs:
+            job_futures = [
+                self._submit(job.model_name, img_item, images_bytes) for img_item in job.images]
+            _time_preprocess(job, job_futures)
+            futures.append(job_futures)
+
+        self.batches.put((jobs, futures))
+
+    def _submit(
+            self,
+            model_name: str,
+            img_item: redis_models.RedisImageItem,
+            images_bytes: Dict[str, bytes]) -> Future:
+        """
+        Submit the decoding of an image with the image processor of
+        `model_name`, models differ in input resolution. Images with
+        known features need no decoding and resolve to an empty `PreparedImage`.
+        Images that cannot be submitted resolve to their error
+        """
+        if img_item.embedding is not None:
+            future = Future()
+            future.set_result(PreparedImage())
+            return future
+
+        try:
+            return self.executor.submit(
+                prepare_image,
+                self.image_processors[model_name],
+                image_bytes=images_bytes.get(img_item.image_key),
+                image_path=img_item.image_path)
+        except Exception as e:
+            future = Future()
+            future.set_result(PreparedImage(error=f"{type(e).__name__}: {e}"))
+            return future
+
+    def _discard(self, jobs: List[redis_models.RedisRequestItem]):
+        """
+        Drop jobs whose deadline has passed without decoding
+        their images, the jobs are acknowledged right away
+        """
+        print(f"Dropping {len(jobs)} expired jobs")
+        try:
+            self.job_queue.ack(jobs)
+        except redis.RedisError as e:
+            print(f"Error while acknowledging expired jobs: {e}")
+
+    def _fetch_images_bytes(self, jobs: List[redis_models.RedisRequestItem]) -> Dict[str, bytes]:
+        """
+        Read the images stored in Redis for the jobs of a batch, in a
+        single round trip. The images are deleted when the jobs are
+        acknowledged
+
+        Args:
+        - jobs (List[RedisRequestItem]): The jobs of the batch
+
+        Returns:
+        - Dict[str, bytes]: The image bytes by Redis key, missing
+            keys are not included
+        """
+        images_key = [
+            img_item.image_key
+            for job in jobs
+            for img_item in job.images
+            if img_item.image_key is not None]
+        if not images_key:
+            return {}
+
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for key in images_key:
+            pipeline.get(key)
+        values = pipeline.execute()
+
+        return {
+            key: value
+            for key, value in zip(images_key, values)
+            if value is not None}
+
+    def get(self) -> PreparedBatch:
+        """
+        Get the next batch, waiting for its images to be ready
+
+        Returns:
+        - PreparedBatch: The jobs and their preprocessed images
+        """
+        jobs, futures = self.batches.get()
+        images = [
+            [future.result() for future in job_futures]
+            for job_futures in futures]
+        return PreparedBatch(jobs=jobs, images=images)
@@ -1,131 +1,498 @@
-import os
+import math
+import time
+import traceback
 import uuid
+from typing import List, Tuple
 
 import redis
 import torch
 import numpy as np
-import PIL
-from transformers import CLIPProcessor, CLIPModel, CLIPTokenizerFast
+from transformers import CLIPImageProcessor
 
 import redis_models
-from environment_variables import get_clip_model_name
+import worker_metrics
+from batch_scheduler import group_jobs, split_expired
+from image_pipeline import ImagePrefetcher, PreparedBatch, PreparedImage
+from job_queue import JobQueue, WORKER_MODALITIES
+from model_pool import ModelPool
+from towers import load_logit_scale
+from precision import resolve_precision
+from zero_shot import LabelSetStore
+from backends import InferenceBackend
+from worker_stats import WorkerStats, get_worker_id
+from environment_variables import (
+    get_clip_model_names, get_model_memory_budget_mb, get_max_batch_size, get_max_batch_wait_ms,
+    get_preprocess_workers, get_prefetch_batches, get_job_claim_idle_ms,
+    get_job_max_deliveries, get_inference_backend, get_clip_precision, get_batch_buckets, get_onnx_cache_dir,
+    get_worker_mode, WorkerMode, get_priority_policy, get_priority_weights, get_metrics_port,
+    get_redis_url)
 
-def run_inference(model_name: str, device: str):
+# Expiration of the reply queues, refreshed at every push
+REPLY_QUEUE_TTL_S = 300
+
+
+def _image_errors(images: List[PreparedImage]) -> List[redis_models.ImageError]:
+    """
+    Collect the errors of the images that could not be preprocessed
+    """
+    return [
+        redis_models.ImageError(image_index=idx, error=image.error)
+        for idx, image in enumerate(images)
+        if image.error is not None]
+
+
+def _pack(features) -> List[str]:
+    """
+    Pack a chunk of features as binary embeddings, chunks can be
+    empty when a job has no valid input
+    """
+    # numpy has no bfloat16, the features are packed as float32 anyway
+    return redis_models.pack_embeddings(features.float().cpu().numpy()) if len(features) else []
+
+
+def _known_features(packed: str, backend: InferenceBackend) -> torch.Tensor:
+    """
+    Unpack features that were sent with the job
+    """
+    known = redis_models.unpack_embedding(packed)
+    return torch.from_numpy(known.copy()).to(device=backend.device, dtype=backend.dtype)
+
+
+@torch.inference_mode()
+def run_batch(
+        batch: PreparedBatch,
+        backend: InferenceBackend,
+        label_sets: LabelSetStore,
+        model_name: str) -> List[redis_models.RedisResponseItem]:
     """
-    Run the inference loop continuously pulling requests from the Redis queue
-    and pushing the responses back to the respective queues based on the job_id
-    
+    Run the inference for a batch of jobs. All the texts in the batch are
+    embedded with a single `encode_text` call and all the images with
+    a single `encode_image` call, the results are then scattered back
+    to the respective jobs. Texts and images whose features were sent with
+    the job (e.g. cached by the API) are not run through the model. Images
+    that failed to decode are skipped and reported in the `errors` of their job
+
     Args:
+    - batch (PreparedBatch): The jobs to process and their preprocessed images
+    - backend (InferenceBackend): The backend running the CLIP model
+    - label_sets (LabelSetStore): The registered label sets
     - model_name (str): The name of the CLIP model
-    - device (str): The device to run the inference on
+
+    Returns:
+    - List[RedisResponseItem]: The responses, in the same order as `batch.jobs`
     """
-    _redis_client = redis.Redis.from_url(url='redis://redis:6379', decode_responses=False)
+    jobs = batch.jobs
+    prepared_by_job = {job.job_id: images for job, images in zip(jobs, batch.images)}
 
-    tokenizer = CLIPTokenizerFast.from_pretrained(model_name, device_map="auto")
-    model = CLIPModel.from_pretrained(model_name, device_map="auto").to(device)
-    processor = CLIPProcessor.from_pretrained(model_name, device_map="auto")
-        
-    result = _redis_client.ping()
-    if not result:
-        raise ConnectionError("Could not connect to the Redis server")
-    else:
-        print("Connected to the Redis server: ", result)
+    text_jobs, image_jobs, classification_jobs = group_jobs(jobs)
+    forward_start = time.time()
 
-    while True:
-        # Result is a 2 element tuple of (queue_id, value)
-        result = _redis_client.brpop("requests", timeout=1)
-        if not result:
-            continue
+    # Text-only jobs first, then the labels of the classification jobs
+    txt_list = [
+        txt_item.text
+        for job in text_jobs + classification_jobs
+        for txt_item in job.texts
+        if txt_item.embedding is None]
 
-        queue_item = redis_models.RedisRequestItem.from_json(result[1])
-        response = redis_models.RedisResponseItem(model_name=model_name)
+    # Image-only jobs first, then the images of the classification jobs
+    pixel_values = [
+        prepared.pixel_values
+        for job in image_jobs + classification_jobs
+        for prepared in prepared_by_job[job.job_id]
+        if prepared.pixel_values is not None]
 
-        if not queue_item.images:
-            # Embed the text
-            txt_list = [txt_item.text for txt_item in queue_item.texts]
-            inputs = tokenizer(txt_list, return_tensors="pt", padding=True).to(device)
-            outputs = model.get_text_features(**inputs)
-            model_embeddings = outputs.cpu().detach().numpy().tolist()
+    text_features = None
+    if txt_list:
+        text_features = backend.encode_text(txt_list)
 
-            response.text_embeddings = [
-                redis_models.TextEmbedding(text=txt, embedding=embedding) 
-                for txt, embedding in zip(txt_list, model_embeddings)]
+    image_features = None
+    if pixel_values:
+        image_features = backend.encode_image(torch.stack(pixel_values))
 
-        elif not queue_item.texts:
-            # Embed the images
-            img_list = [PIL.Image.open(image.image_path) for image in queue_item.images]
-            inputs = processor(images=img_list, return_tensors="pt").to(device)
-            outputs = model.get_image_features(**inputs)
-            model_embeddings = outputs.cpu().detach().numpy().tolist()
+    forward_end = time.time()
+    for job in jobs:
+        if job.timings is not None:
+            job.timings.forward_start = forward_start
+            job.timings.forward_end = forward_end
 
-            response.image_embeddings = [
-                redis_models.ImageEmbedding(image_id=str(uuid.uuid4()), embedding=embedding)
-                for embedding in model_embeddings]
+    worker_metrics.BATCH_SIZE.labels("jobs").observe(len(jobs))
+    worker_metrics.BATCH_SIZE.labels("texts").observe(len(txt_list))
+    worker_metrics.BATCH_SIZE.labels("images").observe(len(pixel_values))
+    worker_metrics.ITEMS.labels("text").inc(len(txt_list))
+    worker_metrics.ITEMS.labels("image").inc(len(pixel_values))
+    serialization_start = time.perf_counter()
 
-        else:
-            # Embed both the text and images, and perform classification
-            txt_list = [txt_item.text for txt_item in queue_item.texts]
-            img_list = [PIL.Image.open(image.image_path) for image in queue_item.images]
+    # Scatter the features back, in the same order they were gathered
+    text_chunks = {}
+    computed_idx = 0
+    for job in text_jobs + classification_jobs:
+        rows = []
+        for txt_item in job.texts:
+            if txt_item.embedding is not None:
+                rows.append(_known_features(txt_item.embedding, backend))
+            else:
+                rows.append(text_features[computed_idx])
+                computed_idx += 1
+        text_chunks[job.job_id] = torch.stack(rows) if rows else []
 
-            inputs = processor(
-                text=txt_list,
-                images=img_list,
-                return_tensors="pt",
-                padding=True
-            ).to(device)
+    image_chunks = {}
+    image_ids = {}
+    computed_idx = 0
+    for job in image_jobs + classification_jobs:
+        rows, ids = [], []
+        for img_item, prepared in zip(job.images, prepared_by_job[job.job_id]):
+            if prepared.error is not None:
+                continue
+            if img_item.embedding is not None:
+                rows.append(_known_features(img_item.embedding, backend))
+            else:
+                rows.append(image_features[computed_idx])
+                computed_idx += 1
+            ids.append(img_item.image_id or str(uuid.uuid4()))
+        image_chunks[job.job_id] = torch.stack(rows) if rows else []
+        image_ids[job.job_id] = ids
+
+    responses = {}
+
+    for job in text_jobs:
+        response = redis_models.RedisResponseItem(model_name=model_name)
+        response.text_embeddings = [
+            redis_models.RedisTextEmbedding(text=txt_item.text, embedding=embedding)
+            for txt_item, embedding in zip(job.texts, _pack(text_chunks[job.job_id]))]
+        responses[job.job_id] = response
 
-            outputs = model(**inputs)
+    for job in image_jobs:
+        response = redis_models.RedisResponseItem(model_name=model_name)
+        response.image_embeddings = [
+            redis_models.RedisImageEmbedding(image_id=image_id, embedding=embedding)
+            for image_id, embedding in zip(image_ids[job.job_id], _pack(image_chunks[job.job_id]))]
+        responses[job.job_id] = response
 
-            logits_per_image = outputs.logits_per_image
-            probs = logits_per_image.softmax(dim=1).detach().cpu().numpy().tolist()
+    for job in classification_jobs:
+        response = redis_models.RedisResponseItem(model_name=model_name)
 
-            text_embeddings = outputs.text_embeds.cpu().detach().numpy().tolist()
-            image_embeddings = outputs.image_embeds.cpu().detach().numpy().tolist()
+        if job.label_set is not None:
+            # The label embeddings of registered label sets are already
+            # normalized, they are not returned as they can be thousands
+            try:
+                txt_list, text_embeds = label_sets.get(job.label_set)
+            except KeyError as e:
+                response.error = str(e)
+                responses[job.job_id] = response
+                continue
+        else:
+            # Same as CLIPModel.forward, the embeddings are normalized
+            # and the logits scaled by the learned temperature
+            txt_features = text_chunks[job.job_id]
+            text_embeds = txt_features / txt_features.norm(p=2, dim=-1, keepdim=True)
+            txt_list = [txt_item.text for txt_item in job.texts]
 
             response.text_embeddings = [
-                redis_models.TextEmbedding(text=txt, embedding=embedding) 
-                for txt, embedding in zip(txt_list, text_embeddings)
+                redis_models.RedisTextEmbedding(text=txt, embedding=embedding)
+                for txt, embedding in zip(txt_list, _pack(text_embeds))
             ]
 
-            img_uuids = [str(uuid.uuid4()) for _ in range(len(img_list))]
+        img_features = image_chunks[job.job_id]
+        img_ids = image_ids[job.job_id]
 
-            response.image_embeddings = [
-                redis_models.ImageEmbedding(image_id=img_uuid, embedding=embedding)
-                for img_uuid, embedding in zip(img_uuids, image_embeddings)
-            ]
+        image_embeddings = []
+        indices, probs = None, []
+        if len(img_features):
+            image_embeds = img_features / img_features.norm(p=2, dim=-1, keepdim=True)
+            indices, probs = backend.classify(image_embeds, text_embeds, job.top_k)
+            probs = probs.float().cpu().numpy().tolist()
+            image_embeddings = _pack(image_embeds)
+
+        response.image_embeddings = [
+            redis_models.RedisImageEmbedding(image_id=img_id, embedding=embedding)
+            for img_id, embedding in zip(img_ids, image_embeddings)
+        ]
 
+        if indices is None:
+            softmax_outputs = [
+                redis_models.SoftmaxOutput(image_id=img_id, softmax_scores=probs[idx])
+                for idx, img_id in enumerate(img_ids)
+            ]
+        else:
+            # With top_k every image has its own labels, the
+            # full list of labels is not returned
             softmax_outputs = [
-                redis_models.SoftmaxOutput(image_id=img_uuid, softmax_scores=probs[idx])
-                for idx, img_uuid in enumerate(img_uuids)
+                redis_models.SoftmaxOutput(
+                    image_id=img_id, 
+                    softmax_scores=probs[idx],
+                    labels=[txt_list[label_idx] for label_idx in indices[idx].tolist()])
+                for idx, img_id in enumerate(img_ids)
             ]
+            txt_list = []
+
+        response.classification_result = redis_models.ClassificationResult(
+            labels=txt_list,
+            softmax_outputs=softmax_outputs
+        )
+        responses[job.job_id] = response
 
-            response.classification_result = redis_models.ClassificationResult(
-                labels=txt_list,
-                softmax_outputs=softmax_outputs
-            )
-            
+    for job in jobs:
+        errors = _image_errors(prepared_by_job[job.job_id])
+        if errors:
+            responses[job.job_id].errors = errors
 
-        # remove the image files
-        for img_item in queue_item.images:
-            img_path = img_item.image_path
-            os.remove(img_path)
+    worker_metrics.observe_stage(worker_metrics.SERIALIZATION_STAGE, serialization_start)
+    return [responses[job.job_id] for job in jobs]
 
-        # Build the response queue name
-        redis_response_key = f"{queue_item.job_id}-response"
 
-        _redis_client.lpush(
-            redis_response_key,
-            response.to_json()
-        )
+def answer_batch(
+        batch: PreparedBatch,
+        model_pool: ModelPool,
+        label_sets: LabelSetStore,
+        model_name: str
+    ) -> Tuple[List[redis_models.RedisResponseItem], List[redis_models.RedisRequestItem]]:
+    """
+    Run a batch of jobs of a model, isolating the jobs that fail. When the
+    batch fails its jobs are run one at a time, so that a job the model
+    cannot run does not fail the others, and the jobs that still fail
+    are answered with their error
+
+    Args:
+    - batch (PreparedBatch): The jobs of the model and their preprocessed images
+    - model_pool (ModelPool): The pool of the loaded models
+    - label_sets (LabelSetStore): The registered label sets
+    - model_name (str): The name of the CLIP model
+
+    Returns:
+    - List[RedisResponseItem]: The responses, in the same order as `batch.jobs`
+    - List[RedisRequestItem]: The jobs that failed
+    """
+    backend = None
+    try:
+        backend = model_pool.get(model_name).backend
+        return run_batch(batch, backend, label_sets, model_name), []
+    except Exception as e:
+        print(f"Batch of {len(batch.jobs)} jobs of {model_name} failed: {type(e).__name__}: {e}")
+        traceback.print_exc()
+        batch_error = f"Inference failed: {type(e).__name__}: {e}"
+
+    # Without the model, or with a single job, retrying cannot isolate anything
+    if backend is None or len(batch.jobs) == 1:
+        responses = [
+            redis_models.RedisResponseItem(model_name=model_name, error=batch_error)
+            for _ in batch.jobs]
+        return responses, list(batch.jobs)
+
+    responses, failed = [], []
+    for job, images in zip(batch.jobs, batch.images):
+        try:
+            responses.extend(run_batch(PreparedBatch(jobs=[job], images=[images]), backend, label_sets, model_name))
+        except Exception as e:
+            print(f"Job {job.job_id} of {model_name} failed: {type(e).__name__}: {e}")
+            responses.append(redis_models.RedisResponseItem(
+                model_name=model_name, error=f"Inference failed: {type(e).__name__}: {e}"))
+            failed.append(job)
+    return responses, failed
+
+
+def split_by_model(batch: PreparedBatch) -> List[PreparedBatch]:
+    """
+    Split a batch in one batch per model, jobs of different
+    models are read together but run on their own model
+
+    Args:
+    - batch (PreparedBatch): The batch
+
+    Returns:
+    - List[PreparedBatch]: The batches, one per model
+    """
+    by_model = {}
+    for job, images in zip(batch.jobs, batch.images):
+        model_batch = by_model.setdefault(job.model_name, PreparedBatch(jobs=[]))
+        model_batch.jobs.append(job)
+        model_batch.images.append(images)
+    return list(by_model.values())
+
+
+def drop_expired(batch: PreparedBatch, job_queue: JobQueue) -> PreparedBatch:
+    """
+    Remove the jobs whose deadline has passed from a batch, nobody
+    is waiting for their response anymore so they are acknowledged
+    without running them
+
+    Args:
+    - batch (PreparedBatch): The batch
+    - job_queue (JobQueue): The job queue
+
+    Returns:
+    - PreparedBatch: The batch with the live jobs only
+    """
+    live, expired = split_expired(batch.jobs, time.time())
+    if not expired:
+        return batch
+
+    print(f"Dropping {len(expired)} expired jobs")
+    job_queue.ack(expired)
+    live_ids = {job.job_id for job in live}
+    return PreparedBatch(
+        jobs=live,
+        images=[images for job, images in zip(batch.jobs, batch.images) if job.job_id in live_ids])
+
+
+def push_responses(
+        redis_client: redis.Redis,
+        jobs: List[redis_models.RedisRequestItem],
+        responses: List[redis_models.RedisResponseItem]):
+    """
+    Push the responses in a single round trip to the reply queue of
+    the API process that enqueued each job, or to the `{job_id}-response`
+    queue for jobs without `reply_to`. The timings of every job
+    are sent back with its response
+
+    Args:
+    - redis_client (redis.Redis): The Redis client
+    - jobs (List[RedisRequestItem]): The jobs of the batch
+    - responses (List[RedisResponseItem]): The responses, in the same order as `jobs`
+    """
+    start = time.perf_counter()
+    pipeline = redis_client.pipeline(transaction=False)
+    for job, response in zip(jobs, responses):
+        response.job_id = job.job_id
+        if job.timings is not None:
+            job.timings.pushed = time.time()
+            response.timings = job.timings
+        reply_queue = job.reply_to or f"{job.job_id}-response"
+        pipeline.lpush(reply_queue, response.to_json())
+        # Replies are dropped if the API process that
+        # should read them is gone
+        pipeline.expire(reply_queue, REPLY_QUEUE_TTL_S)
+    pipeline.execute()
+    worker_metrics.observe_stage(worker_metrics.PUSH_STAGE, start)
+
+
+def run_inference(model_names: List[str], device: str, worker_mode: WorkerMode = WorkerMode.FULL):
+    """
+    Run the inference loop continuously pulling batches of requests from
+    the Redis job streams of `model_names`, for the modalities served by
+    `worker_mode`, and pushing the responses back
+    to the respective queues based on the job_id. Jobs are acknowledged
+    only once answered, so the jobs of a worker that crashes are retried
+    by the others. Jobs the model fails to run are answered with their
+    error and dead-lettered, see `answer_batch`. Models are loaded by
+    the first job that needs them.
+    Images are decoded and preprocessed by the `ImagePrefetcher` while
+    the model runs the previous batch
+
+    Args:
+    - model_names (List[str]): The names of the CLIP models served
+    - device (str): The device to run the inference on
+    - worker_mode (WorkerMode): The jobs served and the towers loaded
+    """
+    _redis_client = redis.Redis.from_url(url=get_redis_url(), decode_responses=False)
+    worker_metrics.start_metrics_server(get_metrics_port())
+
+    # The image processors are only configurations, the
+    # models are loaded when needed by the pool. Text workers
+    # only read images whose features are known
+    modalities = WORKER_MODALITIES[worker_mode]
+    image_processors = {}
+    if redis_models.IMAGE_JOBS in modalities:
+        image_processors = {
+            model_name: CLIPImageProcessor.from_pretrained(model_name)
+            for model_name in model_names}
+    model_pool = ModelPool(
+        device,
+        backend_type=get_inference_backend(),
+        precision=resolve_precision(get_clip_precision(), device),
+        buckets=get_batch_buckets(),
+        onnx_cache_dir=get_onnx_cache_dir(),
+        memory_budget_mb=get_model_memory_budget_mb(),
+        worker_mode=worker_mode)
+    # The default model is loaded upfront, the others on demand
+    model_pool.get(model_names[0])
+
+    result = _redis_client.ping()
+    if not result:
+        raise ConnectionError("Could not connect to the Redis server")
+    else:
+        print("Connected to the Redis server: ", result)
+
+    # The API scores the zero-shot classifications with the logit scale of the model
+    _redis_client.hset(redis_models.LOGIT_SCALES_KEY, mapping={
+        model_name: math.exp(load_logit_scale(model_name)) for model_name in model_names})
+
+    label_sets = LabelSetStore(_redis_client, device=device, dtype=torch.float32)
+
+    worker_id = get_worker_id()
+    worker_stats = WorkerStats(_redis_client, worker_id)
+
+    job_queue = JobQueue(
+        _redis_client,
+        model_names=model_names,
+        modalities=modalities,
+        consumer=worker_id,
+        claim_idle_ms=get_job_claim_idle_ms(),
+        max_deliveries=get_job_max_deliveries(),
+        policy=get_priority_policy(),
+        weights=get_priority_weights())
+    job_queue.create_group()
+    job_queue.start_heartbeat()
+
+    prefetcher = ImagePrefetcher(
+        redis_client=_redis_client,
+        job_queue=job_queue,
+        image_processors=image_processors,
+        max_batch_size=get_max_batch_size(),
+        max_batch_wait_ms=get_max_batch_wait_ms(),
+        num_workers=get_preprocess_workers(),
+        prefetch_batches=get_prefetch_batches())
+    prefetcher.start()
+
+    while True:
+        batch = prefetcher.get()
+
+        # Jobs can expire while waiting in the prefetch queue
+        batch = drop_expired(batch, job_queue)
+        if not batch.jobs:
+            continue
+
+        start = time.perf_counter()
+        for model_batch in split_by_model(batch):
+            model_name = model_batch.jobs[0].model_name
+            responses, failed = answer_batch(model_batch, model_pool, label_sets, model_name)
+
+            try:
+                push_responses(_redis_client, model_batch.jobs, responses)
+                failed_ids = {job.job_id for job in failed}
+                job_queue.ack([job for job in model_batch.jobs if job.job_id not in failed_ids])
+                if failed:
+                    job_queue.dead_letter(failed, reason="inference failed")
+            except redis.RedisError as e:
+                # The jobs stay pending and are retried once reclaimed
+                print(f"Could not answer {len(model_batch.jobs)} jobs of {model_name}: {e}")
+                continue
+            worker_metrics.JOBS.labels(model_name).inc(len(model_batch.jobs) - len(failed))
+            worker_metrics.FAILED_JOBS.labels(model_name).inc(len(failed))
+        worker_stats.report(time.perf_counter() - start, len(batch.jobs))
 
 
 if __name__ == "__main__":
-    model_name = get_clip_model_name()
+    model_names = get_clip_model_names()
+    worker_mode = get_worker_mode()
     device = "cuda" if torch.cuda.is_available() else "cpu"
     device_name = torch.cuda.get_device_name(0) if torch.cuda.is_available() else "CPU"
     print(f"Inference configuration:")
-    print(f"\t- model name: {model_name}")
+    print(f"\t- model names: {', '.join(model_names)}")
+    print(f"\t- worker mode: {worker_mode.value}")
+    print(f"\t- model memory budget: {get_model_memory_budget_mb() or 'unlimited'} MB")
     print(f"\t- device: {device.capitalize()}")
     print(f"\t- device name: {device_name}")
-    
-    run_inference(model_name=model_name, device=device)
\ No newline at end of file
+    print(f"\t- backend: {get_inference_backend().value}")
+    print(f"\t- precision: {get_clip_precision().value}")
+    print(f"\t- batch buckets: {get_batch_buckets()}")
+    print(f"\t- max batch size: {get_max_batch_size()}")
+    print(f"\t- max batch wait: {get_max_batch_wait_ms()} ms")
+    print(f"\t- preprocess workers: {get_preprocess_workers()}")
+    print(f"\t- prefetch batches: {get_prefetch_batches()}")
+    print(f"\t- job claim idle: {get_job_claim_idle_ms()} ms")
+    print(f"\t- job max deliveries: {get_job_max_deliveries()}")
+    print(f"\t- priority policy: {get_priority_policy().value}")
+    print(f"\t- priority weights: {get_priority_weights()}")
+    print(f"\t- metrics port: {get_metrics_port() or 'disabled'}")
+
+    run_inference(model_names=model_names, device=device, worker_mode=worker_mode)
@@ -0,0 +1,467 @@
+"""
+Job queue of the inference workers, backed by one Redis Stream per
+model, modality and priority class read through a consumer group. Every
+job is delivered to a single worker and stays pending until acknowledged,
+jobs left pending by a worker that crashed are reclaimed by the others.
+The idle time of the jobs a worker holds is refreshed while they wait
+for and run through the model, so slow batches are never reclaimed.
+"""
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import redis
+
+import redis_models
+import worker_metrics
+from environment_variables import WorkerMode, PriorityPolicy
+
+# Number of entries kept in the dead-letter stream
+DEAD_LETTER_MAXLEN = 10000
+
+# Jobs read by every worker mode, classification jobs come with
+# all their features and are served by the text workers
+WORKER_MODALITIES = {
+    WorkerMode.FULL: redis_models.JOB_MODALITIES,
+    WorkerMode.TEXT: [redis_models.TEXT_JOBS, redis_models.CLASSIFICATION_JOBS],
+    WorkerMode.IMAGE: [redis_models.IMAGE_JOBS],
+}
+
+
+def _decode(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class JobQueue():
+    """
+    Reads the jobs of the `modalities` streams of the `model_names` as
+    the `consumer` member of `JOB_GROUP`. The streams of the priority
+    classes are read according to `policy`. Entries pending for more than
+    `claim_idle_ms` are claimed by the next worker asking for jobs, after
+    `max_deliveries` attempts they are moved to `DEAD_LETTER_STREAM`. Jobs are
+    acknowledged and deleted from the stream once answered, together
+    with their images. Until then the heartbeat refreshes their idle
+    time, see `start_heartbeat`
+    """
+    def __init__(
+            self,
+            redis_client: redis.Redis,
+            model_names: List[str],
+            modalities: List[str],
+            consumer: str,
+            claim_idle_ms: int,
+            max_deliveries: int,
+            policy: PriorityPolicy = PriorityPolicy.WEIGHTED,
+            weights: List[int] = None,
+            claim_interval_s: float = 1.0):
+        """
+        Constructor for the JobQueue class
+
+        Args:
+        - redis_client (redis.Redis): The Redis client
+        - model_names (List[str]): The models whose jobs are read
+        - modalities (List[str]): The modalities of the jobs read, see `redis_models.JOB_MODALITIES`
+        - consumer (str): The name of this worker in the consumer group
+        - claim_idle_ms (int): The time after which a pending job is reclaimed
+            when its worker stopped refreshing it
+        - max_deliveries (int): The number of attempts before a job is dead-lettered
+        - policy (PriorityPolicy): How the jobs of the priority classes are read
+        - weights (List[int]): The weight of every priority class with the
+            weighted policy, highest priority first. Equal weights if not set
+        - claim_interval_s (float): The minimum time between two scans of the pending jobs
+        """
+        self.redis_client = redis_client
+        # The streams of every priority class, highest priority first
+        self.class_streams = [
+            [
+                redis_models.job_stream(model_name, modality, priority)
+                for model_name in model_names
+                for modality in modalities]
+            for priority in redis_models.PRIORITY_CLASSES]
+        self.streams = {
+            redis_models.job_stream(model_name, modality, priority): model_name
+            for priority in redis_models.PRIORITY_CLASSES
+            for model_name in model_names
+            for modality in modalities}
+        self.stream_priorities = {
+            stream: priority
+            for priority, streams in zip(redis_models.PRIORITY_CLASSES, self.class_streams)
+            for stream in streams}
+        self.policy = policy
+        self.weights = weights or [1] * len(redis_models.PRIORITY_CLASSES)
+        self.consumer = consumer
+        self.claim_idle_ms = claim_idle_ms
+        self.max_deliveries = max_deliveries
+        self.claim_interval_s = claim_interval_s
+
+        self.last_claim = 0.0
+        # Stream, entry and deadline of the jobs read and not acknowledged
+        # yet, jobs are read by the prefetch thread and acknowledged
+        # by the inference loop
+        self.entry_ids: Dict[str, Tuple[str, bytes, Optional[float]]] = {}
+        self.lock = threading.Lock()
+        # Jobs read past the requested count with their stream, returned
+        # first by the next reads of the stream. Only the prefetch thread reads
+        self.held: List[Tuple[str, redis_models.RedisRequestItem]] = []
+
+    def create_group(self):
+        """
+        Create the consumer group and the streams if they do not exist
+        """
+        for stream in self.streams:
+            try:
+                self.redis_client.xgroup_create(stream, redis_models.JOB_GROUP, id="0", mkstream=True)
+            except redis.ResponseError as e:
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    def _parse(
+            self,
+            stream: str,
+            entries: List[Tuple[bytes, Dict[bytes, bytes]]]) -> List[redis_models.RedisRequestItem]:
+        """
+        Parse the jobs of stream entries and track their entry ids, the
+        model of a job is the one of its stream. Entries that are not
+        valid jobs are dead-lettered right away
+        """
+        jobs, invalid = [], []
+        dequeued = time.time()
+        for entry_id, fields in entries:
+            try:
+                job = redis_models.RedisRequestItem.from_json(fields[b"job"])
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Invalid job in entry {entry_id}: {e}")
+                invalid.append((entry_id, fields or {}))
+                continue
+            job.model_name = self.streams[stream]
+            if job.timings is None:
+                job.timings = redis_models.JobTimings()
+            job.timings.dequeued = dequeued
+            jobs.append(job)
+
+            with self.lock:
+                self.entry_ids[job.job_id] = (stream, entry_id, job.deadline)
+
+        if invalid:
+            self._dead_letter(stream, invalid, reason="invalid job")
+        return jobs
+
+    def _quotas(self, count: int) -> List[int]:
+        """
+        Get the number of jobs every priority class can take from a batch
+        of `count` jobs, before the unused shares are redistributed
+        """
+        if self.policy == PriorityPolicy.STRICT:
+            # Every class can fill the batch, in priority order
+            return [count] * len(self.class_streams)
+        total = sum(self.weights)
+        return [max(1, count * weight // total) for weight in self.weights]
+
+    def read(self, count: int, block_ms: int) -> List[redis_models.RedisRequestItem]:
+        """
+        Read new jobs, never delivered to any worker, from all the streams.
+        Every priority class first gets its quota of the batch, see `_quotas`,
+        then the classes that had jobs take the rest, highest priority first.
+        When no job is queued, waits for the first job of any class
+
+        Args:
+        - count (int): The maximum number of jobs, split between the streams
+        - block_ms (int): The maximum time to wait for a job, must be positive
+
+        Returns:
+        - List[RedisRequestItem]: The jobs, oldest first within every model
+            and priority class. Empty if none arrived in time
+        """
+        jobs, busy_classes = [], []
+        for streams, quota in zip(self.class_streams, self._quotas(count)):
+            limit = min(quota, count - len(jobs))
+            if limit <= 0:
+                break
+            class_jobs = self._read_streams(streams, limit)
+            if class_jobs:
+                busy_classes.append(streams)
+                jobs.extend(class_jobs)
+
+        # The share of the classes without jobs goes to the others
+        for streams in busy_classes:
+            if len(jobs) >= count:
+                break
+            jobs.extend(self._read_streams(streams, count - len(jobs)))
+
+        if jobs:
+            return jobs
+        return self._read_streams(list(self.streams), count, block_ms)
+
+    def _read_streams(
+            self,
+            streams: List[str],
+            count: int,
+            block_ms: Optional[int] = None) -> List[redis_models.RedisRequestItem]:
+        """
+        Read new jobs from some of the streams, without waiting if `block_ms`
+        is not set or jobs are held. COUNT applies to every stream, so the
+        oldest `count` jobs read are returned and the others are held for
+        the next reads, already delivered to this worker and refreshed
+        """
+        wanted = set(streams)
+        jobs = [job for stream, job in self.held if stream in wanted][:count]
+        if jobs:
+            taken = {job.job_id for job in jobs}
+            self.held = [(stream, job) for stream, job in self.held if job.job_id not in taken]
+            if len(jobs) == count:
+                return jobs
+            block_ms = None
+
+        result = self.redis_client.xreadgroup(
+            redis_models.JOB_GROUP,
+            self.consumer,
+            {stream: ">" for stream in streams},
+            count=count - len(jobs),
+            block=block_ms)
+        if not result:
+            return jobs
+
+        # One (stream, entries) pair per stream with new jobs
+        read = []
+        now_ms = time.time() * 1000
+        for stream, entries in result:
+            stream = stream.decode() if isinstance(stream, bytes) else stream
+            # Entry ids start with the time the entry was added, in milliseconds
+            queue_wait = worker_metrics.QUEUE_WAIT.labels(self.stream_priorities[stream])
+            for entry_id, _ in entries:
+                entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+                queue_wait.observe(max(0.0, now_ms - int(entry_id.split("-")[0])) / 1000)
+            read.extend((stream, job) for job in self._parse(stream, entries))
+
+        read.sort(key=lambda item: self._entry_order(item[1]))
+        kept = count - len(jobs)
+        jobs.extend(job for _, job in read[:kept])
+        self.held.extend(read[kept:])
+        return jobs
+
+    def _entry_order(self, job: redis_models.RedisRequestItem) -> Tuple[int, int]:
+        """
+        Get the time and sequence number of the entry of a job, in the
+        order the jobs were added across streams
+        """
+        with self.lock:
+            _, entry_id, _ = self.entry_ids.get(job.job_id, (None, b"0-0", None))
+        timestamp, sequence = _decode(entry_id).split("-")
+        return int(timestamp), int(sequence)
+
+    def claim_stale(self, count: int) -> List[redis_models.RedisRequestItem]:
+        """
+        Claim the jobs left pending by other workers for more than
+        `claim_idle_ms`, and dead-letter the ones that already had
+        `max_deliveries` attempts. The pending jobs are scanned at most
+        once every `claim_interval_s` seconds
+
+        Args:
+        - count (int): The maximum number of jobs
+
+        Returns:
+        - List[RedisRequestItem]: The claimed jobs
+        """
+        if time.monotonic() - self.last_claim < self.claim_interval_s:
+            return []
+        self.last_claim = time.monotonic()
+
+        jobs = []
+        for stream in self.streams:
+            jobs.extend(self._claim_stream(stream, count - len(jobs)))
+            if len(jobs) >= count:
+                break
+        return jobs
+
+    def _claim_stream(self, stream: str, count: int) -> List[redis_models.RedisRequestItem]:
+        """
+        Claim the stale jobs of a stream, see `claim_stale`
+        """
+        # Same as XAUTOCLAIM, but XPENDING also reports how many
+        # times every entry has been delivered
+        pending = self.redis_client.xpending_range(
+            stream,
+            redis_models.JOB_GROUP,
+            min="-",
+            max="+",
+            count=count,
+            idle=self.claim_idle_ms)
+        # The jobs this worker is still running are not claimed again, the
+        # heartbeat may just be late. Jobs past their deadline are claimed
+        # even from this worker, it may have lost track of them
+        live = {entry_id for _, entry_id in self._live_entries()}
+        pending = [
+            item for item in pending
+            if _decode(item["consumer"]) != self.consumer or item["message_id"] not in live]
+        if not pending:
+            return []
+
+        deliveries = {item["message_id"]: item["times_delivered"] for item in pending}
+
+        # The idle time is checked again by XCLAIM, so an entry is
+        # claimed by a single worker even if several see it pending
+        claimed = self.redis_client.xclaim(
+            stream,
+            redis_models.JOB_GROUP,
+            self.consumer,
+            min_idle_time=self.claim_idle_ms,
+            message_ids=list(deliveries))
+
+        retry, exhausted, deleted = [], [], []
+        for entry_id, fields in claimed:
+            if not fields:
+                # Deleted from the stream while pending, e.g. answered
+                # by a worker that was considered gone
+                deleted.append(entry_id)
+            elif deliveries[entry_id] >= self.max_deliveries:
+                exhausted.append((entry_id, fields))
+            else:
+                retry.append((entry_id, fields))
+
+        if deleted:
+            self.redis_client.xack(stream, redis_models.JOB_GROUP, *deleted)
+        if exhausted:
+            self._dead_letter(stream, exhausted, reason=f"failed after {self.max_deliveries} deliveries")
+        if retry:
+            print(f"Claimed {len(retry)} stale jobs of {stream}")
+        return self._parse(stream, retry)
+
+    def _dead_letter(self, stream: str, entries: List[Tuple[bytes, Dict[bytes, bytes]]], reason: str):
+        """
+        Move entries to the dead-letter stream and delete their images
+        """
+        print(f"Moving {len(entries)} jobs to the dead-letter stream: {reason}")
+        jobs = []
+        pipeline = self.redis_client.pipeline(transaction=True)
+        for entry_id, fields in entries:
+            pipeline.xadd(
+                redis_models.DEAD_LETTER_STREAM,
+                {**fields, b"stream": stream, b"entry_id": entry_id, b"reason": reason, b"consumer": self.consumer},
+                maxlen=DEAD_LETTER_MAXLEN,
+                approximate=True)
+            try:
+                jobs.append(redis_models.RedisRequestItem.from_json(fields[b"job"]))
+            except (KeyError, TypeError, ValueError):
+                pass
+        entry_ids = [entry_id for entry_id, _ in entries]
+        pipeline.xack(stream, redis_models.JOB_GROUP, *entry_ids)
+        pipeline.xdel(stream, *entry_ids)
+        pipeline.execute()
+
+        self._delete_images(jobs)
+
+    def _delete_images(self, jobs: List[redis_models.RedisRequestItem]):
+        """
+        Delete the images of jobs that will not be processed again
+        """
+        images_key = [
+            img_item.image_key
+            for job in jobs
+            for img_item in job.images
+            if img_item.image_key is not None]
+        if images_key:
+            self.redis_client.delete(*images_key)
+
+        for job in jobs:
+            for img_item in job.images:
+                if img_item.image_path is not None and os.path.exists(img_item.image_path):
+                    os.remove(img_item.image_path)
+
+    def _live_entries(self) -> List[Tuple[str, bytes]]:
+        """
+        Get the stream and entry of the jobs read and not acknowledged
+        yet whose deadline has not passed. Past the deadline nobody
+        waits for the answer, so a job this worker lost track of is
+        reclaimed and dropped, by this worker too
+        """
+        now = time.time()
+        with self.lock:
+            return [
+                (stream, entry_id)
+                for stream, entry_id, deadline in self.entry_ids.values()
+                if deadline is None or deadline > now]
+
+    def refresh(self):
+        """
+        Reset the idle time of the live jobs of this worker, so that they
+        are not claimed by the other workers. XCLAIM with JUSTID does
+        not count as a delivery
+        """
+        entry_ids: Dict[str, List[bytes]] = {}
+        for stream, entry_id in self._live_entries():
+            entry_ids.setdefault(stream, []).append(entry_id)
+        if not entry_ids:
+            return
+
+        pipeline = self.redis_client.pipeline(transaction=False)
+        for stream, stream_entry_ids in entry_ids.items():
+            pipeline.xclaim(
+                stream,
+                redis_models.JOB_GROUP,
+                self.consumer,
+                min_idle_time=0,
+                message_ids=stream_entry_ids,
+                justid=True)
+        pipeline.execute()
+
+    def start_heartbeat(self):
+        """
+        Refresh the live jobs every third of `claim_idle_ms` from a
+        background thread, so that a long batch, a model load or a
+        compilation does not get the jobs waiting for it reclaimed
+        """
+        def heartbeat():
+            while True:
+                time.sleep(self.claim_idle_ms / 3000)
+                try:
+                    self.refresh()
+                except redis.RedisError as e:
+                    print(f"Error while refreshing the jobs in flight: {e}")
+
+        threading.Thread(target=heartbeat, name="job-heartbeat", daemon=True).start()
+
+    def dead_letter(self, jobs: List[redis_models.RedisRequestItem], reason: str):
+        """
+        Move jobs that failed to the dead-letter stream, they are not
+        retried. Their images are deleted
+
+        Args:
+        - jobs (List[RedisRequestItem]): The jobs that failed
+        - reason (str): Why the jobs failed, stored with every entry
+        """
+        entries: Dict[str, List[Tuple[bytes, Dict[bytes, bytes]]]] = {}
+        with self.lock:
+            for job in jobs:
+                if job.job_id in self.entry_ids:
+                    stream, entry_id, _ = self.entry_ids.pop(job.job_id)
+                    entries.setdefault(stream, []).append((entry_id, {b"job": job.to_json()}))
+
+        for stream, stream_entries in entries.items():
+            self._dead_letter(stream, stream_entries, reason)
+
+    def ack(self, jobs: List[redis_models.RedisRequestItem]):
+        """
+        Acknowledge jobs that have been answered or dropped, they are
+        deleted from the stream together with their images
+
+        Args:
+        - jobs (List[RedisRequestItem]): The jobs to acknowledge
+        """
+        entry_ids: Dict[str, List[bytes]] = {}
+        with self.lock:
+            for job in jobs:
+                if job.job_id in self.entry_ids:
+                    stream, entry_id, _ = self.entry_ids.pop(job.job_id)
+                    entry_ids.setdefault(stream, []).append(entry_id)
+
+        if entry_ids:
+            pipeline = self.redis_client.pipeline(transaction=True)
+            for stream, stream_entry_ids in entry_ids.items():
+                pipeline.xack(stream, redis_models.JOB_GROUP, *stream_entry_ids)
+                # Acknowledged entries are never read again, deleting them
+                # keeps the length of the stream equal to the queued jobs
+                pipeline.xdel(stream, *stream_entry_ids)
+            pipeline.execute()
+
+        self._delete_images(jobs)
@@ -0,0 +1,139 @@
+"""
+Pool of the CLIP models hosted by an inference worker. Models are
+loaded on the first job that needs them and the least recently used
+ones are unloaded to stay within the memory budget.
+"""
+import gc
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List
+
+import torch
+from transformers import CLIPTokenizerFast
+
+import worker_metrics
+from backends import InferenceBackend, create_backend
+from precision import apply_precision
+from towers import load_model
+from environment_variables import InferenceBackendType, ClipPrecision, WorkerMode
+
+
+@dataclass
+class LoadedModel:
+    """
+    A CLIP model ready for inference
+    """
+    backend: InferenceBackend
+    size_bytes: int
+
+
+def _release_memory():
+    """
+    Free the memory of the models no longer referenced
+    """
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+class ModelPool():
+    """
+    Keeps the loaded models in least recently used order. When loading
+    a model would exceed `memory_budget_mb`, the least recently used
+    models are unloaded first. The size of a model is only known once
+    loaded, so the first load of a model can temporarily exceed the
+    budget. A single model larger than the budget is still loaded.
+    A model counts for the memory its backend runs with, for the ONNX
+    backend the sessions only, as the PyTorch weights are released.
+    With a text or image `worker_mode` only the tower of the mode is loaded
+    """
+    def __init__(
+            self,
+            device: str,
+            backend_type: InferenceBackendType,
+            precision: ClipPrecision,
+            buckets: List[int],
+            onnx_cache_dir: str,
+            memory_budget_mb: int = 0,
+            worker_mode: WorkerMode = WorkerMode.FULL):
+        """
+        Constructor for the ModelPool class
+
+        Args:
+        - device (str): The device the models are loaded on
+        - backend_type (InferenceBackendType): The backend that runs the models
+        - precision (ClipPrecision): The precision the models are converted to
+        - buckets (List[int]): The batch sizes the backends are prepared for
+        - onnx_cache_dir (str): The directory the models exported to ONNX are stored in
+        - memory_budget_mb (int): The memory available for the models, 0 for no limit
+        - worker_mode (WorkerMode): The towers of the models that are loaded
+        """
+        self.device = device
+        self.backend_type = backend_type
+        self.precision = precision
+        self.buckets = buckets
+        self.onnx_cache_dir = onnx_cache_dir
+        self.memory_budget_bytes = memory_budget_mb * 1024 * 1024
+        self.worker_mode = worker_mode
+        self.models: OrderedDict = OrderedDict()
+        # Size of every model loaded at least once
+        self.known_sizes: Dict[str, int] = {}
+
+    def _used_bytes(self) -> int:
+        return sum(loaded.size_bytes for loaded in self.models.values())
+
+    def _evict(self, needed_bytes: int):
+        """
+        Unload the least recently used models until `needed_bytes` fit in the budget
+        """
+        if self.memory_budget_bytes <= 0:
+            return
+
+        evicted = False
+        while self.models and self._used_bytes() + needed_bytes > self.memory_budget_bytes:
+            model_name, loaded = self.models.popitem(last=False)
+            print(f"Unloading model {model_name} ({loaded.size_bytes / 2**20:.0f} MB)")
+            worker_metrics.MODEL_MEMORY.remove(model_name)
+            del loaded
+            evicted = True
+
+        if evicted:
+            # Release the memory right away, before the next model is loaded
+            _release_memory()
+
+    def get(self, model_name: str) -> LoadedModel:
+        """
+        Get a model, loading it if needed
+
+        Args:
+        - model_name (str): The name of the CLIP model
+
+        Returns:
+        - LoadedModel: The prepared backend of the model
+        """
+        if model_name in self.models:
+            self.models.move_to_end(model_name)
+            return self.models[model_name]
+
+        self._evict(self.known_sizes.get(model_name, 0))
+
+        print(f"Loading model {model_name}")
+        tokenizer = CLIPTokenizerFast.from_pretrained(model_name, device_map="auto")
+        model = load_model(model_name, self.worker_mode).to(self.device)
+        model = apply_precision(model.eval(), self.precision)
+
+        backend = create_backend(
+            self.backend_type, model, tokenizer, self.device, self.buckets, model_name, self.onnx_cache_dir)
+        if backend.model is None:
+            # The backend does not run the PyTorch weights, free them
+            # before they are accounted or the next model is loaded
+            del model
+            _release_memory()
+        loaded = LoadedModel(backend=backend, size_bytes=backend.memory_bytes())
+        self.known_sizes[model_name] = loaded.size_bytes
+
+        # Unload the other models if this one turned out larger than expected
+        self._evict(loaded.size_bytes)
+        self.models[model_name] = loaded
+        worker_metrics.MODEL_MEMORY.labels(model_name).set(loaded.size_bytes)
+        return loaded
@@ -0,0 +1,51 @@
+"""
+Reduced precision modes of the CLIP model, applied once the model
+is loaded and before the inference backend is prepared.
+"""
+import torch
+from transformers import CLIPModel
+
+from environment_variables import ClipPrecision
+
+
+def resolve_precision(precision: ClipPrecision, device: str) -> ClipPrecision:
+    """
+    Get the precision actually used on `device`, fp16 is only
+    supported on GPU and dynamic int8 quantization only on CPU
+
+    Args:
+    - precision (ClipPrecision): The requested precision
+    - device (str): The device the model runs on
+
+    Returns:
+    - ClipPrecision: The precision to use
+    """
+    if precision == ClipPrecision.FP16 and device != "cuda":
+        print("fp16 is only supported on GPU, using fp32")
+        return ClipPrecision.FP32
+    if precision == ClipPrecision.INT8 and device != "cpu":
+        print("int8 is only supported on CPU, using fp32")
+        return ClipPrecision.FP32
+    return precision
+
+
+def apply_precision(model: CLIPModel, precision: ClipPrecision) -> CLIPModel:
+    """
+    Convert a float32 model to the given precision. With int8 the
+    weights of the linear layers are quantized and the activations
+    quantized on the fly, the model inputs and outputs stay float32
+
+    Args:
+    - model (CLIPModel): The float32 model, already on its device
+    - precision (ClipPrecision): The precision, see `resolve_precision`
+
+    Returns:
+    - CLIPModel: The converted model
+    """
+    if precision == ClipPrecision.FP16:
+        return model.to(torch.float16)
+    if precision == ClipPrecision.BF16:
+        return model.to(torch.bfloat16)
+    if precision == ClipPrecision.INT8:
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
@@ -0,0 +1,104 @@
+"""
+Loading of only the text or only the vision tower of a CLIP model, for
+the workers that serve a single modality. The towers are wrapped with
+the same interface of `CLIPModel` used by the backends.
+"""
+import math
+
+import torch
+from huggingface_hub import hf_hub_download
+from safetensors import safe_open
+from transformers import (
+    CLIPConfig, CLIPModel, CLIPTextModelWithProjection, CLIPVisionModelWithProjection)
+
+from environment_variables import WorkerMode
+
+# Logit scale of the OpenAI CLIP checkpoints, clamped to 100 during training
+DEFAULT_LOGIT_SCALE = math.log(100)
+
+
+def load_logit_scale(model_name: str) -> float:
+    """
+    Read the learned logit scale of a model from its checkpoint, without
+    loading the towers. It is not part of the tower-only models
+
+    Args:
+    - model_name (str): The name of the CLIP model
+
+    Returns:
+    - float: The logit scale, before the exponential
+    """
+    try:
+        path = hf_hub_download(model_name, "model.safetensors")
+        with safe_open(path, framework="pt") as checkpoint:
+            return checkpoint.get_tensor("logit_scale").item()
+    except Exception as e:
+        print(f"Could not read the logit scale of {model_name}: {type(e).__name__}: {e}")
+        print(f"Using {DEFAULT_LOGIT_SCALE:.4f}")
+        return DEFAULT_LOGIT_SCALE
+
+
+class ClipTowers(torch.nn.Module):
+    """
+    A CLIP model with only its text or only its vision tower loaded.
+    Has the `get_text_features`, `get_image_features`, `logit_scale`,
+    `config` and `dtype` of `CLIPModel`, the missing tower raises
+    """
+    def __init__(
+            self,
+            config: CLIPConfig,
+            logit_scale: float,
+            text_model: CLIPTextModelWithProjection = None,
+            vision_model: CLIPVisionModelWithProjection = None):
+        """
+        Constructor for the ClipTowers class
+
+        Args:
+        - config (CLIPConfig): The configuration of the full model
+        - logit_scale (float): The learned logit scale, before the exponential
+        - text_model (CLIPTextModelWithProjection): The text tower, if loaded
+        - vision_model (CLIPVisionModelWithProjection): The vision tower, if loaded
+        """
+        super().__init__()
+        self.config = config
+        self.text_model = text_model
+        self.vision_model = vision_model
+        self.logit_scale = torch.nn.Parameter(torch.tensor(logit_scale))
+        self.has_text = text_model is not None
+        self.has_image = vision_model is not None
+
+    @property
+    def dtype(self) -> torch.dtype:
+        return self.logit_scale.dtype
+
+    def get_text_features(self, input_ids: torch.Tensor, attention_mask: torch.Tensor) -> torch.Tensor:
+        if self.text_model is None:
+            raise RuntimeError("The text tower is not loaded by this worker")
+        return self.text_model(input_ids=input_ids, attention_mask=attention_mask).text_embeds
+
+    def get_image_features(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        if self.vision_model is None:
+            raise RuntimeError("The vision tower is not loaded by this worker")
+        return self.vision_model(pixel_values=pixel_values).image_embeds
+
+
+def load_model(model_name: str, mode: WorkerMode) -> torch.nn.Module:
+    """
+    Load the part of a CLIP model needed by a worker
+
+    Args:
+    - model_name (str): The name of the CLIP model
+    - mode (WorkerMode): The worker mode
+
+    Returns:
+    - torch.nn.Module: The `CLIPModel`, or the `ClipTowers` with the tower of the mode
+    """
+    if mode == WorkerMode.FULL:
+        return CLIPModel.from_pretrained(model_name, device_map="auto")
+
+    config = CLIPConfig.from_pretrained(model_name)
+    if mode == WorkerMode.TEXT:
+        tower = CLIPTextModelWithProjection.from_pretrained(model_name, device_map="auto")
+        return ClipTowers(config, load_logit_scale(model_name), text_model=tower)
+    tower = CLIPVisionModelWithProjection.from_pretrained(model_name, device_map="auto")
+    return ClipTowers(config, load_logit_scale(model_name), vision_model=tower)
@@ -0,0 +1,78 @@
+"""
+Prometheus metrics of the inference worker, served on `METRICS_PORT`.
+Timings of the stages a job goes through, from the wait in the queue to
+the push of the response, the size of the batches, the items embedded
+and the memory taken by the models. The process metrics (RSS, CPU) are
+exported by the default collectors of `prometheus_client`.
+"""
+import time
+
+import torch
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# Stages timed by the worker
+IMAGE_DECODE_STAGE = "image_decode"
+PREPROCESS_STAGE = "preprocess"
+TOKENIZATION_STAGE = "tokenization"
+FORWARD_STAGE = "forward"
+SERIALIZATION_STAGE = "serialization"
+PUSH_STAGE = "push"
+
+# From a single small image to a large batch of a slow model
+STAGE_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+QUEUE_WAIT_BUCKETS = (.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512)
+
+QUEUE_WAIT = Histogram(
+    "clipserve_worker_queue_wait_seconds",
+    "Time between the job was added to its stream and read by a worker",
+    ["priority"],
+    buckets=QUEUE_WAIT_BUCKETS)
+STAGE_SECONDS = Histogram(
+    "clipserve_worker_stage_seconds",
+    "Time spent in every stage, per image for image_decode and preprocess, "
+    "per batch and modality for tokenization and forward, per batch for the others",
+    ["stage", "modality"],
+    buckets=STAGE_BUCKETS)
+BATCH_SIZE = Histogram(
+    "clipserve_worker_batch_size",
+    "Number of jobs and of items run by the model in a batch",
+    ["kind"],
+    buckets=BATCH_SIZE_BUCKETS)
+ITEMS = Counter(
+    "clipserve_worker_items",
+    "Texts and images run by the model, rate() gives the items per second",
+    ["modality"])
+JOBS = Counter(
+    "clipserve_worker_jobs",
+    "Jobs answered by the worker, per model",
+    ["model"])
+FAILED_JOBS = Counter(
+    "clipserve_worker_failed_jobs",
+    "Jobs answered with an error and dead-lettered, per model",
+    ["model"])
+MODEL_MEMORY = Gauge(
+    "clipserve_worker_model_memory_bytes",
+    "Memory taken by the weights of the loaded models",
+    ["model"])
+
+
+def start_metrics_server(port: int):
+    """
+    Serve the metrics on a background thread, `port` 0 disables them
+    """
+    if port <= 0:
+        return
+    if torch.cuda.is_available():
+        Gauge(
+            "clipserve_worker_cuda_memory_allocated_bytes",
+            "Memory allocated by PyTorch on the GPU").set_function(torch.cuda.memory_allocated)
+    start_http_server(port)
+    print(f"Serving the metrics on port {port}")
+
+
+def observe_stage(stage: str, start: float, modality: str = ""):
+    """
+    Observe the time spent in a stage since `start`, a `time.perf_counter()` value
+    """
+    STAGE_SECONDS.labels(stage, modality).observe(time.perf_counter() - start)
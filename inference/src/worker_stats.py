@@ -0,0 +1,68 @@
+"""
+Load reporting of the inference workers, used by the API
+to estimate the queue wait time for admission control.
+"""
+import os
+import socket
+import time
+
+import redis
+
+# Workers that did not report in this time are considered gone
+WORKER_HEARTBEAT_S = 30
+
+
+def get_worker_id() -> str:
+    """
+    Get an id unique to this worker process
+    """
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkerStats():
+    """
+    Tracks an exponential moving average of the time spent per job
+    and publishes it to Redis. Active workers are kept in the `workers`
+    sorted set scored by their last report, their average job time in
+    the `workers:job_time_s` hash
+    """
+    def __init__(self, redis_client: redis.Redis, worker_id: str, smoothing: float = 0.1):
+        """
+        Constructor for the WorkerStats class
+
+        Args:
+        - redis_client (redis.Redis): The Redis client
+        - worker_id (str): The id of this worker
+        - smoothing (float): The weight of the newest sample in the average
+        """
+        self.redis_client = redis_client
+        self.worker_id = worker_id
+        self.smoothing = smoothing
+        self.job_time_s = None
+
+    def report(self, elapsed_s: float, jobs_count: int):
+        """
+        Add a processed batch to the average and publish it
+
+        Args:
+        - elapsed_s (float): The time spent on the batch, in seconds
+        - jobs_count (int): The number of jobs in the batch
+        """
+        if jobs_count <= 0:
+            return
+
+        sample = elapsed_s / jobs_count
+        if self.job_time_s is None:
+            self.job_time_s = sample
+        else:
+            self.job_time_s = (1 - self.smoothing) * self.job_time_s + self.smoothing * sample
+
+        try:
+            pipeline = self.redis_client.pipeline(transaction=False)
+            now = time.time()
+            pipeline.zadd("workers", {self.worker_id: now})
+            pipeline.zremrangebyscore("workers", 0, now - 10 * WORKER_HEARTBEAT_S)
+            pipeline.hset("workers:job_time_s", self.worker_id, self.job_time_s)
+            pipeline.execute()
+        except redis.RedisError as e:
+            print(f"Error while reporting the worker stats: {e}")
@@ -0,0 +1,122 @@
+"""
+Zero-shot classification helpers: scoring of image embeddings against
+label embeddings and the store of the registered label sets.
+"""
+import json
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+import redis
+import torch
+
+import redis_models
+
+# Number of labels scored at once when only the top-k labels are requested
+LABEL_CHUNK_SIZE = 4096
+# Number of label sets kept on the device by every worker
+MAX_CACHED_LABEL_SETS = 16
+
+
+def classify(
+        image_embeds: torch.Tensor,
+        label_embeds: torch.Tensor,
+        logit_scale: torch.Tensor,
+        top_k: Optional[int] = None,
+        chunk_size: int = LABEL_CHUNK_SIZE) -> Tuple[Optional[torch.Tensor], torch.Tensor]:
+    """
+    Compute the softmax scores of normalized image embeddings over
+    normalized label embeddings. With `top_k` the labels are scored in
+    chunks keeping a running log-sum-exp and the best candidates, so
+    the full (images x labels) matrix is never materialized
+
+    Args:
+    - image_embeds (torch.Tensor): The normalized image embeddings, (n_images, dim)
+    - label_embeds (torch.Tensor): The normalized label embeddings, (n_labels, dim)
+    - logit_scale (torch.Tensor): The learned temperature, already exponentiated
+    - top_k (Optional[int]): The number of best labels to keep, None for all
+    - chunk_size (int): The number of labels scored at once
+
+    Returns:
+    - Optional[torch.Tensor]: The indices of the best labels, (n_images, k),
+        None when `top_k` is None
+    - torch.Tensor: The softmax scores, (n_images, k) or (n_images, n_labels)
+    """
+    if top_k is None:
+        logits_per_image = logit_scale * image_embeds @ label_embeds.t()
+        return None, logits_per_image.softmax(dim=1)
+
+    n_images, n_labels = image_embeds.shape[0], label_embeds.shape[0]
+    k = min(top_k, n_labels)
+
+    log_sum_exp = torch.full((n_images,), float("-inf"), device=image_embeds.device, dtype=image_embeds.dtype)
+    best_logits = torch.empty((n_images, 0), device=image_embeds.device, dtype=image_embeds.dtype)
+    best_indices = torch.empty((n_images, 0), device=image_embeds.device, dtype=torch.long)
+
+    for start in range(0, n_labels, chunk_size):
+        logits = logit_scale * image_embeds @ label_embeds[start:start + chunk_size].t()
+        log_sum_exp = torch.logaddexp(log_sum_exp, torch.logsumexp(logits, dim=1))
+
+        chunk_logits, chunk_indices = logits.topk(min(k, logits.shape[1]), dim=1)
+        candidate_logits = torch.cat([best_logits, chunk_logits], dim=1)
+        candidate_indices = torch.cat([best_indices, chunk_indices + start], dim=1)
+
+        best_logits, order = candidate_logits.topk(min(k, candidate_logits.shape[1]), dim=1)
+        best_indices = candidate_indices.gather(1, order)
+
+    return best_indices, (best_logits - log_sum_exp[:, None]).exp()
+
+
+class LabelSetStore():
+    """
+    Loads the label sets registered through the API and keeps the
+    most recently used ones on the device. Label sets are stored in
+    Redis as a hash with the `labels` (JSON list), the normalized
+    float32 `embeddings` matrix and its `version`
+    """
+    def __init__(self, redis_client: redis.Redis, device: str, dtype: torch.dtype):
+        """
+        Constructor for the LabelSetStore class
+
+        Args:
+        - redis_client (redis.Redis): The Redis client
+        - device (str): The device the label embeddings are moved to
+        - dtype (torch.dtype): The data type of the model
+        """
+        self.redis_client = redis_client
+        self.device = device
+        self.dtype = dtype
+        self.label_sets: OrderedDict = OrderedDict()
+
+    def get(self, ref: redis_models.RedisLabelSetRef) -> Tuple[List[str], torch.Tensor]:
+        """
+        Get a label set, loading it from Redis if not cached
+
+        Args:
+        - ref (RedisLabelSetRef): The label set referenced by the job
+
+        Returns:
+        - List[str]: The labels
+        - torch.Tensor: The normalized label embeddings, (n_labels, dim)
+
+        Raises:
+        - KeyError: If the label set does not exist or was registered again
+        """
+        cache_key = (ref.key, ref.version)
+        if cache_key in self.label_sets:
+            self.label_sets.move_to_end(cache_key)
+            return self.label_sets[cache_key]
+
+        labels, embeddings, version = self.redis_client.hmget(ref.key, ["labels", "embeddings", "version"])
+        if version is None or version.decode() != ref.version:
+            raise KeyError(f"Label set {ref.key} version {ref.version} not found")
+
+        labels = json.loads(labels)
+        matrix = np.frombuffer(embeddings, dtype="<f4").reshape(len(labels), -1)
+        label_embeds = torch.from_numpy(matrix.copy()).to(device=self.device, dtype=self.dtype)
+
+        self.label_sets[cache_key] = (labels, label_embeds)
+        while len(self.label_sets) > MAX_CACHED_LABEL_SETS:
+            self.label_sets.popitem(last=False)
+
+        return labels, label_embeds
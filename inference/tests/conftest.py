@@ -0,0 +1,8 @@
+import os
+import sys
+
+# the worker modules are flat in src, as when run by the container,
+# the tiny CLIP model of the benchmark is used by the model checks
+_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(_ROOT, "inference", "src"))
+sys.path.insert(0, os.path.join(_ROOT, "benchmark"))
@@ -0,0 +1,85 @@
+import io
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from transformers import CLIPImageProcessor, CLIPModel
+
+from backends import InferenceBackend
+from image_downscale import downscale_image, model_input_size
+from image_pipeline import prepare_image
+from tiny_clip import create_offline_cache, tiny_tokenizer
+
+MODEL = "openai/clip-vit-base-patch32"
+# Same as the default of evaluate_downscale.py
+MIN_COSINE = 0.99
+
+
+def generated_image(width: int, height: int, seed: int, image_format: str) -> bytes:
+    """
+    A smooth color gradient with a few random rectangles, like a photo
+    it has both flat regions and sharp edges
+    """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, width)[None, :, None]
+    y = np.linspace(0, 1, height)[:, None, None]
+    pixels = 255 * (x * rng.random(3) + y * rng.random(3)) / 2
+    for _ in range(6):
+        left, top = rng.integers(0, width // 2), rng.integers(0, height // 2)
+        pixels[top:top + rng.integers(20, height // 2), left:left + rng.integers(20, width // 2)] = rng.integers(0, 256, 3)
+
+    output = io.BytesIO()
+    Image.fromarray(pixels.astype(np.uint8)).save(output, format=image_format, quality=95)
+    return output.getvalue()
+
+
+@pytest.fixture(scope="module")
+def tiny_model(tmp_path_factory):
+    snapshot_dir = create_offline_cache(
+        str(tmp_path_factory.mktemp("hf_home")), MODEL, image_size=model_input_size(MODEL))
+    model = CLIPModel.from_pretrained(snapshot_dir).eval()
+    backend = InferenceBackend(model, tiny_tokenizer(), "cpu", [8])
+    return backend, CLIPImageProcessor.from_pretrained(snapshot_dir)
+
+
+def embed(tiny_model, images_bytes) -> torch.Tensor:
+    backend, image_processor = tiny_model
+    prepared = [prepare_image(image_processor, image_bytes=data) for data in images_bytes]
+    assert all(image.error is None for image in prepared)
+    return backend.encode_image(torch.stack([image.pixel_values for image in prepared])).float()
+
+
+def test_downscaled_images_give_the_same_embeddings(tiny_model):
+    full_bytes = [
+        generated_image(1024, 768, seed=0, image_format="JPEG"),
+        generated_image(768, 1024, seed=1, image_format="JPEG"),
+        generated_image(1280, 720, seed=2, image_format="PNG"),
+        generated_image(640, 640, seed=3, image_format="PNG"),
+    ]
+    downscaled_bytes = [downscale_image(data, model_input_size(MODEL)) for data in full_bytes]
+
+    for full, downscaled in zip(full_bytes, downscaled_bytes):
+        assert len(downscaled) < len(full)
+        with Image.open(io.BytesIO(downscaled)) as img:
+            assert min(img.size) == model_input_size(MODEL)
+
+    cosine = torch.nn.functional.cosine_similarity(
+        embed(tiny_model, full_bytes), embed(tiny_model, downscaled_bytes), dim=-1)
+    assert cosine.min().item() >= MIN_COSINE
+
+
+@pytest.mark.parametrize("image_bytes", [
+    generated_image(200, 300, seed=0, image_format="JPEG"),
+    b"not an image",
+])
+def test_images_that_cannot_be_downscaled_are_unchanged(image_bytes):
+    assert downscale_image(image_bytes, model_input_size(MODEL)) is image_bytes
+
+
+def test_transparent_images_are_unchanged():
+    output = io.BytesIO()
+    Image.new("RGBA", (1024, 768), (255, 0, 0, 128)).save(output, format="PNG")
+    image_bytes = output.getvalue()
+
+    assert downscale_image(image_bytes, model_input_size(MODEL)) is image_bytes
@@ -0,0 +1,137 @@
+import time
+
+import fakeredis
+import pytest
+
+import redis_models
+from job_queue import JobQueue
+
+MODEL = "openai/clip-vit-base-patch32"
+OTHER_MODEL = "openai/clip-vit-base-patch16"
+CLAIM_IDLE_MS = 50
+
+
+def make_queue(redis_client, consumer: str, max_deliveries: int = 3) -> JobQueue:
+    queue = JobQueue(
+        redis_client,
+        model_names=[MODEL, OTHER_MODEL],
+        modalities=[redis_models.TEXT_JOBS],
+        consumer=consumer,
+        claim_idle_ms=CLAIM_IDLE_MS,
+        max_deliveries=max_deliveries,
+        claim_interval_s=0)
+    queue.create_group()
+    return queue
+
+
+def add_jobs(redis_client, count: int, model_name: str = MODEL, deadline: float = None, prefix: str = "job"):
+    stream = redis_models.job_stream(model_name, redis_models.TEXT_JOBS, redis_models.INTERACTIVE_PRIORITY)
+    for idx in range(count):
+        job = redis_models.RedisRequestItem(
+            job_id=f"{prefix}-{idx}",
+            texts=[redis_models.RedisTextItem(text=f"text {idx}")],
+            deadline=time.time() + 60 if deadline is None else deadline)
+        redis_client.xadd(stream, {"job": job.to_json()})
+    return stream
+
+
+def wait_idle():
+    time.sleep(CLAIM_IDLE_MS * 2 / 1000)
+
+
+@pytest.fixture
+def redis_client():
+    return fakeredis.FakeRedis()
+
+
+def test_read_never_exceeds_count(redis_client):
+    queue = make_queue(redis_client, "worker-a")
+    add_jobs(redis_client, 5, MODEL, prefix="a")
+    add_jobs(redis_client, 5, OTHER_MODEL, prefix="b")
+
+    batches = [queue.read(4, block_ms=10) for _ in range(4)]
+
+    assert [len(batch) for batch in batches] == [4, 4, 2, 0]
+    job_ids = [job.job_id for batch in batches for job in batch]
+    assert sorted(job_ids) == sorted([f"a-{idx}" for idx in range(5)] + [f"b-{idx}" for idx in range(5)])
+
+
+def test_stale_jobs_are_claimed_by_other_workers(redis_client):
+    worker_a = make_queue(redis_client, "worker-a")
+    worker_b = make_queue(redis_client, "worker-b")
+    add_jobs(redis_client, 2)
+
+    assert len(worker_a.read(8, block_ms=10)) == 2
+    wait_idle()
+
+    # a worker never claims again the jobs it is running
+    assert worker_a.claim_stale(8) == []
+    assert sorted(job.job_id for job in worker_b.claim_stale(8)) == ["job-0", "job-1"]
+
+
+def test_refreshed_jobs_are_not_claimed(redis_client):
+    worker_a = make_queue(redis_client, "worker-a")
+    worker_b = make_queue(redis_client, "worker-b")
+    add_jobs(redis_client, 2)
+
+    worker_a.read(8, block_ms=10)
+    wait_idle()
+    worker_a.refresh()
+
+    assert worker_b.claim_stale(8) == []
+
+
+def test_expired_jobs_are_reclaimed_by_their_worker(redis_client):
+    queue = make_queue(redis_client, "worker-a")
+    add_jobs(redis_client, 1, deadline=time.time() - 1)
+
+    queue.read(8, block_ms=10)
+    wait_idle()
+    queue.refresh()
+    wait_idle()
+
+    assert [job.job_id for job in queue.claim_stale(8)] == ["job-0"]
+
+
+def test_jobs_are_dead_lettered_after_max_deliveries(redis_client):
+    worker_a = make_queue(redis_client, "worker-a", max_deliveries=2)
+    worker_b = make_queue(redis_client, "worker-b", max_deliveries=2)
+    worker_c = make_queue(redis_client, "worker-c", max_deliveries=2)
+    stream = add_jobs(redis_client, 1)
+
+    worker_a.read(8, block_ms=10)
+    wait_idle()
+    assert len(worker_b.claim_stale(8)) == 1
+    wait_idle()
+    assert worker_c.claim_stale(8) == []
+
+    dead = redis_client.xrange(redis_models.DEAD_LETTER_STREAM)
+    assert len(dead) == 1
+    assert dead[0][1][b"reason"] == b"failed after 2 deliveries"
+    assert redis_client.xlen(stream) == 0
+    assert redis_client.xpending(stream, redis_models.JOB_GROUP)["pending"] == 0
+
+
+def test_failed_jobs_are_dead_lettered(redis_client):
+    queue = make_queue(redis_client, "worker-a")
+    stream = add_jobs(redis_client, 2)
+
+    first, second = queue.read(8, block_ms=10)
+    queue.dead_letter([first], reason="inference failed")
+    queue.ack([second])
+
+    dead = redis_client.xrange(redis_models.DEAD_LETTER_STREAM)
+    assert [fields[b"reason"] for _, fields in dead] == [b"inference failed"]
+    assert redis_models.RedisRequestItem.from_json(dead[0][1][b"job"]).job_id == first.job_id
+    assert redis_client.xlen(stream) == 0
+    assert redis_client.xpending(stream, redis_models.JOB_GROUP)["pending"] == 0
+
+
+def test_invalid_jobs_are_dead_lettered(redis_client):
+    queue = make_queue(redis_client, "worker-a")
+    stream = redis_models.job_stream(MODEL, redis_models.TEXT_JOBS, redis_models.INTERACTIVE_PRIORITY)
+    redis_client.xadd(stream, {"job": "not json"})
+
+    assert queue.read(8, block_ms=10) == []
+    dead = redis_client.xrange(redis_models.DEAD_LETTER_STREAM)
+    assert [fields[b"reason"] for _, fields in dead] == [b"invalid job"]